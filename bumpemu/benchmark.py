@@ -0,0 +1,352 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for the hot paths, each timed against the implementation it replaced (kept here as a reference) after
+checking the two agree. Run with python -m bumpemu.benchmark NAME.
+"""
+
+import argparse
+import os
+import random
+import struct
+import timeit
+from time import monotonic
+
+from bumpemu.charger.status import Status, StatusSnapshot, STATUS_SIZE
+from bumpemu.circular_bytearray import CircularByteArray
+from bumpemu.controller.constants import Message
+from bumpemu.controller.frame_decoder import FrameDecoder
+from bumpemu.util import crc16, Crc16, checksum, rotate_bit16_left, swap_bytes
+
+
+def _old_crc16(data, init):
+    crc = init
+    for bb in data:
+        for _ in range(8):
+            if (bb ^ crc) & 1:
+                crc = (crc >> 1) ^ 0x8408
+            else:
+                crc >>= 1
+            bb >>= 1
+    return crc
+
+
+def _old_rotate_bit16_left(val, nrolls):
+    while nrolls:
+        bit = (val & (1 << 15)) >> 15
+        val <<= 1
+        val |= bit
+        nrolls -= 1
+    return val & 0xffff
+
+
+def _old_checksum(data, init):
+    cksum = init
+    for ii in range(0, len(data), 2):
+        cksum += ((data[ii] << 8) | data[ii + 1])
+        cksum = _old_rotate_bit16_left(cksum & 0xffff, 2)
+    return cksum
+
+
+def _old_swap_bytes(data, start=0):
+    for ii in range(start, len(data), 2):
+        tmp = data[ii]
+        data[ii] = data[ii + 1]
+        data[ii + 1] = tmp
+    return data
+
+
+class _OldCircularByteArray(CircularByteArray):
+    """
+    CircularByteArray with the per-byte copies it used before.
+    """
+
+    def append(self, data):
+        if self.available() >= len(data):
+            start = self._real_index(self._write_idx)
+            jj = 0
+            for ii in range(start, min(start + len(data), len(self._buf))):
+                self._buf[ii] = data[jj]
+                jj += 1
+            for ii in range(0, len(data) - jj):
+                self._buf[ii] = data[jj]
+                jj += 1
+            self._write_idx += len(data)
+            return True
+        return False
+
+    def consume(self, nbytes):
+        if self.size() >= nbytes:
+            real_start = self._real_index(self.read_index)
+            real_stop = self._real_index(self.read_index + nbytes)
+            if real_start < real_stop or not nbytes:
+                data = bytearray(self._buf[real_start:real_start + nbytes])
+            else:
+                data = bytearray(nbytes)
+                jj = 0
+                for ii in range(real_start, len(self._buf)):
+                    data[jj] = self._buf[ii]
+                    jj += 1
+                for ii in range(0, real_stop):
+                    data[jj] = self._buf[ii]
+                    jj += 1
+            self._read_idx += nbytes
+            return data
+        return None
+
+
+def _best(func, repeat, number=None):
+    """
+    Returns the best time per call over repeat runs of func.
+    """
+    if number is None:
+        number, _ = timeit.Timer(func).autorange()
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def _header(before='before', after='after'):
+    print('%-40s %12s %12s %8s' % ('', before, after, 'speedup'))
+
+
+def _report(name, before, after):
+    print('%-40s %9.1f us %9.1f us %7.1fx' % (name, before * 1e6, after * 1e6, before / after))
+
+
+def _report_rate(name, nbytes, before, after):
+    print('%-40s %7.1f MB/s %7.1f MB/s %7.1fx' % (name, nbytes / before / 1e6, nbytes / after / 1e6,
+                                                 before / after))
+
+
+def bench_crc(args, rnd):
+    for init in (0x18e4, 0x926, 0x342, 0x5ada, 0x4d1, 0xf5, 0x1114):
+        for size in (0, 1, 153, 7680):
+            data = bytes(rnd.getrandbits(8) for _ in range(size))
+            stream = Crc16(init)
+            for ii in range(0, size, 97):
+                stream.update(data[ii:ii + 97])
+            assert crc16(data, init) == _old_crc16(data, init) == stream.value
+
+    _header()
+    for name, size in (('crc16, 7680-byte preset image', 7680), ('crc16, 153-byte Ram frame', 153)):
+        data = bytes(rnd.getrandbits(8) for _ in range(size))
+        _report(name, _best(lambda: _old_crc16(data, 0x5ada), args.repeat),
+                _best(lambda: crc16(data, 0x5ada), args.repeat))
+
+
+def bench_checksum(args, rnd):
+    for val in (0, 1, 0x8000, 0xffff, 0x1234):
+        for nrolls in range(20):
+            assert rotate_bit16_left(val, nrolls) == _old_rotate_bit16_left(val, nrolls)
+    for size in (0, 2, 510, 7680):
+        data = bytearray(rnd.getrandbits(8) for _ in range(size))
+        assert checksum(data, 0) == _old_checksum(data, 0)
+        for start in (0, 4):
+            assert swap_bytes(bytearray(data), start) == _old_swap_bytes(bytearray(data), start)
+
+    _header()
+    blocks = [bytearray(rnd.getrandbits(8) for _ in range(510)) for _ in range(15)]
+    _report('checksum, 15 x 510-byte blocks', _best(lambda: [_old_checksum(bb, 0) for bb in blocks], args.repeat),
+            _best(lambda: [checksum(memoryview(bb), 0) for bb in blocks], args.repeat))
+    wrtp = bytearray(rnd.getrandbits(8) for _ in range(7684))
+    _report('swap_bytes, 7684-byte WrtP', _best(lambda: _old_swap_bytes(wrtp, 4), args.repeat),
+            _best(lambda: swap_bytes(wrtp, 4), args.repeat))
+
+
+def bench_ring(args, rnd):
+    for capacity in (7, 64, 4096):
+        old, new = _OldCircularByteArray(capacity), CircularByteArray(capacity)
+        for _ in range(2000):
+            nbytes = rnd.randint(1, capacity)
+            if rnd.random() < 0.5:
+                data = bytes(rnd.getrandbits(8) for _ in range(nbytes))
+                assert old.append(data) == new.append(data)
+            else:
+                assert old.consume(nbytes) == new.consume(nbytes)
+
+    def pump(ring, chunk, total):
+        for _ in range(total // len(chunk)):
+            ring.append(chunk)
+            ring.consume(len(chunk))
+
+    # 48 KB ring as used for the serial port; 245760 is a multiple of every chunk size so runs stay aligned
+    total = 245760
+    _header()
+    for name, size in (('append + consume, 20-byte BLE writes', 20), ('append + consume, 40-byte BLE writes', 40),
+                       ('append + consume, 240-byte serial reads', 240)):
+        chunk = bytes(rnd.getrandbits(8) for _ in range(size))
+        old, new = _OldCircularByteArray(48 * 1024), CircularByteArray(48 * 1024)
+        _report_rate(name, total, _best(lambda: pump(old, chunk, total), args.repeat, 1),
+                     _best(lambda: pump(new, chunk, total), args.repeat, 1))
+
+    rfd, wfd = os.pipe()
+    try:
+        chunk = bytes(240)
+        ring = CircularByteArray(48 * 1024)
+
+        def from_pipe():
+            for _ in range(total // len(chunk)):
+                os.write(wfd, chunk)
+                ring.readinto(rfd, len(chunk))
+                ring.advance(len(chunk))
+        print('%-40s %12s %7.1f MB/s' % ('readinto(fd), 240-byte pipe reads', '',
+                                         total / _best(from_pipe, args.repeat, 1) / 1e6))
+    finally:
+        os.close(rfd)
+        os.close(wfd)
+
+
+# What the emulator reads from each status per tick (status_loop, _status_message, the poll rate and checks)
+_STATUS_TICK_FIELDS = ('firmware_version', 'mode', 'error_code', 'chem8', 'ch1_cells', 'fuel_level', 'avg_amps',
+                       'b_volts', 'mah_in', 'mah_out', 'charge_seconds', 'status_flags', 'rx_status_flags',
+                       'cv_started', 'lower_pwm_reason', 'mohm', 'bypass_percent', 'supply_volts', 'supply_amps',
+                       'cpu_temp', 'active_preset', 'options_flash_changed', 'preset_flash_changed')
+
+
+def _status_tick(status):
+    return [getattr(status, name) for name in _STATUS_TICK_FIELDS]
+
+
+def _ram_response(rnd, cmd_size):
+    # A Ram response as read_status gets it: the echoed command, the payload and its CRC. Mode 0x63 is left out;
+    # Status.mode_to_str can't format it.
+    resp = bytearray(rnd.getrandbits(8) for _ in range(cmd_size + STATUS_SIZE + 2))
+    if resp[cmd_size + 133] == 0x63:
+        resp[cmd_size + 133] = 0
+    return bytes(resp)
+
+
+def bench_status(args, rnd):
+    cmd_size = 4
+    for _ in range(500):
+        resp = _ram_response(rnd, cmd_size)
+        status, snapshot = Status(bytearray(resp[cmd_size:cmd_size + STATUS_SIZE])), StatusSnapshot(resp, cmd_size)
+        assert _status_tick(status) == _status_tick(snapshot)
+        assert str(status) == str(snapshot)
+
+    resp = _ram_response(rnd, cmd_size)
+    _header('Status', 'StatusSnapshot')
+    _report('decode + status_loop fields', _best(
+        lambda: _status_tick(Status(bytearray(resp[cmd_size:cmd_size + STATUS_SIZE]))), args.repeat),
+        _best(lambda: _status_tick(StatusSnapshot(resp, cmd_size)), args.repeat))
+    # The same reads from an object that already holds every value; what is left of a tick once decoding is free
+    snapshot = StatusSnapshot(resp, cmd_size)
+    values = argparse.Namespace(**{name: getattr(snapshot, name) for name in _STATUS_TICK_FIELDS})
+    print('%-40s %12s %9.1f us' % ('  floor (values precomputed)', '', _best(lambda: _status_tick(values),
+                                                                            args.repeat) * 1e6))
+    _report('decode + mohm', _best(
+        lambda: Status(bytearray(resp[cmd_size:cmd_size + STATUS_SIZE])).mohm, args.repeat),
+        _best(lambda: StatusSnapshot(resp, cmd_size).mohm, args.repeat))
+    status, snapshot = Status(bytearray(resp[cmd_size:cmd_size + STATUS_SIZE])), StatusSnapshot(resp, cmd_size)
+    _report('str() for --log-status', _best(lambda: str(status), args.repeat),
+            _best(lambda: str(snapshot), args.repeat))
+
+
+def _app_frame(message_id, payload):
+    frame = bytearray(len(payload) + Message.OVERHEAD)
+    struct.pack_into(Message.HEADER_FORMAT, frame, 0, Message.PREAMBLE_BYTE, 0x64, message_id, len(payload))
+    frame[Message.PAYLOAD_OFFSET:-Message.CRC_BYTES] = payload
+    struct.pack_into(Message.CRC_FORMAT, frame, len(frame) - Message.CRC_BYTES,
+                     crc16(frame[:-Message.CRC_BYTES], init=Message.CRC_SEED))
+    return bytes(frame)
+
+
+def _app_writes(rnd, count):
+    """
+    Returns count writes as a lossy link delivers them, each split into fragments, and the (message_id, payload)
+    of every frame that arrives intact. A write is a good frame, one with a bit flipped (sometimes in its length),
+    one cut short or noise full of stray preambles.
+    """
+    writes, intact = [], []
+    for _ in range(count):
+        message_id = rnd.randint(0, 255)
+        payload = bytes(rnd.getrandbits(8) for _ in range(rnd.randint(0, 40)))
+        frame = bytearray(_app_frame(message_id, payload))
+        kind = rnd.random()
+        if kind < 0.7:
+            intact.append((message_id, payload))
+        elif kind < 0.8:
+            frame[rnd.randrange(len(frame))] ^= 1 << rnd.randrange(8)
+        elif kind < 0.9:
+            frame[4] ^= 1 << rnd.randrange(8)
+        elif kind < 0.95:
+            del frame[rnd.randrange(1, len(frame)):]
+        else:
+            frame = bytes(rnd.choice((Message.PREAMBLE_BYTE, rnd.getrandbits(8))) for _ in range(rnd.randint(1, 12)))
+        fragments, ii = [], 0
+        while ii < len(frame):
+            nbytes = rnd.randint(1, 20)
+            fragments.append(bytes(frame[ii:ii + nbytes]))
+            ii += nbytes
+        writes.append(fragments)
+    return writes, intact
+
+
+def bench_frames(args, rnd):
+    timeout = 0.2
+    writes, intact = _app_writes(rnd, 20000)
+
+    def decode(expire):
+        decoder = FrameDecoder(4096, timeout)
+        frames = []
+        started = monotonic()
+        for fragments in writes:
+            for fragment in fragments:
+                frames.extend((message_id, bytes(payload)) for message_id, payload in decoder.feed(fragment))
+            if expire:
+                # App writes are far apart; act as if the timeout ran out before the next one
+                frames.extend((message_id, bytes(payload))
+                              for message_id, payload in decoder.expire(monotonic() + timeout))
+        return frames, monotonic() - started, decoder
+
+    print('%d writes, %d frames intact' % (len(writes), len(intact)))
+    for name, expire in (('without expire()', False), ('with expire()', True)):
+        frames, elapsed, decoder = decode(expire)
+        remaining = list(intact)
+        for frame in frames:
+            if remaining and frame == remaining[0]:
+                remaining.pop(0)
+        print('%-18s decoded=%d missing=%d %.0f frames/s' % (name, len(frames), len(remaining),
+                                                             len(frames) / elapsed))
+        print('%-18s %s' % ('', decoder))
+
+
+BENCHMARKS = {
+    'checksum': bench_checksum,
+    'crc': bench_crc,
+    'frames': bench_frames,
+    'ring': bench_ring,
+    'status': bench_status,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the hot paths against the code they replaced.')
+    parser.add_argument('name', nargs='*',
+                        help='benchmarks to run: %s (default: all)' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='take the best of this many runs (default: 5)')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the random test data (default: 1)')
+    pargs = parser.parse_args()
+    for name in pargs.name:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+
+    for name in pargs.name or sorted(BENCHMARKS):
+        print('== %s' % name)
+        BENCHMARKS[name](pargs, random.Random(pargs.seed))
+
+
+if __name__ == '__main__':
+    main()
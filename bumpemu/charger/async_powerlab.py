@@ -0,0 +1,372 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import os
+
+import serial
+
+from bumpemu import debug
+from bumpemu.circular_bytearray import CircularByteArray
+from bumpemu.debug import print_bytes
+from bumpemu.util import ignore_exc
+from bumpemu.charger import powerlab
+from bumpemu.charger.powerlab import PowerlabException, ConnectFailedException, _command, _verify_cmd_with_values
+
+
+async def retry(func, num, interval=.1):
+    while True:
+        try:
+            return await func()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if num <= 0:
+                raise
+            num -= 1
+            if interval > 0:
+                await asyncio.sleep(interval)
+
+
+class _SerialTransport(object):
+    """
+    Non-blocking reads and writes on the serial port's file descriptor, driven by the event loop. Incoming bytes
+    go straight into a ring buffer from the loop's reader callback.
+    """
+
+    def __init__(self, loop, ser):
+        self._logger = logging.getLogger(__name__)
+        self._loop = loop
+        self._ser = ser
+        self._fd = ser.fileno()
+        self._buf = CircularByteArray(48 * 1024)
+        self._waiter = None
+        self._waiter_nbytes = 0
+        self._closed = False
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._loop.remove_reader(self._fd)
+            self._loop.remove_writer(self._fd)
+            self._wake_waiter(ConnectFailedException('serial port closed'))
+
+    def clear(self):
+        self._buf.clear()
+
+    async def wait_for(self, nbytes, timeout):
+        if self._buf.size() < nbytes:
+            if self._closed:
+                raise ConnectFailedException('serial port closed')
+            self._waiter = self._loop.create_future()
+            self._waiter_nbytes = nbytes
+            try:
+                await asyncio.wait_for(self._waiter, timeout)
+            finally:
+                self._waiter = None
+
+    async def read(self, nbytes, timeout):
+        await self.wait_for(nbytes, timeout)
+        return self._buf.consume(nbytes)
+
+    async def write(self, data, timeout):
+        view = memoryview(data)
+        deadline = self._loop.time() + timeout
+        while view:
+            try:
+                nwritten = os.write(self._fd, view)
+            except (BlockingIOError, InterruptedError):
+                nwritten = 0
+            view = view[nwritten:]
+            if view:
+                writable = self._loop.create_future()
+                self._loop.add_writer(self._fd, lambda: writable.done() or writable.set_result(None))
+                try:
+                    await asyncio.wait_for(writable, max(0, deadline - self._loop.time()))
+                finally:
+                    self._loop.remove_writer(self._fd)
+
+    def _on_readable(self):
+        while True:
+            if self._buf.is_full():
+                # Nobody is reading; drop the oldest bytes like the driver would
+                self._buf.clear()
+            try:
+                nread = self._buf.readinto(self._fd)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as ex:
+                self._logger.warning('serial read failed: %s', ex)
+                self.close()
+                return
+            if not nread:
+                self._logger.warning('serial port hung up')
+                self.close()
+                return
+        if self._buf.size() >= self._waiter_nbytes:
+            self._wake_waiter()
+
+    def _wake_waiter(self, exc=None):
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+
+class AsyncPowerlab(object):
+    """
+    asyncio version of Powerlab. Every request is a coroutine. A charger that does not answer in time raises
+    asyncio.TimeoutError (after any retries), and cancelling a request stops waiting on the charger immediately.
+    Requests on one instance are serialized, so several tasks can share a charger and several chargers can be
+    driven from one event loop.
+    """
+    READ_TIMEOUT = 1
+    WRITE_TIMEOUT = 1
+
+    def __init__(self, port, loop=None):
+        self._logger = logging.getLogger(__name__)
+        self._port = port
+        self._using_port = port
+        self._loop = loop
+        self._ser = None
+        self._transport = None
+        self._lock = None
+        self._firmware_version = None
+        self._flash_commit_stats = powerlab.FlashCommitStats()
+        self._write_guard = powerlab.PresetWriteGuard()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, typ, value, traceback):
+        self.close()
+
+    @property
+    def port(self):
+        return self._using_port
+
+    @property
+    def flash_commit_stats(self):
+        return self._flash_commit_stats
+
+    @property
+    def write_guard(self):
+        return self._write_guard
+
+    async def connect(self, read_timeout=READ_TIMEOUT, write_timeout=WRITE_TIMEOUT):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        if not self._port:
+            self._using_port = powerlab._find_port()
+            if not self._using_port:
+                raise ConnectFailedException('no port found')
+
+        self._logger.debug('connecting port:%s read_to:%f, write_to:%f', self._using_port, read_timeout, write_timeout)
+        try:
+            # pyserial opens the port non-blocking; all I/O is done on its fd from the event loop
+            ser = serial.Serial(baudrate=19200, timeout=0, write_timeout=0)
+            ser.dtr = True
+            ser.port = self._using_port
+            ser.open()
+        except Exception as ex:
+            self._logger.debug(str(ex))
+            raise ConnectFailedException()
+
+        if hasattr(ser, 'set_low_latency_mode'):
+            ignore_exc(lambda: ser.set_low_latency_mode(True))
+        self._ser = ser
+        self._transport = _SerialTransport(self._loop, ser)
+
+        retries = 3
+        while retries:
+            try:
+                options = await self._read_options(read_timeout, write_timeout)
+                self._logger.info('connected to %s', self._using_port)
+                return options
+            except asyncio.CancelledError:
+                self.close()
+                raise
+            except Exception as ex:
+                retries -= 1
+                self._logger.debug(str(ex))
+
+        self.close()
+        raise ConnectFailedException()
+
+    def close(self):
+        self._write_guard.forget()
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+        if self._ser:
+            if self._ser.is_open:
+                ignore_exc(self._ser.reset_input_buffer)
+                ignore_exc(self._ser.reset_output_buffer)
+                ignore_exc(self._ser.close)
+            self._ser = None
+            self._logger.info('closed %s', self._using_port)
+
+    async def command_enter(self, num_parallel=1, retries=0):
+        self._logger.debug('command_enter')
+        return await retry(lambda: self._send_cmd(num_parallel, 'E'), retries)
+
+    async def command_monitor(self, num_parallel, use_bananas=True, retries=0):
+        self._logger.debug('command_monitor')
+        return await retry(lambda: self._send_cmd(num_parallel, 'M' if use_bananas else 'm'), retries)
+
+    async def command_charge(self, num_parallel, use_bananas=True, retries=0):
+        self._logger.debug('command_charge')
+        return await retry(lambda: self._send_cmd(num_parallel, 'C' if use_bananas else 'c'), retries)
+
+    async def command_discharge(self, num_parallel, use_bananas=True, retries=0):
+        self._logger.debug('command_discharge')
+        return await retry(lambda: self._send_cmd(num_parallel, 'D' if use_bananas else 'd'), retries)
+
+    async def command_cycle(self, num_parallel, use_bananas=True, retries=0):
+        self._logger.debug('command_cycle')
+        return await retry(lambda: self._send_cmd(num_parallel, 'Y' if use_bananas else 'y'), retries)
+
+    async def command_set_active_preset(self, which, retries=0):
+        self._logger.debug('command_set_active_preset %s', which)
+        write_cmd, calc_crc = powerlab._set_preset_command(which)
+        async def impl():
+            resp = await self._request(write_cmd, nbytes=len(write_cmd) + 2)
+            powerlab._verify_set_preset(which, write_cmd, resp, calc_crc)
+        return await retry(impl, retries)
+
+    async def read_status(self, retries=0):
+        self._logger.debug('read_status')
+        async def impl():
+            cmd = _command('Ram\0')
+            resp = await self._request(cmd, nbytes=153)
+            status = powerlab._parse_status(cmd, resp, self._logger)
+            self._firmware_version = status.firmware_version
+            return status
+        return await retry(impl, retries)
+
+    async def read_presets(self, retries=0):
+        self._logger.debug('reading presets')
+        async def impl():
+            cmd = _command('Prst')
+            resp = await self._request(cmd, nbytes=7686, timeout=7)
+            bank = powerlab._parse_presets(cmd, resp)
+            self._write_guard.remember(bank.image)
+            return bank
+        return await retry(impl, retries)
+
+    async def write_presets(self, presets, retries=0, force=False):
+        self._logger.debug('writing presets')
+        write_cmd, calc_crc, bank = powerlab._presets_write_command(
+            presets, verify=self._logger.isEnabledFor(logging.DEBUG))
+        if not force and self._write_guard.matches(bank.image) and not await self._preset_flash_changed():
+            saved = self._write_guard.record_avoided()
+            bank.mark_clean()
+            self._logger.info('presets already in flash (%08x), skipped write saving ~%.1fs (%s)',
+                              bank.fingerprint(), saved, self._write_guard)
+            return
+        async def impl():
+            async with self._lock:
+                started = self._loop.time()
+                self._logger.debug('erase presets')
+                cmd = _command('ErsP')
+                self._write_guard.record_erase()
+                resp = await self._exchange(cmd, nbytes=6)
+                _verify_cmd_with_values(cmd, resp, bytes([0x22, 0x1b]))
+
+                await asyncio.sleep(.05)
+                self._logger.debug('write presets')
+                await self._exchange(write_cmd, nbytes=0, write_timeout=7)
+                written = self._loop.time()
+                await self._transport.wait_for(1, powerlab.Powerlab.FLASH_COMMIT_TIMEOUT)
+                latency = self._loop.time() - written
+                self._flash_commit_stats.record(self._firmware_version, latency)
+                self._logger.info('presets flash commit took %.3fs (firmware %s)', latency, self._firmware_version)
+                resp = await self._exchange(None, nbytes=7686, timeout=7)
+                powerlab._verify_presets_write(resp, calc_crc)
+                bank.mark_clean()
+                self._write_guard.record_write(bank.image, self._loop.time() - started)
+            self._logger.debug('presets write success')
+        return await retry(impl, retries)
+
+    async def _preset_flash_changed(self):
+        try:
+            status = await self.read_status()
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            self._logger.debug('could not read status: %s', ex)
+            return True
+        return status.preset_flash_changed
+
+    async def read_options(self, retries=0):
+        self._logger.debug('loading options')
+        return await retry(lambda: self._read_options(self.READ_TIMEOUT, self.WRITE_TIMEOUT), retries)
+
+    async def write_options(self, options, retries=0):
+        self._logger.debug('writing options')
+        async def impl():
+            write_cmd, calc_crc = powerlab._options_write_command(options)
+            async with self._lock:
+                self._logger.debug('erase options')
+                cmd = _command('ErsC')
+                resp = await self._exchange(cmd, nbytes=6)
+                _verify_cmd_with_values(cmd, resp, bytes([0x0d, 0x04]))
+
+                self._logger.debug('write options')
+                resp = await self._exchange(write_cmd, nbytes=70)
+                powerlab._verify_options_write(resp, calc_crc)
+            self._logger.debug('options write success')
+        return await retry(impl, retries)
+
+    async def _read_options(self, read_timeout, write_timeout):
+        cmd = _command('PrsI')
+        resp = await self._request(cmd, nbytes=262, timeout=read_timeout, write_timeout=write_timeout)
+        return powerlab._parse_options(cmd, resp, self._logger)
+
+    async def _send_cmd(self, num_parallel, command_char):
+        cmd = powerlab._control_command(num_parallel, command_char)
+        resp = await self._request(cmd, nbytes=6)
+        powerlab._verify_control_command(cmd, resp)
+
+    async def _request(self, data, nbytes, timeout=READ_TIMEOUT, write_timeout=WRITE_TIMEOUT):
+        async with self._lock:
+            return await self._exchange(data, nbytes, timeout, write_timeout)
+
+    async def _exchange(self, data, nbytes, timeout=READ_TIMEOUT, write_timeout=WRITE_TIMEOUT):
+        # The caller must hold self._lock
+        transport = self._transport
+        if transport is None:
+            raise PowerlabException('not connected')
+        if data is not None:
+            ignore_exc(self._ser.reset_output_buffer)
+            ignore_exc(self._ser.reset_input_buffer)
+            transport.clear()
+            await transport.write(data, write_timeout)
+            if debug.LOG_SERIAL:
+                print_bytes(self._logger, logging.DEBUG, data, 'w')
+        if not nbytes:
+            return None
+        resp = await transport.read(nbytes, timeout)
+        if debug.LOG_SERIAL:
+            print_bytes(self._logger, logging.DEBUG, resp, 'r')
+        return resp
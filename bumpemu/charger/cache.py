@@ -0,0 +1,112 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import struct
+import tempfile
+
+
+class PresetCache(object):
+    """
+    Keeps the last preset image read from each charger on disk so reconnecting does not have to read the whole
+    bank back at 19200 baud. An entry is keyed by port and stores the firmware version and options it was read
+    with; it is only handed back when both still match the charger and the image's CRC still checks out.
+    """
+    MAGIC = b'BEPC'
+    VERSION = 1
+    # magic, version, firmware version, options length, preset payload length
+    _HEADER = struct.Struct('>4sBHHH')
+
+    def __init__(self, directory):
+        self._logger = logging.getLogger(__name__)
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def load(self, port, firmware_version, options):
+        """
+        Returns the cached Prst payload (preset image followed by its CRC) for the charger on port, or None if
+        there is no entry or it was read from a different firmware or options.
+        """
+        path = self._path(port)
+        try:
+            with open(path, 'rb') as stream:
+                data = stream.read()
+        except FileNotFoundError:
+            return None
+        except OSError as ex:
+            self._logger.warning('could not read preset cache %s: %s', path, ex)
+            return None
+
+        if len(data) < self._HEADER.size:
+            self._logger.warning('discarding truncated preset cache %s', path)
+            self.invalidate(port)
+            return None
+        magic, version, cached_firmware, options_len, payload_len = self._HEADER.unpack_from(data)
+        if magic != self.MAGIC or version != self.VERSION or \
+                len(data) != self._HEADER.size + options_len + payload_len:
+            self._logger.warning('discarding unrecognized preset cache %s', path)
+            self.invalidate(port)
+            return None
+
+        options_start = self._HEADER.size
+        cached_options = data[options_start:options_start + options_len]
+        if cached_options != options:
+            self._logger.info('preset cache miss on %s: charger options changed', port)
+            return None
+        if cached_firmware != firmware_version:
+            self._logger.info('preset cache miss on %s: firmware %s != %s', port, firmware_version, cached_firmware)
+            return None
+        return data[options_start + options_len:]
+
+    def store(self, port, firmware_version, options, payload):
+        header = self._HEADER.pack(self.MAGIC, self.VERSION, firmware_version, len(options), len(payload))
+        path = self._path(port)
+        try:
+            # Write then rename so a crash never leaves a half written entry behind
+            fd, tmp_path = tempfile.mkstemp(dir=self._directory, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as stream:
+                    stream.write(header)
+                    stream.write(options)
+                    stream.write(payload)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as ex:
+            self._logger.warning('could not write preset cache %s: %s', path, ex)
+            return False
+        self._logger.debug('cached presets for %s in %s', port, path)
+        return True
+
+    def invalidate(self, port):
+        path = self._path(port)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return
+        except OSError as ex:
+            self._logger.warning('could not remove preset cache %s: %s', path, ex)
+            return
+        self._logger.debug('invalidated preset cache for %s', port)
+
+    def _path(self, port):
+        name = os.path.realpath(port).strip(os.sep).replace(os.sep, '_')
+        return os.path.join(self._directory, 'presets-%s.bin' % name)
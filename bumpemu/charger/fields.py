@@ -0,0 +1,268 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import struct
+
+from bumpemu.util import byte_to_char
+
+_CHARS = tuple(byte_to_char(val) for val in range(256))
+
+
+def _compile(name, args, body, namespace):
+    # Offsets, masks and shifts are written into the source as constants, the same way namedtuple builds its class
+    source = 'def %s(%s):\n%s\n' % (name, ', '.join(args), '\n'.join('    ' + line for line in body))
+    exec(source, namespace)
+    return namespace[name]
+
+
+class Field(property):
+    """
+    A property over a fixed place in the instance's _data buffer. Its getter and setter are compiled from the
+    layout, so a get or set is a few constant index, shift and mask operations with no struct format parsing or
+    per-bit loops. The layout stays on the field for exporters: see fields() and describe(), and raw() reads the
+    unconverted value from any buffer.
+    """
+
+    def __init__(self, kind, offset, size, expr, store=None, namespace=None, start_bit=None, end_bit=None,
+                 signed=False, count=1, divisor=None, convert=None, invert=None, boolean=False, fmt=None):
+        self.kind = kind
+        self.offset = offset
+        self.size = size
+        self.start_bit = start_bit
+        self.end_bit = end_bit
+        self.signed = signed
+        self.count = count
+        self.divisor = divisor
+        self.convert = convert
+        self.boolean = boolean
+        # struct format of the value as stored, used by layout()
+        self.fmt = fmt
+
+        namespace = dict(namespace or {})
+        namespace.update(convert=convert, invert=invert, divisor=divisor)
+        self.raw = _compile('raw', ['data'], ['return ' + expr], namespace)
+
+        value_expr = self.value_expr(expr, 'convert')
+        fget = _compile('fget', ['self'], ['data = self._data', 'return ' + value_expr], namespace)
+
+        fset = None
+        self.store = None
+        if store is not None:
+            if boolean:
+                prelude = ['value = 1 if value else 0']
+            elif invert is not None:
+                prelude = ['value = invert(value)']
+            elif divisor is not None:
+                prelude = ['value = int(round(value * divisor))']
+            else:
+                prelude = []
+            fset = _compile('fset', ['self', 'value'], prelude + ['data = self._data'] + store, namespace)
+            self.store = _compile('store', ['data', 'value'], store, namespace)
+        super(Field, self).__init__(fget, fset)
+
+    @property
+    def writable(self):
+        return self.store is not None
+
+    def value_expr(self, expr, convert_name):
+        """
+        Source for this field's value given source for its raw value, calling the convert function by convert_name.
+        """
+        if self.boolean:
+            return '(%s) != 0' % expr
+        elif self.convert is not None:
+            return '%s(%s)' % (convert_name, expr)
+        elif self.divisor is not None:
+            return '(%s) / %r' % (expr, self.divisor)
+        return expr
+
+    def describe(self):
+        return {'kind': self.kind, 'offset': self.offset, 'size': self.size, 'start_bit': self.start_bit,
+                'end_bit': self.end_bit, 'signed': self.signed, 'count': self.count, 'divisor': self.divisor,
+                'writable': self.writable}
+
+
+def uint8(offset, writable=False, divisor=None, convert=None, invert=None):
+    return Field('uint8', offset, 1, 'data[%d]' % offset, ['data[%d] = value' % offset] if writable else None,
+                 divisor=divisor, convert=convert, invert=invert, fmt='B')
+
+
+def int8(offset, divisor=None, convert=None):
+    return Field('int8', offset, 1, 'unpack_from(data, %d)[0]' % offset,
+                 namespace={'unpack_from': struct.Struct('>b').unpack_from}, signed=True, divisor=divisor,
+                 convert=convert, fmt='b')
+
+
+def uint16(offset, writable=False, signed=False, divisor=None, convert=None, invert=None):
+    if signed:
+        packer = struct.Struct('>h')
+        expr = 'unpack_from(data, %d)[0]' % offset
+        store = ['pack_into(data, %d, value)' % offset]
+        namespace = {'unpack_from': packer.unpack_from, 'pack_into': packer.pack_into}
+    else:
+        expr = '(data[%d] << 8) | data[%d]' % (offset, offset + 1)
+        store = ['data[%d] = (value >> 8) & 0xff' % offset, 'data[%d] = value & 0xff' % (offset + 1)]
+        namespace = None
+    return Field('int16' if signed else 'uint16', offset, 2, expr, store if writable else None, namespace,
+                 signed=signed, divisor=divisor, convert=convert, invert=invert, fmt='h' if signed else 'H')
+
+
+def uint32(offset, convert=None):
+    return Field('uint32', offset, 4, 'unpack_from(data, %d)[0]' % offset,
+                 namespace={'unpack_from': struct.Struct('>L').unpack_from}, convert=convert, fmt='L')
+
+
+def array(offset, count, fmt='H', writable=False, convert=None):
+    """
+    count big endian values of struct format fmt, read as a tuple. Setting writes the values given, up to count.
+    """
+    item = struct.Struct('>' + fmt)
+    signed = fmt.islower()
+    store = ['index = %d' % offset,
+             'for item, _ in zip(value, range(%d)):' % count,
+             '    pack_into(data, index, item%s)' % ('' if signed else ' & %d' % ((1 << (8 * item.size)) - 1)),
+             '    index += %d' % item.size]
+    namespace = {'unpack_from': struct.Struct('>%d%s' % (count, fmt)).unpack_from, 'pack_into': item.pack_into}
+    return Field('array', offset, item.size * count, 'unpack_from(data, %d)' % offset, store if writable else None,
+                 namespace, signed=signed, count=count, convert=convert, fmt='%d%s' % (count, fmt))
+
+
+def bits(offset, start_bit, end_bit, writable=False, divisor=None, convert=None, invert=None, boolean=False):
+    """
+    Bits start_bit..end_bit (inclusive, 0 is the least significant) of the big endian 16-bit word at offset.
+    """
+    nbits = end_bit - start_bit + 1
+    mask = (1 << nbits) - 1
+    word = '((data[%d] << 8) | data[%d])' % (offset, offset + 1)
+    expr = '(%s >> %d) & %d' % (word, start_bit, mask) if start_bit else '%s & %d' % (word, mask)
+    store = ['if value < 0:',
+             "    raise Exception('value must be >= 0')",
+             'if value > %d:' % mask,
+             "    raise Exception('value (%%d) too large for bits (%d)' %% value)" % nbits,
+             'int16 = (%s & %d) | (value << %d)' % (word, ~(mask << start_bit) & 0xffff, start_bit),
+             'data[%d] = int16 >> 8' % offset,
+             'data[%d] = int16 & 0xff' % (offset + 1)]
+    return Field('bits', offset, 2, expr, store if writable else None, start_bit=start_bit, end_bit=end_bit,
+                 divisor=divisor, convert=convert, invert=invert, boolean=boolean, fmt='H')
+
+
+def flag(offset, bit, writable=False, end_bit=None):
+    """
+    A boolean bit. With end_bit it reads true if any of bit..end_bit is set and sets only bit.
+    """
+    return bits(offset, bit, bit if end_bit is None else end_bit, writable=writable, boolean=True)
+
+
+def text(offset, nchars, writable=False):
+    """
+    nchars characters stored two to a big endian word, so each pair of bytes holds its characters swapped.
+    Unprintable bytes read as spaces and shorter values are padded with spaces when set.
+    """
+    expr = ' + '.join('chars[data[%d]] + chars[data[%d]]' % (offset + ii + 1, offset + ii)
+                      for ii in range(0, nchars, 2))
+    store = ['if len(value) > %d:' % nchars,
+             "    raise Exception('text too long: %%d > %d characters' %% len(value))" % nchars,
+             'value = value.ljust(%d)' % nchars,
+             'for ii in range(0, %d, 2):' % nchars,
+             '    data[%d + ii] = ord(value[ii])' % (offset + 1),
+             '    data[%d + ii] = ord(value[ii + 1])' % offset]
+    return Field('text', offset, nchars, expr, store if writable else None, {'chars': _CHARS}, count=nchars)
+
+
+def fields(cls):
+    """
+    Returns (name, Field) for every field of cls and its bases, in buffer order.
+    """
+    found = {}
+    for klass in reversed(cls.__mro__):
+        for name, attr in vars(klass).items():
+            if isinstance(attr, Field):
+                found[name] = attr
+    return sorted(found.items(), key=lambda item: (item[1].offset, item[1].start_bit or 0, item[0]))
+
+
+def layout(cls, size):
+    """
+    Returns (offset, fmt, count) for each distinct place the fields of cls are stored in a size byte buffer, in
+    buffer order, where fmt is the struct format of the value(s) there. Bits share the word at their offset.
+    """
+    found = {}
+    for name, field in fields(cls):
+        if field.fmt is None:
+            raise ValueError('%s.%s: %s fields cannot be unpacked' % (cls.__name__, name, field.kind))
+        if found.setdefault(field.offset, (field.fmt, field.count)) != (field.fmt, field.count):
+            raise ValueError('%s.%s: overlaps another field at offset %d' % (cls.__name__, name, field.offset))
+    position = 0
+    places = []
+    for offset in sorted(found):
+        if offset < position:
+            raise ValueError('%s: fields overlap at offset %d' % (cls.__name__, offset))
+        fmt, count = found[offset]
+        position = offset + struct.calcsize('>' + fmt)
+        places.append((offset, fmt, count))
+    if position > size:
+        raise ValueError('%s: fields end at %d, past %d bytes' % (cls.__name__, position, size))
+    return places
+
+
+def record(cls, size):
+    """
+    Builds a record type for the fields of cls whose constructor, (data, offset=0), unpacks the size bytes of
+    data at offset with one precompiled struct.Struct into __slots__. Fields stored as is become plain (and
+    assignable) attributes; converted fields and bits are properties over the unpacked word, so nothing is
+    converted unless it is read. Subclasses add derived values and should declare __slots__ of their own.
+    """
+    table = fields(cls)
+    slots = {}
+    for name, field in table:
+        if field.kind != 'bits' and field.convert is None and field.divisor is None:
+            slots.setdefault(field.offset, name)
+
+    fmt = '>'
+    position = 0
+    targets = []
+    body = []
+    for offset, item, count in layout(cls, size):
+        if offset > position:
+            fmt += '%dx' % (offset - position)
+        fmt += item
+        position = offset + struct.calcsize('>' + item)
+        slot = slots.setdefault(offset, '_raw%d' % offset)
+        values = ['raw%d_%d' % (offset, ii) for ii in range(count)]
+        targets.extend(values)
+        body.append('self.%s = %s' % (slot, '(%s,)' % ', '.join(values) if count > 1 else values[0]))
+    if size > position:
+        fmt += '%dx' % (size - position)
+
+    namespace = {'__slots__': tuple(slots[offset] for offset in sorted(slots))}
+    init_namespace = {'unpack_from': struct.Struct(fmt).unpack_from}
+    namespace['__init__'] = _compile('__init__', ['self', 'data', 'offset=0'],
+                                     ['(%s,) = unpack_from(data, offset)' % ', '.join(targets)] + body,
+                                     init_namespace)
+    for name, field in table:
+        expr = 'self.' + slots[field.offset]
+        if expr == 'self.' + name:
+            continue
+        if field.kind == 'bits':
+            mask = (1 << (field.end_bit - field.start_bit + 1)) - 1
+            if field.boolean:
+                expr = '%s & %d' % (expr, mask << field.start_bit)
+            elif field.start_bit:
+                expr = '(%s >> %d) & %d' % (expr, field.start_bit, mask)
+            else:
+                expr = '%s & %d' % (expr, mask)
+        namespace[name] = property(_compile('fget', ['self'], ['return ' + field.value_expr(expr, 'convert')],
+                                            {'convert': field.convert}))
+    return type('%sRecord' % cls.__name__, (object,), namespace)
@@ -14,6 +14,9 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import os
+import select
+import zlib
 from time import sleep, time
 from threading import Thread, Lock, Condition
 import serial
@@ -22,10 +25,10 @@ import serial.tools.list_ports as list_ports
 from bumpemu.circular_bytearray import CircularByteArray
 from bumpemu import debug
 from bumpemu.debug import print_bytes
-from bumpemu.charger.status import Status
-from bumpemu.charger.preset import Preset
+from bumpemu.charger.status import StatusSnapshot
+from bumpemu.charger.preset import PresetBank
 from bumpemu.charger.options import Options
-from bumpemu.util import swap_bytes, crc16, checksum, ignore_exc
+from bumpemu.util import swap_bytes, crc16, checksum, ignore_exc, Crc16
 
 
 class PowerlabException(Exception):
@@ -61,33 +64,111 @@ def _num_parallel_to_char(num):
 
 def _verify_preset_checksums(data):
     # every 510 bytes is checksummed
-    for ii in range(0, 15):
-        start = ii * 512
-        end = start + 510
-        calc_cksum = checksum(data[start:end], init=0xc8)
-        check16 = (data[end] << 8) | data[end + 1]
-        if calc_cksum != check16:
-            raise ChecksumException('preset block checksum %d failed: cksum=%d calc_cksum=%d' %
-                                    (ii, check16, calc_cksum))
+    with memoryview(data) as view:
+        for ii in range(0, 15):
+            start = ii * 512
+            end = start + 510
+            calc_cksum = checksum(view[start:end], init=0xc8)
+            check16 = (data[end] << 8) | data[end + 1]
+            if calc_cksum != check16:
+                raise ChecksumException('preset block checksum %d failed: cksum=%d calc_cksum=%d' %
+                                        (ii, check16, calc_cksum))
+
+
+class PresetStreamDecoder(object):
+    """
+    Validates a Prst response one 512-byte block at a time as it arrives: each block is 5 presets followed by
+    their checksum, and the whole 7680-byte image is followed by a CRC. Blocks are copied straight into a
+    PresetBank; feed() returns the presets from a block as soon as its checksum passes and raises as soon as
+    anything fails.
+    """
+    BLOCK_SIZE = PresetBank.BLOCK_SIZE
+    NUM_BLOCKS = PresetBank.NUM_BLOCKS
+    PRESETS_PER_BLOCK = PresetBank.PRESETS_PER_BLOCK
+    IMAGE_SIZE = PresetBank.IMAGE_SIZE
+    CRC_INIT = 0x18e4
+
+    def __init__(self):
+        self._crc = Crc16(self.CRC_INIT)
+        self._bank = PresetBank()
+        self._blocks = 0
+        self._done = False
 
+    @property
+    def done(self):
+        return self._done
 
-def _prestart_offset(prestart_num):
-    # every 510 bytes is checksummed
-    return prestart_num * 102 + (prestart_num // 5) * 2
+    @property
+    def bank(self):
+        return self._bank
+
+    @property
+    def image(self):
+        return self._bank.image
+
+    @property
+    def received(self):
+        return self._blocks * self.BLOCK_SIZE
+
+    @property
+    def expected(self):
+        return self.IMAGE_SIZE + 2
+
+    @property
+    def crc(self):
+        return self._crc.value
+
+    def next_size(self):
+        return self.BLOCK_SIZE if self._blocks < self.NUM_BLOCKS else 2
+
+    def feed(self, data):
+        nbytes = self.next_size()
+        if data is None or len(data) < nbytes:
+            raise VerifyException('preset block %d: timed out after %d of %d bytes' %
+                                  (self._blocks, self.received, self.expected))
+
+        if self._blocks == self.NUM_BLOCKS:
+            crc = (data[0] << 8) | data[1]
+            if crc != self._crc.value:
+                raise CrcException('bad CRC')
+            self._bank.mark_clean()
+            self._done = True
+            return []
+
+        end = self.BLOCK_SIZE - 2
+        with memoryview(data) as view:
+            calc_cksum = checksum(view[:end], init=0xc8)
+        cksum = (data[end] << 8) | data[end + 1]
+        if calc_cksum != cksum:
+            raise ChecksumException('preset block checksum %d failed: cksum=%d calc_cksum=%d' %
+                                    (self._blocks, cksum, calc_cksum))
+        self._crc.update(data)
+        start = self._blocks * self.BLOCK_SIZE
+        self._bank.image[start:start + self.BLOCK_SIZE] = data[:self.BLOCK_SIZE]
+
+        first = self._blocks * self.PRESETS_PER_BLOCK
+        self._blocks += 1
+        return self._bank[first:first + self.PRESETS_PER_BLOCK]
 
 
 # We have to do this because the powerlab devs didn't implement flow control *sigh*
 class SerialBuffer(object):
     READ_TIMEOUT = 1
 
-    def __init__(self, ser):
+    def __init__(self, ser, event_driven=False):
         self._logger = logging.getLogger(__name__)
         self._ser = ser
         self._buf = CircularByteArray(48 * 1024)
         self._lock = Lock()
         self._cv = Condition(self._lock)
         self._stopped = False
-        self._thread = Thread(target=self._read_loop, daemon=True)
+        self._wakeup_fds = None
+        if event_driven:
+            self._wakeup_fds = os.pipe()
+            target = self._poll_loop
+        else:
+            target = self._read_loop
+        self._thread = Thread(target=target, daemon=True)
         self._thread.start()
 
     def clear(self):
@@ -96,38 +177,109 @@ class SerialBuffer(object):
     def stop(self):
         self._stopped = True
         with self._cv:
-            self._cv.notify()
+            self._cv.notify_all()
+        if self._wakeup_fds:
+            ignore_exc(lambda: os.write(self._wakeup_fds[1], b'\0'))
+            ignore_exc(lambda: os.close(self._wakeup_fds[1]))
 
     def read(self, nbytes, timeout=READ_TIMEOUT):
+        deadline = time() + timeout
         with self._cv:
             while not self._stopped:
-                start = time()
                 data = self._buf.consume(nbytes)
                 if data:
-                    self._cv.notify()
+                    self._cv.notify_all()
                     return data
-                timeout -= (time() - start)
-                if not self._cv.wait(timeout=timeout):
+                remaining = deadline - time()
+                if remaining <= 0 or not self._cv.wait(timeout=remaining):
                     return None  # timeout
             return None
 
+    def wait_for(self, nbytes, timeout):
+        """
+        Waits until at least nbytes are buffered without consuming them. Returns False on timeout.
+        """
+        deadline = time() + timeout
+        with self._cv:
+            while not self._stopped:
+                if self._buf.size() >= nbytes:
+                    return True
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+                self._cv.wait(timeout=remaining)
+            return False
+
+    def wait_quiet(self, quiet, timeout):
+        """
+        Discards incoming bytes until nothing has arrived for quiet seconds (or timeout expires). Used to let the
+        charger finish sending a response we have given up on before the next command.
+        """
+        deadline = time() + timeout
+        with self._cv:
+            while not self._stopped and time() < deadline:
+                self._buf.clear()
+                received = self._buf.write_index
+                self._cv.wait(timeout=min(quiet, max(0, deadline - time())))
+                if self._buf.write_index == received:
+                    return True
+            self._buf.clear()
+            return False
+
     def _read_loop(self):
         self._ser.timeout = .1
         while not self._stopped:
+            with self._cv:
+                while not self._stopped and self._buf.available() < 240:
+                    self._cv.wait()
+            # Only this thread adds to the buffer, so the free space can be filled without holding the lock
             # noinspection PyBroadException
             try:
-                data = self._ser.read(240)
+                nread = self._buf.readinto(self._ser, 240)
             except:
                 pass
             else:
-                if data:
+                if nread:
                     with self._cv:
-                        while not self._stopped:
-                            if self._buf.append(data):
-                                self._cv.notify()
-                                break
-                            else:
-                                self._cv.wait()
+                        self._cv.notify_all()
+
+    def _poll_loop(self):
+        # Sleeps in poll() until the charger sends something (or stop() is called), so an idle charger
+        # costs no wakeups. Every wakeup drains everything the driver has buffered.
+        fd = self._ser.fileno()
+        wakeup_fd = self._wakeup_fds[0]
+        poller = select.poll()
+        poller.register(fd, select.POLLIN | select.POLLERR | select.POLLHUP)
+        poller.register(wakeup_fd, select.POLLIN)
+        try:
+            while not self._stopped:
+                events = poller.poll()
+                if self._stopped:
+                    break
+                for event_fd, event in events:
+                    if event_fd == fd and event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                        self._logger.warning('serial port hung up')
+                        return
+                self._drain(fd)
+        finally:
+            ignore_exc(lambda: os.close(wakeup_fd))
+
+    def _drain(self, fd):
+        while not self._stopped:
+            with self._cv:
+                while not self._stopped and self._buf.is_full():
+                    self._cv.wait()
+            try:
+                nread = self._buf.readinto(fd)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                self._logger.debug(str(ex))
+                return
+            if not nread:
+                return
+            with self._cv:
+                self._cv.notify_all()
 
 
 def _verify_cmd(cmd, buf):
@@ -143,6 +295,195 @@ def _verify_cmd_with_values(cmd, buf, byte_vals):
         raise VerifyException(cmd.decode('utf-8') + ' failed')
 
 
+def _verify_crc(buf, crc_index, crc_init, logger):
+    crc = (buf[crc_index] << 8) | buf[crc_index + 1]
+    calc_crc = crc16(buf[:crc_index], crc_init)
+    if debug.LOG_SERIAL:
+        logger.debug('crc: %s calc_crc: %s', hex(crc), hex(calc_crc))
+    if crc != calc_crc:
+        raise CrcException('bad CRC')
+
+
+def _verify_cmd_with_crc(cmd, buf, crc_index, crc_init, logger):
+    _verify_cmd(cmd, buf)
+    _verify_crc(buf[len(cmd):], crc_index - len(cmd), crc_init, logger)
+
+
+def _find_port():
+    for port in list_ports.comports():
+        if port.description == 'FT232R USB UART':
+            return port.device
+    return None
+
+
+# The functions below build the commands and check the responses for each request. They do no I/O so that
+# the blocking Powerlab and the asyncio AsyncPowerlab speak exactly the same protocol.
+
+def _control_command(num_parallel, command_char):
+    return _command('Se' + _num_parallel_to_char(num_parallel) + command_char)
+
+
+def _verify_control_command(cmd, resp):
+    _verify_cmd_with_values(cmd, resp, bytes([0x5, 0xdc]))
+
+
+def _set_preset_command(which):
+    if which < 0 or which > 24:
+        raise PowerlabException('invalid preset: %s' % which)
+    return _command('SelP' + chr(which)), crc16([which], init=0x1114)
+
+
+def _verify_set_preset(which, write_cmd, resp, calc_crc):
+    crc = (resp[len(write_cmd)] << 8) | resp[len(write_cmd) + 1]
+    if crc != calc_crc:
+        raise CrcException('set preset %s failed: invalid CRC %s != %s' % (which, hex(crc), hex(calc_crc)))
+
+
+def _parse_status(cmd, resp, logger):
+    _verify_cmd_with_crc(cmd, resp, crc_index=151, crc_init=0x926, logger=logger)
+    return StatusSnapshot(resp, len(cmd))
+
+
+def _parse_presets(cmd, resp):
+    _verify_cmd(cmd, resp)
+    return _decode_presets(resp, offset=len(cmd))
+
+
+def _decode_presets(payload, offset=0):
+    decoder = PresetStreamDecoder()
+    while not decoder.done:
+        nbytes = decoder.next_size()
+        decoder.feed(payload[offset:offset + nbytes])
+        offset += nbytes
+    return decoder.bank
+
+
+def _presets_write_command(presets, verify=False):
+    bank = presets if isinstance(presets, PresetBank) else PresetBank.from_presets(presets)
+    bank.refresh_checksums()
+    if verify:
+        _verify_preset_checksums(bank.image)
+
+    write_cmd = _command('WrtP')
+    write_cmd.extend(bank.image)
+    assert (len(write_cmd) == 7684)
+    swap_bytes(write_cmd, start=4)
+    with memoryview(write_cmd) as view:
+        calc_crc = crc16(view[4:], init=0x4d1)
+    return write_cmd, calc_crc, bank
+
+
+def _verify_presets_write(resp, calc_crc):
+    if len(resp) != 7686:
+        raise VerifyException('did not get expected response length: %d != %d' % (len(resp), 7686))
+    crc = (resp[7684] << 8) | resp[7685]
+    if crc != calc_crc:
+        raise CrcException('write presets failed: invalid CRC %s != %s' % (hex(crc), hex(calc_crc)))
+
+
+def _parse_options(cmd, resp, logger):
+    _verify_cmd_with_crc(cmd, resp, crc_index=260, crc_init=0x342, logger=logger)
+    return Options(resp[len(cmd):260])
+
+
+def _options_write_command(options):
+    write_cmd = _command('WrtC')
+    write_cmd.extend(options.raw_bytes()[128:192])
+
+    assert (len(write_cmd) == 68)
+    swap_bytes(write_cmd, start=4)
+    return write_cmd, crc16(write_cmd[4:], init=0xf5)
+
+
+def _verify_options_write(resp, calc_crc):
+    crc = (resp[68] << 8) | resp[69]
+    if crc != calc_crc:
+        raise CrcException('write options failed: invalid CRC %s != %s' % (hex(crc), hex(calc_crc)))
+
+
+class FlashCommitStats(object):
+    """
+    Observed time from the end of the WrtP write to the first byte of the charger's echo, i.e. how long the
+    charger took to commit the presets to flash, per firmware version.
+    """
+
+    def __init__(self):
+        self._by_firmware = {}
+
+    def record(self, firmware_version, latency):
+        stats = self._by_firmware.setdefault(firmware_version, [0, 0.0, None, None, None])
+        stats[0] += 1
+        stats[1] += latency
+        stats[2] = latency if stats[2] is None else min(stats[2], latency)
+        stats[3] = latency if stats[3] is None else max(stats[3], latency)
+        stats[4] = latency
+
+    def summary(self):
+        return {firmware: {'count': count, 'mean': total / count, 'min': low, 'max': high, 'last': last}
+                for firmware, (count, total, low, high, last) in self._by_firmware.items()}
+
+    def __str__(self):
+        return ', '.join('firmware %s: n=%d mean=%.3fs min=%.3fs max=%.3fs' %
+                         (firmware, vals['count'], vals['mean'], vals['min'], vals['max'])
+                         for firmware, vals in sorted(self.summary().items(), key=lambda item: str(item[0])))
+
+
+class PresetWriteGuard(object):
+    """
+    Remembers the preset image last known to be in the charger's flash so a write that would not change it can be
+    skipped. Also counts erases, writes and skipped writes as a record of flash wear on the charger.
+    """
+    # Assumed cost of a preset write until one has been timed: 7.7 kB each way at 19200 baud plus the commit
+    DEFAULT_WRITE_TIME = 8.5
+
+    def __init__(self):
+        self._flash = None
+        self._write_time = 0.0
+        self.erases = 0
+        self.writes = 0
+        self.avoided = 0
+        self.time_saved = 0.0
+
+    @property
+    def fingerprint(self):
+        return None if self._flash is None else zlib.crc32(self._flash)
+
+    @property
+    def mean_write_time(self):
+        return self._write_time / self.writes if self.writes else self.DEFAULT_WRITE_TIME
+
+    def matches(self, image):
+        return self._flash is not None and self._flash == image
+
+    def remember(self, image):
+        self._flash = bytes(image)
+
+    def forget(self):
+        self._flash = None
+
+    def record_erase(self):
+        self.erases += 1
+        self._flash = None
+
+    def record_write(self, image, duration):
+        self.writes += 1
+        self._write_time += duration
+        self.remember(image)
+
+    def record_avoided(self):
+        saved = self.mean_write_time
+        self.avoided += 1
+        self.time_saved += saved
+        return saved
+
+    def summary(self):
+        return {'erases': self.erases, 'writes': self.writes, 'avoided': self.avoided, 'time_saved': self.time_saved}
+
+    def __str__(self):
+        return 'erases=%d writes=%d avoided=%d time_saved=%.1fs' % (self.erases, self.writes, self.avoided,
+                                                                    self.time_saved)
+
+
 def retry(func, num, interval=.1):
     while True:
         try:
@@ -158,13 +499,21 @@ def retry(func, num, interval=.1):
 class Powerlab(object):
     READ_TIMEOUT = 1
     WRITE_TIMEOUT = 1
+    # Upper bound on how long the charger may take to commit presets to flash before it starts echoing
+    FLASH_COMMIT_TIMEOUT = 10
 
-    def __init__(self, port):
+    def __init__(self, port, event_driven_reader=False, cache=None):
         self._logger = logging.getLogger(__name__)
         self._port = port
+        self._event_driven_reader = event_driven_reader
+        self._cache = cache
         self._using_port = port
         self._ser = None
         self._serial_buffer = None
+        self._options = None
+        self._firmware_version = None
+        self._flash_commit_stats = FlashCommitStats()
+        self._write_guard = PresetWriteGuard()
 
     def __enter__(self):
         self.connect()
@@ -177,13 +526,17 @@ class Powerlab(object):
     def port(self):
         return self._using_port
 
+    @property
+    def flash_commit_stats(self):
+        return self._flash_commit_stats
+
+    @property
+    def write_guard(self):
+        return self._write_guard
+
     def connect(self, read_timeout=READ_TIMEOUT, write_timeout=WRITE_TIMEOUT):
         if not self._port:
-            self._using_port = None
-            for port in list_ports.comports():
-                if port.description == 'FT232R USB UART':
-                    self._using_port = port.device
-                    break
+            self._using_port = _find_port()
             if not self._using_port:
                 raise ConnectFailedException('no port found')
 
@@ -208,8 +561,9 @@ class Powerlab(object):
                     while retries:
                         try:
                             options = self.read_options()
+                            self._options = options
                             self._logger.info('connected to %s', self._using_port)
-                            self._serial_buffer = SerialBuffer(self._ser)
+                            self._serial_buffer = SerialBuffer(self._ser, event_driven=self._event_driven_reader)
                             return options
                         except Exception as ex:
                             retries -= 1
@@ -226,6 +580,8 @@ class Powerlab(object):
         if self._serial_buffer:
             self._serial_buffer.stop()
             self._serial_buffer = None
+        self._options = None
+        self._write_guard.forget()
         if self._ser:
             if self._ser.is_open:
                 ignore_exc(self._ser.reset_input_buffer)
@@ -256,16 +612,11 @@ class Powerlab(object):
 
     def command_set_active_preset(self, which, retries=0):
         self._logger.debug('command_set_active_preset %s', which)
-        if which < 0 or which > 24:
-            raise PowerlabException('invalid preset: %s' % which)
+        write_cmd, calc_crc = _set_preset_command(which)
         def impl():
-            write_cmd = _command('SelP' + chr(which))
-            calc_crc = crc16([which], init=0x1114)
             self._write(write_cmd)
             resp = self._read(nbytes=len(write_cmd) + 2)
-            crc = (resp[len(write_cmd)] << 8) | resp[len(write_cmd) + 1]
-            if crc != calc_crc:
-                raise CrcException('set preset %s failed: invalid CRC %s != %s' % (which, hex(crc), hex(calc_crc)))
+            _verify_set_preset(which, write_cmd, resp, calc_crc)
         return retry(impl, retries)
 
     def read_status(self, retries=0):
@@ -274,55 +625,106 @@ class Powerlab(object):
             cmd = _command('Ram\0')
             self._write(cmd)
             resp = self._read(nbytes=153)
-            self._verify_cmd_with_crc(cmd, resp, crc_index=151, crc_init=0x926)
-            return Status(resp[len(cmd):151])
+            status = _parse_status(cmd, resp, self._logger)
+            self._firmware_version = status.firmware_version
+            return status
         return retry(impl, retries)
 
-    def read_presets(self, retries=0):
+    def invalidate_preset_cache(self):
+        """
+        Drops the cached presets so the next read_presets() reads them from the charger.
+        """
+        if self._cache:
+            self._cache.invalidate(self._using_port)
+
+    def read_presets(self, retries=0, progress=None):
         self._logger.debug('reading presets')
+        bank = self._cached_presets()
+        if bank is not None:
+            self._write_guard.remember(bank.image)
+            return bank
         def impl():
-            cmd = _command('Prst')
-            self._write(cmd)
-            resp = self._read(nbytes=7686, timeout=7)
-            _verify_cmd(cmd, resp)
-            self._verify_crc(resp[4:], crc_index=7680, crc_init=0x18e4)
-            _verify_preset_checksums(resp[4:])
-            presets = []
-            for preset_num in range(0, 75):
-                offset = _prestart_offset(preset_num)
-                presets.append(Preset(resp[4 + offset:4 + offset + 102], preset_num))
-            return presets
+            decoder = PresetStreamDecoder()
+            for _ in self._iter_presets(decoder, progress):
+                pass
+            if self._cache and self._options is not None and self._firmware_version is not None:
+                payload = bytes(decoder.image) + bytes([decoder.crc >> 8, decoder.crc & 0xff])
+                self._cache.store(self._using_port, self._firmware_version, self._options.raw_bytes(), payload)
+            self._write_guard.remember(decoder.image)
+            return decoder.bank
         return retry(impl, retries)
 
-    def write_presets(self, presets, retries=0):
+    def iter_presets(self, progress=None):
+        """
+        Yields the presets 5 at a time as each block arrives and passes its checksum. A bad or missing block
+        raises immediately. progress(received, expected) is called after each block.
+        """
+        return self._iter_presets(PresetStreamDecoder(), progress)
+
+    def _iter_presets(self, decoder, progress):
+        cmd = _command('Prst')
+        self._write(cmd)
+        deadline = time() + 7
+        try:
+            _verify_cmd(cmd, self._read_until(len(cmd), deadline))
+            while not decoder.done:
+                for preset in decoder.feed(self._read_until(decoder.next_size(), deadline)):
+                    yield preset
+                if progress:
+                    progress(decoder.received, decoder.expected)
+        except VerifyException:
+            # Let the charger finish sending before anything else goes on the wire
+            if self._serial_buffer:
+                self._serial_buffer.wait_quiet(quiet=.1, timeout=max(0, deadline - time()))
+            raise
+
+    def _cached_presets(self):
+        if not self._cache or self._options is None:
+            return None
+        try:
+            status = self.read_status()
+        except Exception as ex:
+            self._logger.debug('preset cache skipped, no status: %s', ex)
+            return None
+        if status.preset_flash_changed or status.options_flash_changed:
+            self._logger.info('charger reports its flash changed, re-reading presets')
+            self._cache.invalidate(self._using_port)
+            return None
+
+        payload = self._cache.load(self._using_port, status.firmware_version, self._options.raw_bytes())
+        if payload is None:
+            return None
+        try:
+            bank = _decode_presets(payload)
+        except VerifyException as ex:
+            self._logger.warning('discarding corrupt preset cache for %s: %s', self._using_port, ex)
+            self._cache.invalidate(self._using_port)
+            return None
+        self._logger.info('loaded presets for %s from cache', self._using_port)
+        return bank
+
+    def write_presets(self, presets, retries=0, force=False):
+        """
+        Writes the presets to flash unless the charger already holds exactly these presets. force writes anyway,
+        e.g. to exercise the flash write path.
+        """
         self._logger.debug('writing presets')
+        write_cmd, calc_crc, bank = _presets_write_command(presets, verify=self._logger.isEnabledFor(logging.DEBUG))
+        if not force and self._write_guard.matches(bank.image) and not self._preset_flash_changed():
+            saved = self._write_guard.record_avoided()
+            bank.mark_clean()
+            self._logger.info('presets already in flash (%08x), skipped write saving ~%.1fs (%s)',
+                              bank.fingerprint(), saved, self._write_guard)
+            return
+
+        if self._cache:
+            # Flash is erased before it is written, so the cached image is stale even if the write fails
+            self._cache.invalidate(self._using_port)
         def impl():
-            write_cmd = _command('WrtP')
-            ii = 1
-            for preset in presets:
-                preset.is_validated = not preset.is_empty
-                write_cmd.extend(preset.raw_bytes())
-
-                # every 510 bytes, compute and add checksum
-                if (ii % 5) == 0:
-                    block_num = ii // 5 - 1
-                    start = 4 + block_num * 512
-                    end = start + 510
-                    assert (len(write_cmd) == end)
-                    cksum = checksum(write_cmd[start:end], init=0xc8)
-                    write_cmd.append(cksum >> 8)
-                    write_cmd.append(cksum & 0xff)
-                ii += 1
-
-            if self._logger.isEnabledFor(logging.DEBUG):
-                _verify_preset_checksums(write_cmd[4:])
-
-            assert (len(write_cmd) == 7684)
-            swap_bytes(write_cmd, start=4)
-            calc_crc = crc16(write_cmd[4:], init=0x4d1)
-
+            started = time()
             self._logger.debug('erase presets')
             cmd = _command('ErsP')
+            self._write_guard.record_erase()
             self._write(cmd)
             resp = self._read(nbytes=6)
             _verify_cmd_with_values(cmd, resp, bytes([0x22, 0x1b]))
@@ -330,35 +732,45 @@ class Powerlab(object):
             sleep(.05)
             self._logger.debug('write presets')
             self._write(write_cmd, timeout=7)
-            sleep(5.25)
+            written = time()
+            # The charger echoes once the presets are in flash; start reading as soon as the echo begins
+            if not self._serial_buffer.wait_for(1, timeout=self.FLASH_COMMIT_TIMEOUT):
+                raise VerifyException('no response to write presets after %ds' % self.FLASH_COMMIT_TIMEOUT)
+            latency = time() - written
+            self._flash_commit_stats.record(self._firmware_version, latency)
+            self._logger.info('presets flash commit took %.3fs (firmware %s)', latency, self._firmware_version)
             resp = self._read(nbytes=7686, timeout=7)
-            if len(resp) != 7686:
-                raise VerifyException('did not get expected response length: %d != %d' % (len(resp), 7686))
-            crc = (resp[7684] << 8) | resp[7685]
-            if crc != calc_crc:
-                raise CrcException('write presets failed: invalid CRC %s != %s' % (hex(crc), hex(calc_crc)))
+            _verify_presets_write(resp, calc_crc)
+            bank.mark_clean()
+            self._write_guard.record_write(bank.image, time() - started)
             self._logger.debug('presets write success')
+            self._logger.debug('flash commit latency: %s', self._flash_commit_stats)
         return retry(impl, retries)
 
+    def _preset_flash_changed(self):
+        # Presets edited on the charger itself would make the remembered image wrong
+        try:
+            return self.read_status().preset_flash_changed
+        except Exception as ex:
+            self._logger.debug('could not read status: %s', ex)
+            return True
+
     def read_options(self, retries=0):
         self._logger.debug('loading options')
         def impl():
             cmd = _command('PrsI')
             self._write(cmd)
             resp = self._read(nbytes=262)
-            self._verify_cmd_with_crc(cmd, resp, crc_index=260, crc_init=0x342)
-            return Options(resp[len(cmd):260])
+            self._options = _parse_options(cmd, resp, self._logger)
+            return self._options
         return retry(impl, retries)
 
     def write_options(self, options, retries=0):
         self._logger.debug('writing options')
+        if self._cache:
+            self._cache.invalidate(self._using_port)
         def impl():
-            write_cmd = _command('WrtC')
-            write_cmd.extend(options.raw_bytes()[128:192])
-
-            assert (len(write_cmd) == 68)
-            swap_bytes(write_cmd, start=4)
-            calc_crc = crc16(write_cmd[4:], init=0xf5)
+            write_cmd, calc_crc = _options_write_command(options)
 
             self._logger.debug('erase options')
             cmd = _command('ErsC')
@@ -369,9 +781,7 @@ class Powerlab(object):
             self._logger.debug('write options')
             self._write(write_cmd)
             resp = self._read(nbytes=70)
-            crc = (resp[68] << 8) | resp[69]
-            if crc != calc_crc:
-                raise CrcException('write options failed: invalid CRC %s != %s' % (hex(crc), hex(calc_crc)))
+            _verify_options_write(resp, calc_crc)
             self._logger.debug('options write success')
         return retry(impl, retries)
 
@@ -395,6 +805,9 @@ class Powerlab(object):
                 print_bytes(self._logger, logging.DEBUG, resp, 'r')
         return resp or []
 
+    def _read_until(self, nbytes, deadline):
+        return self._read(nbytes=nbytes, timeout=max(0, min(self.READ_TIMEOUT, deadline - time())))
+
     def _write(self, data, timeout=WRITE_TIMEOUT):
         self._ser.reset_output_buffer()
         self._ser.reset_input_buffer()
@@ -406,19 +819,7 @@ class Powerlab(object):
             print_bytes(self._logger, logging.DEBUG, data, 'w')
 
     def _send_cmd(self, num_parallel, command_char):
-        cmd = _command('Se' + _num_parallel_to_char(num_parallel) + command_char)
+        cmd = _control_command(num_parallel, command_char)
         self._write(cmd)
         resp = self._read(nbytes=6)
-        _verify_cmd_with_values(cmd, resp, bytes([0x5, 0xdc]))
-
-    def _verify_crc(self, buf, crc_index, crc_init):
-        crc = (buf[crc_index] << 8) | buf[crc_index + 1]
-        calc_crc = crc16(buf[:crc_index], crc_init)
-        if debug.LOG_SERIAL:
-            self._logger.debug('crc: %s calc_crc: %s', hex(crc), hex(calc_crc))
-        if crc != calc_crc:
-            raise CrcException('bad CRC')
-
-    def _verify_cmd_with_crc(self, cmd, buf, crc_index, crc_init):
-        _verify_cmd(cmd, buf)
-        self._verify_crc(buf[len(cmd):], crc_index - len(cmd), crc_init)
+        _verify_control_command(cmd, resp)
@@ -13,7 +13,134 @@
 #      You should have received a copy of the GNU General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from bumpemu.util import byte_to_char, bits_from_int16, str_from_props, int16_to_bits, checksum
+import zlib
+
+from bumpemu.util import str_from_props, checksum
+from bumpemu.charger.fields import uint16, array, bits, flag, text
+
+
+def _charge_mamps_from_raw(val):
+    if val < 200:
+        return val * 5
+    else:
+        return 1000 + ((val - 200) * 50)
+
+
+def _charge_mamps_to_raw(value):
+    set_val = min(value, 40000)
+    if set_val < 1000:
+        set_val = int((set_val + 2.5) // 5) * 5
+        set_val //= 5
+    elif set_val >= 1000:
+        set_val = ((set_val + 25) // 50) * 50
+        set_val = ((set_val - 1000) // 50) + 200
+    else:
+        raise Exception('invalid value: %s' % value)
+    return set_val
+
+
+def _discharge_mamps_from_raw(val):
+    if val <= 100:
+        return val * 10
+    else:
+        return 1000 + (val - 100) * 250
+
+
+def _discharge_mamps_to_raw(value):
+    if value <= 1000:
+        value = ((value + 5) // 10) * 10
+        value //= 10
+    elif value > 1000:
+        value = ((value + 125) // 250) * 250
+        value = ((value - 1000) // 250) + 100
+    else:
+        raise Exception('invalid value: %s' % value)
+    return value
+
+
+def _max_charge_amps_from_raw(val):
+    if val == 0:
+        return 0.25
+    elif val == 1:
+        return 0.5
+    else:
+        return val - 1
+
+
+def _max_charge_amps_to_raw(val):
+    if val < 1:
+        val *= 100
+        val = int(round(((val + 12.5) // 25) * 25))
+        if val <= 25:
+            val = 0
+        elif val <= 50:
+            val = 1
+        else:
+            val = 2
+    else:
+        val = min(int(round(val) + 1), 41)
+    return val
+
+
+def _num_cycles_from_raw(val):
+    if val == 4:
+        val = 5
+    elif val == 5:
+        val = 10
+    elif val == 6:
+        val = 20
+    elif val == 7:
+        val = 2 ** 32
+    elif val > 7:
+        raise Exception("unknown num cycles")
+    return val
+
+
+def _num_cycles_to_raw(val):
+    if val not in (0, 1, 2, 3):
+        if val == 5:
+            val = 4
+        elif val == 10:
+            val = 5
+        elif val == 20:
+            val = 6
+        elif val == 2 ** 32:
+            val = 7
+        else:
+            raise Exception("unknown num cycles")
+    return val
+
+
+def _trickle_mamps_from_raw(val):
+    if val == 125:
+        val = 1000
+    elif val == 126:
+        val = 2000
+    elif val == 127:
+        val = 3000
+    else:
+        val *= 5
+    return val
+
+
+def _trickle_mamps_to_raw(val):
+    if val == 1000:
+        val = 125
+    elif val == 2000:
+        val = 126
+    elif val == 3000:
+        val = 127
+    elif val <= 620:
+        val //= 5
+    else:
+        raise Exception('invalid value: %s' % val)
+    return val
+
+
+def _num_parallel_to_raw(value):
+    if value <= 0:
+        raise Exception('value must be >= 1')
+    return value - 1
 
 
 class Preset(object):
@@ -22,7 +149,8 @@ class Preset(object):
                  'NiZn', 'LiHV']
 
     def __init__(self, data, preset_num):
-        self._data = bytearray(data)
+        # A memoryview is used as is, so the preset edits the buffer it points into (see PresetBank)
+        self._data = data if isinstance(data, memoryview) else bytearray(data)
         self._preset_num = preset_num
 
     def raw_bytes(self):
@@ -34,178 +162,51 @@ class Preset(object):
     def preset_num(self):
         return self._preset_num
 
-    @property
-    def is_require_balance_done_enabled(self):
-        return bool(bits_from_int16(self._data, index=0, start_bit=0, end_bit=0))
-
-    @is_require_balance_done_enabled.setter
-    def is_require_balance_done_enabled(self, value):
-        int16_to_bits(self._data, index=0, start_bit=0, end_bit=0, value=1 if value else 0)
-
-    @property
-    def is_require_all_charge_volts_enabled(self):
-        return bool(bits_from_int16(self._data, index=0, start_bit=11, end_bit=11))
-
-    @is_require_all_charge_volts_enabled.setter
-    def is_require_all_charge_volts_enabled(self, value):
-        int16_to_bits(self._data, index=0, start_bit=11, end_bit=11, value=1 if value else 0)
-
-    @property
-    def name(self):
-        chars = []
-        for ii in range(4, 32, 2):
-            chars.append(byte_to_char(self._data[ii + 1]))
-            chars.append(byte_to_char(self._data[ii]))
-        return ''.join(chars)
-
-    @name.setter
-    def name(self, value):
-        if len(value) > 28:
-            raise Exception('name too long')
-        if len(value) < 28:
-            spaces = [' '] * (28 - len(value))
-            value += ''.join(spaces)
-        assert (len(value) == 28)
-        for ii in range(4, 32, 2):
-            self._data[ii + 1] = ord(value[ii - 4])
-            self._data[ii] = ord(value[ii - 3])
-
-    @property
-    def charge_mamps(self):
-        val = bits_from_int16(self._data, index=32, start_bit=4, end_bit=14)
-        if val < 200:
-            return val * 5
-        else:
-            return 1000 + ((val - 200) * 50)
-
-    @charge_mamps.setter
-    def charge_mamps(self, value):
-        set_val = min(value, 40000)
-        if set_val < 1000:
-            set_val = int((set_val + 2.5) // 5) * 5
-            set_val //= 5
-        elif set_val >= 1000:
-            set_val = ((set_val + 25) // 50) * 50
-            set_val = ((set_val - 1000) // 50) + 200
-        else:
-            raise Exception('invalid value: %s' % value)
-        int16_to_bits(self._data, index=32, start_bit=4, end_bit=14, value=set_val)
-
-    @property
-    def charge_volts(self):
-        return bits_from_int16(self._data, index=34, start_bit=0, end_bit=9) / 200.0
-
-    @charge_volts.setter
-    def charge_volts(self, value):
-        int16_to_bits(self._data, index=34, start_bit=0, end_bit=9, value=int(round(value * 200)))
-
-    @property
-    def discharge_mode(self):
-        return bits_from_int16(self._data, index=84, start_bit=9, end_bit=11)
-
-    @discharge_mode.setter
-    def discharge_mode(self, val):
-        int16_to_bits(self._data, index=84, start_bit=9, end_bit=11, value=val)
-
-    @property
-    def discharge_mamps(self):
-        val = bits_from_int16(self._data, index=48, start_bit=0, end_bit=8)
-        if val <= 100:
-            return val * 10
-        else:
-            return 1000 + (val - 100) * 250
-
-    @discharge_mamps.setter
-    def discharge_mamps(self, value):
-        if value <= 1000:
-            value = ((value + 5) // 10) * 10
-            value //= 10
-        elif value > 1000:
-            value = ((value + 125) // 250) * 250
-            value = ((value - 1000) // 250) + 100
-        else:
-            raise Exception('invalid value: %s' % value)
-        int16_to_bits(self._data, index=48, start_bit=0, end_bit=8, value=value)
-
-    @property
-    def discharge_volts(self):
-        return bits_from_int16(self._data, index=98, start_bit=6, end_bit=14) / 100.0
-
-    @discharge_volts.setter
-    def discharge_volts(self, value):
-        int16_to_bits(self._data, index=98, start_bit=6, end_bit=14, value=int(round(value * 100)))
-
-    @property
-    def is_store_charge_discharge(self):
-        return bool(bits_from_int16(self._data, index=46, start_bit=12, end_bit=12))
-
-    @is_store_charge_discharge.setter
-    def is_store_charge_discharge(self, value):
-        int16_to_bits(self._data, index=46, start_bit=12, end_bit=12, value=1 if value else 0)
-
-    @property
-    def is_end_cycling_with_discharge_enabled(self):
-        return bool(bits_from_int16(self._data, index=46, start_bit=14, end_bit=14))
-
-    @is_end_cycling_with_discharge_enabled.setter
-    def is_end_cycling_with_discharge_enabled(self, value):
-        int16_to_bits(self._data, index=46, start_bit=14, end_bit=14, value=1 if value else 0)
-
-    @property
-    def cool_down_time(self):
-        return bits_from_int16(self._data, index=48, start_bit=10, end_bit=13)
-
-    @cool_down_time.setter
-    def cool_down_time(self, val):
-        int16_to_bits(self._data, index=48, start_bit=10, end_bit=13, value=val)
-
-    @property
-    def cv_termination(self):
-        return bits_from_int16(self._data, index=48, start_bit=14, end_bit=15)
-
-    @cv_termination.setter
-    def cv_termination(self, val):
-        int16_to_bits(self._data, index=48, start_bit=14, end_bit=15, value=val)
-
-    @property
-    def is_balance_entire_charge_enabled(self):
-        return bool(bits_from_int16(self._data, index=54, start_bit=15, end_bit=15))
-
-    @is_balance_entire_charge_enabled.setter
-    def is_balance_entire_charge_enabled(self, value):
-        int16_to_bits(self._data, index=54, start_bit=15, end_bit=15, value=1 if value else 0)
-
-    @property
-    def beep_at_percent(self):
-        return bits_from_int16(self._data, index=58, start_bit=11, end_bit=15) * 2 + 38
-
-    @beep_at_percent.setter
-    def beep_at_percent(self, val):
-        int16_to_bits(self._data, index=58, start_bit=11, end_bit=15, value=(val - 38) // 2)
-
-    @property
-    def is_trickle_only(self):
-        return bool(bits_from_int16(self._data, index=0, start_bit=5, end_bit=5))
-
-    @is_trickle_only.setter
-    def is_trickle_only(self, value):
-        int16_to_bits(self._data, index=0, start_bit=5, end_bit=5, value=1 if value else 0)
-
-    @property
-    def is_balance_discharge_enabled(self):
-        return bool(bits_from_int16(self._data, index=96, start_bit=8, end_bit=8))
-
-    @is_balance_discharge_enabled.setter
-    def is_balance_discharge_enabled(self, value):
-        int16_to_bits(self._data, index=96, start_bit=8, end_bit=8, value=1 if value else 0)
-
-    @property
-    def chemistry_idx(self):
-        return bits_from_int16(self._data, index=58, start_bit=6, end_bit=10)
-
-    @chemistry_idx.setter
-    def chemistry_idx(self, val):
-        int16_to_bits(self._data, index=58, start_bit=6, end_bit=10, value=val)
+    is_require_balance_done_enabled = flag(0, 0, writable=True)
+    is_trickle_only = flag(0, 5, writable=True)
+    is_use_fuel_enabled = flag(0, 10, writable=True)
+    is_require_all_charge_volts_enabled = flag(0, 11, writable=True)
+    auto_charge_rate = bits(0, 12, 15, writable=True)
+    max_auto_charge_rate = bits(2, 10, 13, writable=True)
+    name = text(4, 28, writable=True)
+    # 0: off
+    # 1: constant current then constant voltage
+    # 2: constant current
+    power_mode = bits(32, 0, 3, writable=True)
+    charge_mamps = bits(32, 4, 14, writable=True, convert=_charge_mamps_from_raw, invert=_charge_mamps_to_raw)
+    is_visible = flag(32, 15, writable=True)
+    charge_volts = bits(34, 0, 9, writable=True, divisor=200.0)
+    max_charge_amps = bits(34, 10, 15, writable=True, convert=_max_charge_amps_from_raw,
+                           invert=_max_charge_amps_to_raw)
+    is_validated = flag(36, 14, end_bit=15, writable=True)
+    is_store_charge_discharge = flag(46, 12, writable=True)
+    is_end_cycling_with_discharge_enabled = flag(46, 14, writable=True)
+    discharge_mamps = bits(48, 0, 8, writable=True, convert=_discharge_mamps_from_raw,
+                           invert=_discharge_mamps_to_raw)
+    cool_down_time = bits(48, 10, 13, writable=True)
+    cv_termination = bits(48, 14, 15, writable=True)
+    num_parallel = bits(52, 8, 10, writable=True, convert=lambda val: val + 1, invert=_num_parallel_to_raw)
+    charge_timeout = bits(52, 13, 15, writable=True)
+    discharge_timeout = bits(54, 4, 6, writable=True)
+    is_balance_entire_charge_enabled = flag(54, 15, writable=True)
+    trickle_current_mamps = bits(56, 9, 15, writable=True, convert=_trickle_mamps_from_raw,
+                                 invert=_trickle_mamps_to_raw)
+    chemistry_idx = bits(58, 6, 10, writable=True)
+    beep_at_percent = bits(58, 11, 15, writable=True, convert=lambda val: val * 2 + 38,
+                           invert=lambda val: (val - 38) // 2)
+    # Set as raw words, read back scaled
+    fuel_curve = array(60, 11, writable=True, convert=lambda vals: [val * 0.001111111 for val in vals])
+    balance_mode = bits(82, 10, 13)
+    discharge_mode = bits(84, 9, 11, writable=True)
+    is_requires_nodes_enabled = flag(86, 13, writable=True)
+    require_nodes = flag(86, 13)
+    num_cycles = bits(88, 10, 12, writable=True, convert=_num_cycles_from_raw, invert=_num_cycles_to_raw)
+    cv_timeout = bits(92, 5, 7, writable=True)
+    is_hide_empty_enabled = flag(94, 15, writable=True)
+    is_balance_discharge_enabled = flag(96, 8, writable=True)
+    discharge_volts = bits(98, 6, 14, writable=True, divisor=100.0)
+    is_locked = flag(98, 15, writable=True)
+    checksum = uint16(100, writable=True)
 
     @property
     def chemistry(self):
@@ -228,228 +229,6 @@ class Preset(object):
             raise Exception('invalid chemistry: %s' % val)
         self.chemistry_idx = idx
 
-    # 0: off
-    # 1: constant current then constant voltage
-    # 2: constant current
-    @property
-    def power_mode(self):
-        return bits_from_int16(self._data, index=32, start_bit=0, end_bit=3)
-
-    @power_mode.setter
-    def power_mode(self, val):
-        int16_to_bits(self._data, index=32, start_bit=0, end_bit=3, value=val)
-
-    @property
-    def is_requires_nodes_enabled(self):
-        return bool(bits_from_int16(self._data, index=86, start_bit=13, end_bit=13))
-
-    @is_requires_nodes_enabled.setter
-    def is_requires_nodes_enabled(self, value):
-        int16_to_bits(self._data, index=86, start_bit=13, end_bit=13, value=1 if value else 0)
-
-    @property
-    def auto_charge_rate(self):
-        return bits_from_int16(self._data, index=0, start_bit=12, end_bit=15)
-
-    @auto_charge_rate.setter
-    def auto_charge_rate(self, val):
-        int16_to_bits(self._data, index=0, start_bit=12, end_bit=15, value=val)
-
-    @property
-    def max_auto_charge_rate(self):
-        return bits_from_int16(self._data, index=2, start_bit=10, end_bit=13)
-
-    @max_auto_charge_rate.setter
-    def max_auto_charge_rate(self, val):
-        int16_to_bits(self._data, index=2, start_bit=10, end_bit=13, value=val)
-
-    @property
-    def is_use_fuel_enabled(self):
-        return bool(bits_from_int16(self._data, index=0, start_bit=10, end_bit=10))
-
-    @is_use_fuel_enabled.setter
-    def is_use_fuel_enabled(self, value):
-        int16_to_bits(self._data, index=0, start_bit=10, end_bit=10, value=1 if value else 0)
-
-    @property
-    def num_cycles(self):
-        val = bits_from_int16(self._data, index=88, start_bit=10, end_bit=12)
-        if val == 4:
-            val = 5
-        elif val == 5:
-            val = 10
-        elif val == 6:
-            val = 20
-        elif val == 7:
-            val = 2 ** 32
-        elif val > 7:
-            raise Exception("unknown num cycles")
-        return val
-
-    @num_cycles.setter
-    def num_cycles(self, val):
-        if val not in (0, 1, 2, 3):
-            if val == 5:
-                val = 4
-            elif val == 10:
-                val = 5
-            elif val == 20:
-                val = 6
-            elif val == 2 ** 32:
-                val = 7
-            else:
-                raise Exception("unknown num cycles")
-        int16_to_bits(self._data, index=88, start_bit=10, end_bit=12, value=val)
-
-    @property
-    def trickle_current_mamps(self):
-        val = bits_from_int16(self._data, index=56, start_bit=9, end_bit=15)
-        if val == 125:
-            val = 1000
-        elif val == 126:
-            val = 2000
-        elif val == 127:
-            val = 3000
-        else:
-            val *= 5
-        return val
-
-    @trickle_current_mamps.setter
-    def trickle_current_mamps(self, val):
-        if val == 1000:
-            val = 125
-        elif val == 2000:
-            val = 126
-        elif val == 3000:
-            val = 127
-        elif val <= 620:
-            val //= 5
-        else:
-            raise Exception('invalid value: %s' % val)
-        int16_to_bits(self._data, index=56, start_bit=9, end_bit=15, value=val)
-
-    @property
-    def is_visible(self):
-        return bool(bits_from_int16(self._data, index=32, start_bit=15, end_bit=15))
-
-    @is_visible.setter
-    def is_visible(self, value):
-        int16_to_bits(self._data, index=32, start_bit=15, end_bit=15, value=1 if value else 0)
-
-    @property
-    def is_hide_empty_enabled(self):
-        return bool(bits_from_int16(self._data, index=94, start_bit=15, end_bit=15))
-
-    @is_hide_empty_enabled.setter
-    def is_hide_empty_enabled(self, value):
-        int16_to_bits(self._data, index=94, start_bit=15, end_bit=15, value=1 if value else 0)
-
-    @property
-    def is_locked(self):
-        return bool(bits_from_int16(self._data, index=98, start_bit=15, end_bit=15))
-
-    @is_locked.setter
-    def is_locked(self, value):
-        int16_to_bits(self._data, index=98, start_bit=15, end_bit=15, value=1 if value else 0)
-
-    @property
-    def num_parallel(self):
-        return bits_from_int16(self._data, index=52, start_bit=8, end_bit=10) + 1
-
-    @num_parallel.setter
-    def num_parallel(self, value):
-        if value <= 0:
-            raise Exception('value must be >= 1')
-        int16_to_bits(self._data, index=52, start_bit=8, end_bit=10, value=value - 1)
-
-    @property
-    def cv_timeout(self):
-        return bits_from_int16(self._data, index=92, start_bit=5, end_bit=7)
-
-    @cv_timeout.setter
-    def cv_timeout(self, val):
-        int16_to_bits(self._data, index=92, start_bit=5, end_bit=7, value=val)
-
-    @property
-    def charge_timeout(self):
-        return bits_from_int16(self._data, index=52, start_bit=13, end_bit=15)
-
-    @charge_timeout.setter
-    def charge_timeout(self, val):
-        int16_to_bits(self._data, index=52, start_bit=13, end_bit=15, value=val)
-
-    @property
-    def discharge_timeout(self):
-        return bits_from_int16(self._data, index=54, start_bit=4, end_bit=6)
-
-    @discharge_timeout.setter
-    def discharge_timeout(self, val):
-        int16_to_bits(self._data, index=54, start_bit=4, end_bit=6, value=val)
-
-    @property
-    def checksum(self):
-        return (self._data[100] << 8) | self._data[101]
-
-    @checksum.setter
-    def checksum(self, value):
-        self._data[100] = (value >> 8) & 0xff
-        self._data[101] = value & 0xff
-
-    @property
-    def is_validated(self):
-        return bool(bits_from_int16(self._data, index=36, start_bit=14, end_bit=15))
-
-    @is_validated.setter
-    def is_validated(self, value):
-        int16_to_bits(self._data, index=36, start_bit=14, end_bit=15, value=1 if value else 0)
-
-    @property
-    def balance_mode(self):
-        return bits_from_int16(self._data, index=82, start_bit=10, end_bit=13)
-
-    @property
-    def require_nodes(self):
-        return bool(bits_from_int16(self._data, index=86, start_bit=13, end_bit=13))
-
-    @property
-    def fuel_curve(self):
-        return [((self._data[ii] << 8) | self._data[ii + 1]) * 0.001111111 for ii in range(60, 82, 2)]
-
-    @fuel_curve.setter
-    def fuel_curve(self, val):
-        ii = 60
-        for vv in val:
-            self._data[ii] = (vv >> 8) & 0xff
-            self._data[ii + 1] = vv & 0xff
-            ii += 2
-            if ii == 82:
-                break
-
-    @property
-    def max_charge_amps(self):
-        val = bits_from_int16(self._data, index=34, start_bit=10, end_bit=15)
-        if val == 0:
-            return 0.25
-        elif val == 1:
-            return 0.5
-        else:
-            return val - 1
-
-    @max_charge_amps.setter
-    def max_charge_amps(self, val):
-        if val < 1:
-            val *= 100
-            val = int(round(((val + 12.5) // 25) * 25))
-            if val <= 25:
-                val = 0
-            elif val <= 50:
-                val = 1
-            else:
-                val = 2
-        else:
-            val = min(int(round(val) + 1), 41)
-        int16_to_bits(self._data, index=34, start_bit=10, end_bit=15, value=val)
-
     @property
     def is_empty(self):
         return (sum(self._data[:-2]) - self._data[94]) == 0
@@ -459,3 +238,100 @@ class Preset(object):
 
     def __str__(self):
         return str_from_props(self)
+
+
+class PresetBank(object):
+    """
+    All of the charger's presets in wire layout: 15 blocks of 5 presets, each block followed by its checksum. The
+    presets are views into that one buffer, so editing a preset edits the image that gets written back. A copy
+    of what is in flash is kept so only the blocks that actually changed get their checksums recomputed.
+    """
+    PRESET_SIZE = 102
+    PRESETS_PER_BLOCK = 5
+    NUM_BLOCKS = 15
+    NUM_PRESETS = PRESETS_PER_BLOCK * NUM_BLOCKS
+    BLOCK_DATA_SIZE = PRESET_SIZE * PRESETS_PER_BLOCK
+    BLOCK_SIZE = BLOCK_DATA_SIZE + 2
+    IMAGE_SIZE = BLOCK_SIZE * NUM_BLOCKS
+    BLOCK_CHECKSUM_INIT = 0xc8
+
+    def __init__(self, image=None):
+        if image is None:
+            self._image = bytearray(self.IMAGE_SIZE)
+        elif len(image) != self.IMAGE_SIZE:
+            raise ValueError('preset image must be %d bytes, not %d' % (self.IMAGE_SIZE, len(image)))
+        else:
+            self._image = bytearray(image)
+        self._view = memoryview(self._image)
+        self._flash = None
+        self._presets = [Preset(self._view[self.offset(num):self.offset(num) + self.PRESET_SIZE], num)
+                         for num in range(self.NUM_PRESETS)]
+
+    @classmethod
+    def from_presets(cls, presets):
+        bank = cls()
+        num = 0
+        for num, preset in enumerate(presets, 1):
+            if num > cls.NUM_PRESETS:
+                break
+            start = cls.offset(num - 1)
+            bank._image[start:start + cls.PRESET_SIZE] = preset.raw_bytes()
+        if num != cls.NUM_PRESETS:
+            raise ValueError('expected %d presets' % cls.NUM_PRESETS)
+        return bank
+
+    @staticmethod
+    def offset(preset_num):
+        # every 510 bytes is checksummed
+        return preset_num * 102 + (preset_num // 5) * 2
+
+    @property
+    def image(self):
+        return self._image
+
+    @property
+    def is_dirty(self):
+        return self._flash is None or self._image != self._flash
+
+    def __len__(self):
+        return self.NUM_PRESETS
+
+    def __iter__(self):
+        return iter(self._presets)
+
+    def __getitem__(self, index):
+        return self._presets[index]
+
+    def fingerprint(self):
+        return zlib.crc32(self._image)
+
+    def dirty_blocks(self):
+        if self._flash is None:
+            return list(range(self.NUM_BLOCKS))
+        flash = memoryview(self._flash)
+        return [block for block in range(self.NUM_BLOCKS)
+                if self._view[block * self.BLOCK_SIZE:(block + 1) * self.BLOCK_SIZE] !=
+                flash[block * self.BLOCK_SIZE:(block + 1) * self.BLOCK_SIZE]]
+
+    def refresh_checksums(self):
+        """
+        Brings the preset and block checksums of every changed block up to date and returns those block numbers.
+        """
+        blocks = self.dirty_blocks()
+        for block in blocks:
+            first = block * self.PRESETS_PER_BLOCK
+            for preset in self._presets[first:first + self.PRESETS_PER_BLOCK]:
+                preset.is_validated = not preset.is_empty
+                preset.checksum = preset.calc_checksum()
+            start = block * self.BLOCK_SIZE
+            end = start + self.BLOCK_DATA_SIZE
+            cksum = checksum(self._view[start:end], init=self.BLOCK_CHECKSUM_INIT)
+            self._image[end] = cksum >> 8
+            self._image[end + 1] = cksum & 0xff
+        return blocks
+
+    def mark_clean(self):
+        """
+        Records the current image as what is in the charger's flash.
+        """
+        self._flash = bytes(self._image)
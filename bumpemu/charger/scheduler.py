@@ -0,0 +1,262 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import logging
+from concurrent.futures import Future
+from enum import Enum
+from itertools import count
+from threading import Thread, Condition, current_thread
+from time import time
+
+from bumpemu.charger.powerlab import PowerlabException
+
+
+class Priority(Enum):
+    SAFETY = 0
+    CONTROL = 1
+    STATUS = 2
+    BULK = 3
+
+
+class DeadlineExceededException(PowerlabException):
+    pass
+
+
+class _PriorityStats(object):
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def avg_wait(self):
+        started = self.completed + self.failed
+        return self.total_wait / started if started else 0.0
+
+    def as_dict(self):
+        values = dict(vars(self))
+        values['avg_wait'] = self.avg_wait
+        return values
+
+    def __str__(self):
+        return ('submitted=%d completed=%d failed=%d expired=%d depth=%d max_depth=%d avg_wait=%.3fs '
+                'max_wait=%.3fs' % (self.submitted, self.completed, self.failed, self.expired, self.depth,
+                                    self.max_depth, self.avg_wait, self.max_wait))
+
+
+class CommandScheduler(object):
+    """
+    Owns the serial link to one charger. Requests are run one at a time on a single thread, highest priority
+    first and in submission order within a priority. A request that is still queued when its deadline passes is
+    dropped with DeadlineExceededException instead of being sent to the charger.
+    """
+
+    def __init__(self, name='powerlab'):
+        self._logger = logging.getLogger(__name__)
+        self._queue = []
+        self._seq = count()
+        self._cv = Condition()
+        self._stopped = False
+        self._stats = {priority: _PriorityStats() for priority in Priority}
+        self._thread = Thread(target=self._run, name='%s-scheduler' % name, daemon=True)
+        self._thread.start()
+
+    def submit(self, priority, func, deadline=None):
+        future = Future()
+        if current_thread() is self._thread:
+            # Already on the link; queueing behind ourselves would deadlock
+            self._execute(future, func)
+            return future
+        with self._cv:
+            if self._stopped:
+                raise PowerlabException('scheduler stopped')
+            stats = self._stats[priority]
+            stats.submitted += 1
+            stats.depth += 1
+            stats.max_depth = max(stats.max_depth, stats.depth)
+            heapq.heappush(self._queue, (priority.value, next(self._seq), priority, func, deadline, time(), future))
+            self._cv.notify()
+        return future
+
+    def call(self, priority, func, deadline=None):
+        return self.submit(priority, func, deadline).result()
+
+    def queue_depth(self):
+        with self._cv:
+            return len(self._queue)
+
+    def stats(self):
+        with self._cv:
+            return {priority: stats.as_dict() for priority, stats in self._stats.items()}
+
+    def log_stats(self, level=logging.INFO):
+        with self._cv:
+            lines = ['scheduler %s: %s' % (priority.name.lower(), stats) for priority, stats in self._stats.items()]
+        for line in lines:
+            self._logger.log(level, line)
+
+    def stop(self):
+        with self._cv:
+            self._stopped = True
+            pending = self._queue
+            self._queue = []
+            self._cv.notify()
+        for entry in pending:
+            entry[-1].set_exception(PowerlabException('scheduler stopped'))
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._stopped and not self._queue:
+                    self._cv.wait()
+                if self._stopped:
+                    return
+                _, _, priority, func, deadline, queued, future = heapq.heappop(self._queue)
+                stats = self._stats[priority]
+                stats.depth -= 1
+                now = time()
+                if deadline is not None and now > deadline:
+                    stats.expired += 1
+                    expired = True
+                else:
+                    wait = now - queued
+                    stats.total_wait += wait
+                    stats.max_wait = max(stats.max_wait, wait)
+                    expired = False
+
+            if expired:
+                future.set_exception(DeadlineExceededException('%s request expired after %.3fs in queue' %
+                                                               (priority.name.lower(), now - queued)))
+            elif self._execute(future, func):
+                with self._cv:
+                    stats.completed += 1
+            else:
+                with self._cv:
+                    stats.failed += 1
+
+    @staticmethod
+    def _execute(future, func):
+        if not future.set_running_or_notify_cancel():
+            return False
+        try:
+            future.set_result(func())
+        except BaseException as ex:
+            future.set_exception(ex)
+            return False
+        return True
+
+
+class ScheduledPowerlab(object):
+    """
+    Wraps a Powerlab so every call goes through a CommandScheduler: stop (enter) requests first, then control
+    commands, then status polls, then bulk preset/option transfers. Status polls that wait longer than
+    status_deadline seconds are dropped rather than answered with stale data. A request that is already on the
+    wire (e.g. a preset write in progress) is never interrupted.
+    """
+
+    def __init__(self, powerlab, status_deadline=None):
+        self._logger = logging.getLogger(__name__)
+        self._powerlab = powerlab
+        self._status_deadline = status_deadline
+        self._scheduler = CommandScheduler()
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    @property
+    def port(self):
+        return self._powerlab.port
+
+    @property
+    def scheduler(self):
+        return self._scheduler
+
+    @property
+    def flash_commit_stats(self):
+        return self._powerlab.flash_commit_stats
+
+    @property
+    def write_guard(self):
+        return self._powerlab.write_guard
+
+    def shutdown(self):
+        self._scheduler.log_stats()
+        if self.flash_commit_stats.summary():
+            self._logger.info('flash commit latency: %s', self.flash_commit_stats)
+        self._logger.info('preset flash on %s: %s', self.port, self.write_guard)
+        self._scheduler.stop()
+
+    def connect(self, *args, **kwargs):
+        return self._scheduler.call(Priority.BULK, lambda: self._powerlab.connect(*args, **kwargs))
+
+    def close(self):
+        return self._scheduler.call(Priority.CONTROL, self._powerlab.close)
+
+    def command_enter(self, *args, **kwargs):
+        return self._scheduler.call(Priority.SAFETY, lambda: self._powerlab.command_enter(*args, **kwargs))
+
+    def command_monitor(self, *args, **kwargs):
+        return self._scheduler.call(Priority.CONTROL, lambda: self._powerlab.command_monitor(*args, **kwargs))
+
+    def command_charge(self, *args, **kwargs):
+        return self._scheduler.call(Priority.CONTROL, lambda: self._powerlab.command_charge(*args, **kwargs))
+
+    def command_discharge(self, *args, **kwargs):
+        return self._scheduler.call(Priority.CONTROL, lambda: self._powerlab.command_discharge(*args, **kwargs))
+
+    def command_cycle(self, *args, **kwargs):
+        return self._scheduler.call(Priority.CONTROL, lambda: self._powerlab.command_cycle(*args, **kwargs))
+
+    def command_set_active_preset(self, *args, **kwargs):
+        return self._scheduler.call(Priority.CONTROL,
+                                    lambda: self._powerlab.command_set_active_preset(*args, **kwargs))
+
+    def read_status(self, *args, **kwargs):
+        deadline = time() + self._status_deadline if self._status_deadline else None
+        return self._scheduler.call(Priority.STATUS, lambda: self._powerlab.read_status(*args, **kwargs),
+                                    deadline=deadline)
+
+    def read_presets(self, *args, **kwargs):
+        return self._scheduler.call(Priority.BULK, lambda: self._powerlab.read_presets(*args, **kwargs))
+
+    def iter_presets(self, *args, **kwargs):
+        """
+        Runs the whole transfer as one bulk request so nothing else gets on the wire in the middle of it. The
+        presets are collected on the scheduler thread and yielded once all have arrived; progress is still called,
+        on the scheduler thread, as each block arrives.
+        """
+        return iter(self._scheduler.call(Priority.BULK, lambda: list(self._powerlab.iter_presets(*args, **kwargs))))
+
+    def invalidate_preset_cache(self):
+        return self._scheduler.call(Priority.BULK, self._powerlab.invalidate_preset_cache)
+
+    def write_presets(self, *args, **kwargs):
+        return self._scheduler.call(Priority.BULK, lambda: self._powerlab.write_presets(*args, **kwargs))
+
+    def read_options(self, *args, **kwargs):
+        return self._scheduler.call(Priority.BULK, lambda: self._powerlab.read_options(*args, **kwargs))
+
+    def write_options(self, *args, **kwargs):
+        return self._scheduler.call(Priority.BULK, lambda: self._powerlab.write_options(*args, **kwargs))
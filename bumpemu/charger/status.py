@@ -13,9 +13,10 @@
 #      You should have received a copy of the GNU General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import struct
+import os
 
 from bumpemu.util import str_from_props
+from bumpemu.charger.fields import uint8, int8, uint16, uint32, array, flag, record
 
 
 def _to_volts(val):
@@ -38,150 +39,100 @@ class Status(object):
     def __init__(self, data):
         self._data = data
 
-    @property
-    def firmware_version(self):
-        return struct.unpack('>H', self._data[0:2])[0]
-
-    @property
-    def b_avg_adc(self):
-        return struct.unpack('>HHHHHHHH', self._data[2:18])
+    firmware_version = uint16(0)
+    b_avg_adc = array(2, 8)
 
     @property
     def b_volts(self):
         return [(val * 5.12) / 65536 for val in self.b_avg_adc]
 
-    @property
-    def charge_set(self):
-        return struct.unpack('>H', self._data[20:22])[0]
-
-    @property
-    def l_supply_volts(self):
-        return _to_volts(struct.unpack('>H', self._data[22:24])[0]) / 16
-
-    @property
-    def supply_volts(self):
-        return _to_volts(struct.unpack('>H', self._data[24:26])[0])
-
-    @property
-    def cpu_temp(self):
-        val = struct.unpack('>H', self._data[26:28])[0]
-        return (((2.5 * val) / 4095.0) - 0.986) / 0.00355
-
-    @property
-    def avg_amps(self):
-        return struct.unpack('>h', self._data[42:44])[0] / 600.0
-
-    @property
-    def status_flags(self):
-        return struct.unpack('>H', self._data[44:46])[0]
-
-    @property
-    def safety_charge(self):
-        return bool(self.status_flags & (1 << 0))
-
-    @property
-    def generate_fuel(self):
-        return bool(self.status_flags & (1 << 5))
-
-    @property
-    def is_charge_discharge_complete(self):
-        return bool(self.status_flags & (1 << 8))
-
-    @property
-    def is_reduce_amps(self):
-        return bool(self.status_flags & (1 << 11))
-
-    @property
-    def show_vr(self):
-        return bool(self.status_flags & (1 << 12))
-
-    @property
-    def node_current(self):
-        return bool(self.status_flags & (1 << 14))
-
-    @property
-    def cold_weather(self):
-        return bool(self.status_flags & (1 << 15))
-
-    @property
-    def rx_status_flags(self):
-        return struct.unpack('>H', self._data[46:48])[0]
-
-    @property
-    def shunt_switch(self):
-        return bool(self.rx_status_flags & (1 << 0))
-
-    @property
-    def dsch_enable(self):
-        return bool(self.rx_status_flags & (1 << 1))
-
-    @property
-    def cd_pre_complete(self):
-        return bool(self.rx_status_flags & (1 << 2))
-
-    @property
-    def regen_enable(self):
-        return bool(self.rx_status_flags & (1 << 4))
-
-    @property
-    def fast_cell_avg(self):
-        return bool(self.rx_status_flags & (1 << 5))
-
-    @property
-    def chg_enable(self):
-        return bool(self.rx_status_flags & (1 << 6))
-
-    @property
-    def bp_enable(self):
-        return bool(self.rx_status_flags & (1 << 7))
-
-    @property
-    def use_nodes(self):
-        return bool(self.rx_status_flags & (1 << 8))
-
-    @property
-    def use_fuel(self):
-        return bool(self.rx_status_flags & (1 << 9))
-
-    @property
-    def amps_low_range(self):
-        return bool(self.rx_status_flags & (1 << 10))
-
-    @property
-    def amps_dsch_range(self):
-        return bool(self.rx_status_flags & (1 << 11))
-
-    @property
-    def debug1(self):
-        return struct.unpack('>h', self._data[48:50])[0]
-
-    @property
-    def _flags50(self):
-        return struct.unpack('>H', self._data[50:52])[0]
-
-    @property
-    def high_temp(self):
-        return bool(self._flags50 & (1 << 2))
+    charge_set = uint16(20)
+    l_supply_volts = uint16(22, convert=lambda val: _to_volts(val) / 16)
+    supply_volts = uint16(24, convert=_to_volts)
+    cpu_temp = uint16(26, convert=lambda val: (((2.5 * val) / 4095.0) - 0.986) / 0.00355)
+    _charge_secs = uint16(28)
+    _mah_in = uint32(34)
+    fuel_level = uint16(38, signed=True, convert=lambda val: min(max(val, 0), 1000))
+    avg_amps = uint16(42, signed=True, divisor=600.0)
+
+    status_flags = uint16(44)
+    safety_charge = flag(44, 0)
+    generate_fuel = flag(44, 5)
+    is_charge_discharge_complete = flag(44, 8)
+    is_reduce_amps = flag(44, 11)
+    show_vr = flag(44, 12)
+    node_current = flag(44, 14)
+    cold_weather = flag(44, 15)
+
+    rx_status_flags = uint16(46)
+    shunt_switch = flag(46, 0)
+    dsch_enable = flag(46, 1)
+    cd_pre_complete = flag(46, 2)
+    regen_enable = flag(46, 4)
+    fast_cell_avg = flag(46, 5)
+    chg_enable = flag(46, 6)
+    bp_enable = flag(46, 7)
+    use_nodes = flag(46, 8)
+    use_fuel = flag(46, 9)
+    amps_low_range = flag(46, 10)
+    amps_dsch_range = flag(46, 11)
+
+    debug1 = uint16(48, signed=True)
+
+    _flags50 = uint16(50)
+    high_temp = flag(50, 2)
+    cell_count_verified = flag(50, 12)
+
+    cell_vr = array(52, 8, convert=lambda vals: [(((val * 5.12) / 4095) / 8) * 1000 for val in vals])
+    vr_amps = uint16(68, divisor=600.0)
+    max_cell_volts = uint16(74, convert=lambda val: ((val * 5.12) / 4095) / 16)
+
+    _flags76 = uint16(76)
+    checking_peak = flag(76, 0)
+    battery_24v_visible = flag(76, 3)
+    cv_started = flag(76, 4)
+    preset_good = flag(76, 5)
+    preset_flash_changed = flag(76, 6)
+    regen_possible = flag(76, 7)
+    regen_dsch_failed = flag(76, 8)
+    options_flash_changed = flag(76, 10)
+
+    _charge_mins = uint16(78)
+    supply_amps = uint16(80, signed=True, divisor=150.0)
+    batt_pos_avg_volts = uint16(82, convert=lambda val: ((val * 46.96) / 4095) / 16)
+    _mah_out = uint32(84)
+    discharge_set = uint16(92)
+    vr_offset = uint16(114, convert=lambda val: (((val * 5.12) / 4095) / 8) * 1000)
+    slow_avg_amps = uint16(116, divisor=600)
 
-    @property
-    def cell_count_verified(self):
-        return bool(self._flags50 & (1 << 12))
-
-    @property
-    def cell_vr(self):
-        return [(((val * 5.12) / 4095) / 8) * 1000 for val in struct.unpack('>HHHHHHHH', self._data[52:68])]
-
-    @property
-    def vr_amps(self):
-        return struct.unpack('>H', self._data[68:70])[0] / 600.0
-
-    @property
-    def vr_offset(self):
-        return (((struct.unpack('>H', self._data[114:116])[0] * 5.12) / 4095) / 8) * 1000
+    # index = struct.unpack('>h', self._data[118:120])[0]
+    # if index >= 0:
+    #     ManualChgAmps[SlaveNum] = index;
+    #     ManualAutoAmps[SlaveNum] = 0;
+    # else:
+    #     ManualChgAmps[SlaveNum] = 0
+    #     ManualAutoAmps[SlaveNum] = (short)(0 - index);
+    # SlavesFound[SlaveNum] = Module1.valbin2(inBytes, 120);
+    # ManualDschAmps[SlaveNum] = Module1.valbin2S(inBytes, 0x7a);
 
-    @property
-    def ch1_cells(self):
-        return self._data[132]
+    bypass_pwm = array(124, 8, 'B', convert=list)
+    ch1_cells = uint8(132)
+    mode = uint8(133, writable=True)
+    error_code = uint8(134, writable=True)
+    chem8 = uint8(135)
+    packs = uint8(136)
+    active_preset = uint8(137, convert=lambda num: 0 if num > 74 or num < 0 else num)
+    screen_number = uint8(139)
+    check_pack1_volts = int8(140, convert=lambda val: (val * 46.96) / 4095)
+    fuel_offset = uint8(141, convert=lambda val: int(round((val * 5.12) / 4.095)))
+    cycle_cnt = uint8(142)
+    lower_pwm_reason = uint8(143)
+    # 0 = Charge only
+    # 1 = Discharge only
+    # 2 = Monitor
+    # 3 = Cycle
+    start_mode = uint8(144)
+    r_fail_reason = uint8(145)
 
     @property
     def mohm(self):
@@ -195,58 +146,6 @@ class Status(object):
                     vals[ii] = self.cell_vr[ii] / self.vr_amps
         return vals
 
-    @property
-    def _flags76(self):
-        return struct.unpack('>H', self._data[76:78])[0]
-
-    @property
-    def checking_peak(self):
-        return bool(self._flags76 & (1 << 0))
-
-    @property
-    def battery_24v_visible(self):
-        return bool(self._flags76 & (1 << 3))
-
-    @property
-    def cv_started(self):
-        return bool(self._flags76 & (1 << 4))
-
-    @property
-    def preset_good(self):
-        return bool(self._flags76 & (1 << 5))
-
-    @property
-    def preset_flash_changed(self):
-        return bool(self._flags76 & (1 << 6))
-
-    @property
-    def regen_possible(self):
-        return bool(self._flags76 & (1 << 7))
-
-    @property
-    def regen_dsch_failed(self):
-        return bool(self._flags76 & (1 << 8))
-
-    @property
-    def options_flash_changed(self):
-        return bool(self._flags76 & (1 << 10))
-
-    @property
-    def supply_amps(self):
-        return struct.unpack('>h', self._data[80:82])[0] / 150.0
-
-    @property
-    def batt_pos_avg_volts(self):
-        return ((struct.unpack('>H', self._data[82:84])[0] * 46.96) / 4095) / 16
-
-    @property
-    def mode(self):
-        return self._data[133]
-
-    @mode.setter
-    def mode(self, val):
-        self._data[133] = val
-
     @property
     def mode_to_str(self):
         mode = self.mode
@@ -290,10 +189,6 @@ class Status(object):
         else:
             return 'unknown'
 
-    @property
-    def discharge_set(self):
-        return struct.unpack('>H', self._data[92:94])[0]
-
     # if (this.LoadChemistryVal(Preset[SlaveNum]) == 11):
     #    this.MaxCellVolts[SlaveNum] = 0.001
     # else:
@@ -305,10 +200,6 @@ class Status(object):
         else:
             return self.charge_set / 600.0
 
-    @property
-    def max_cell_volts(self):
-        return ((struct.unpack('>H', self._data[74:76])[0] * 5.12) / 4095) / 16
-
     @property
     def avg_cell_volts(self):
         if self.use_nodes and self.ch1_cells:
@@ -323,24 +214,6 @@ class Status(object):
         else:
             return 0
 
-    @property
-    def slow_avg_amps(self):
-        return struct.unpack('>H', self._data[116:118])[0] / 600
-
-    # index = struct.unpack('>h', self._data[118:120])[0]
-    # if index >= 0:
-    #     ManualChgAmps[SlaveNum] = index;
-    #     ManualAutoAmps[SlaveNum] = 0;
-    # else:
-    #     ManualChgAmps[SlaveNum] = 0
-    #     ManualAutoAmps[SlaveNum] = (short)(0 - index);
-    # SlavesFound[SlaveNum] = Module1.valbin2(inBytes, 120);
-    # ManualDschAmps[SlaveNum] = Module1.valbin2S(inBytes, 0x7a);
-
-    @property
-    def bypass_pwm(self):
-        return [bb for bb in self._data[124:132]]
-
     @property
     def bypass_percent(self):
         return [bp * 3.09375 for bp in self.bypass_pwm]
@@ -349,67 +222,13 @@ class Status(object):
     def bypass_current(self):
         return [bp * 31.25 for bp in self.bypass_pwm]
 
-    @property
-    def error_code(self):
-        return self._data[134]
-
-    @error_code.setter
-    def error_code(self, val):
-        self._data[134] = val
-
-    @property
-    def chem8(self):
-        return self._data[135]
-
-    @property
-    def packs(self):
-        return self._data[136]
-
-    @property
-    def active_preset(self):
-        num = self._data[137]
-        if num > 74 or num < 0:
-            return 0
-        return num
-
-    @property
-    def screen_number(self):
-        return self._data[139]
-
-    @property
-    def check_pack1_volts(self):
-        return (struct.unpack('>b', self._data[140:141])[0] * 46.96) / 4095
-
-    @property
-    def fuel_offset(self):
-        return int(round((self._data[141] * 5.12) / 4.095))
-
-    @property
-    def cycle_cnt(self):
-        return self._data[142]
-
-    @property
-    def lower_pwm_reason(self):
-        return self._data[143]
-
-    # 0 = Charge only
-    # 1 = Discharge only
-    # 2 = Monitor
-    # 3 = Cycle
-    @property
-    def start_mode(self):
-        return self._data[144]
-
     @property
     def start_mode_str(self):
         return _start_mode_to_str(self.start_mode)
 
-    @property
-    def r_fail_reason(self):
-        return self._data[145]
-
     @property
     def charge_seconds(self):
+        # Same words as _charge_secs and _charge_mins, read inline since this is polled every status update
         secs = (self._data[28] << 8) | self._data[29]
         mins = (self._data[78] << 8) | self._data[79]
         if secs >= 0xfd1f:
@@ -419,7 +238,7 @@ class Status(object):
 
     @property
     def mah_in(self):
-        val = struct.unpack('>L', self._data[34:38])[0]
+        val = self._mah_in
         if val > 0x7fffffff:
             val = 0
         if self.packs > 1:
@@ -428,22 +247,13 @@ class Status(object):
 
     @property
     def mah_out(self):
-        val = struct.unpack('>L', self._data[84:88])[0]
+        val = self._mah_out
         if val > 0x7fffffff:
             val = 0
         if self.packs > 1:
             val /= float(self.packs)
         return val / 2160.0
 
-    @property
-    def fuel_level(self):
-        val = struct.unpack('>h', self._data[38:40])[0]
-        if val < 0:
-            val = 0
-        elif val > 1000:
-            val = 1000
-        return val
-
     @property
     def no_data_max(self):
         mode = self.mode
@@ -454,3 +264,75 @@ class Status(object):
 
     def __str__(self):
         return str_from_props(self)
+
+
+STATUS_SIZE = 147
+
+
+class StatusSnapshot(record(Status, STATUS_SIZE)):
+    """
+    A Status decoded once, when it is read: the whole Ram payload is unpacked by one precompiled struct into
+    slots, and the per-cell lists are worked out the first time they are asked for and then kept. frame is a
+    copy of the payload as received, for cheap comparison with other reads. mode and error_code can still be
+    assigned; frame is not changed when they are.
+    """
+    __slots__ = ('frame', '_b_volts', '_mohm', '_bypass_percent')
+    _names = tuple(name for name in dir(Status)
+                   if not name.startswith('_') and isinstance(getattr(Status, name), property))
+
+    def __init__(self, data, offset=0):
+        super(StatusSnapshot, self).__init__(data, offset)
+        self.frame = bytes(data[offset:offset + STATUS_SIZE])
+        self._b_volts = None
+        self._mohm = None
+        self._bypass_percent = None
+
+    @property
+    def b_volts(self):
+        if self._b_volts is None:
+            self._b_volts = [(val * 5.12) / 65536 for val in self.b_avg_adc]
+        return self._b_volts
+
+    @property
+    def mohm(self):
+        if self._mohm is None:
+            vals = [0] * 8
+            vr_amps = self.vr_amps
+            if vr_amps > 0:
+                cell_vr = self.cell_vr
+                ch1_cells = self.ch1_cells
+                vals[0] = (cell_vr[0] - self.vr_offset) / vr_amps
+                for ii in range(1, len(vals)):
+                    if ch1_cells == ii:
+                        vals[ii] = (cell_vr[ii] / vr_amps) - ((cell_vr[ii] / vr_amps) / 8.0)
+                    else:
+                        vals[ii] = cell_vr[ii] / vr_amps
+            self._mohm = vals
+        return self._mohm
+
+    @property
+    def bypass_percent(self):
+        if self._bypass_percent is None:
+            self._bypass_percent = [bp * 3.09375 for bp in self.bypass_pwm]
+        return self._bypass_percent
+
+    @property
+    def charge_seconds(self):
+        secs = self._charge_secs
+        if secs >= 0xfd1f:
+            return (secs - 64800) + (self._charge_mins * 60)
+        else:
+            return secs
+
+    mode_to_str = Status.mode_to_str
+    set_amps = Status.set_amps
+    avg_cell_volts = Status.avg_cell_volts
+    avg_ir = Status.avg_ir
+    bypass_current = Status.bypass_current
+    start_mode_str = Status.start_mode_str
+    mah_in = Status.mah_in
+    mah_out = Status.mah_out
+    no_data_max = Status.no_data_max
+
+    def __str__(self):
+        return os.linesep.join(sorted('%s: %s' % (name, getattr(self, name)) for name in self._names))
@@ -0,0 +1,126 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Decodes recorded Ram status payloads in bulk for analysis. Needs NumPy (pip install bumpemu[analysis]), which
+the emulator itself does not use, so nothing else in bumpemu imports this module.
+"""
+
+import numpy as np
+
+from bumpemu.charger.fields import fields, layout
+from bumpemu.charger.status import Status, STATUS_SIZE
+
+_DTYPES = {'B': 'u1', 'b': 'i1', 'H': '>u2', 'h': '>i2', 'L': '>u4'}
+
+# The Status converts that only work on a single value; the rest are plain arithmetic and are applied to whole
+# columns as they are
+_COLUMN_CONVERTS = {
+    'fuel_level': lambda val: np.clip(val, 0, 1000),
+    'cell_vr': lambda vals: (((vals * 5.12) / 4095) / 8) * 1000,
+    'active_preset': lambda num: np.where((num > 74) | (num < 0), 0, num),
+    'fuel_offset': lambda val: np.round((val * 5.12) / 4.095).astype(np.int64),
+    'bypass_pwm': lambda vals: vals,
+}
+
+
+def _frame_dtype():
+    names, formats, offsets = [], [], []
+    for offset, fmt, count in layout(Status, STATUS_SIZE):
+        names.append('o%d' % offset)
+        dtype = _DTYPES[fmt[-1]]
+        formats.append((dtype, (count,)) if count > 1 else dtype)
+        offsets.append(offset)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': STATUS_SIZE})
+
+
+_FRAME_DTYPE = _frame_dtype()
+
+
+def _sum_columns(values):
+    # Added left to right like sum() over a list so the totals match Status to the last bit
+    total = values[:, 0].copy()
+    for ii in range(1, values.shape[1]):
+        total += values[:, ii]
+    return total
+
+
+def decode_status_frames(frames):
+    """
+    Decodes N Ram payloads at once. frames is an (N x 147) uint8 array or N payloads back to back in a bytes
+    like object. Returns a dict mapping each numeric Status value (every field plus b_volts, mohm, set_amps,
+    charge_seconds, mah_in, mah_out and the other derived values) to an array of N values, or N x 8 for the per
+    cell values, computed with the same formulas as Status. The text values mode_to_str and start_mode_str are
+    left out.
+    """
+    frames = np.ascontiguousarray(np.frombuffer(frames, dtype=np.uint8) if not isinstance(frames, np.ndarray)
+                                  else frames, dtype=np.uint8).reshape(-1, STATUS_SIZE)
+    records = frames.view(_FRAME_DTYPE)[:, 0]
+
+    raw = {}
+    columns = {}
+    for name, field in fields(Status):
+        key = 'o%d' % field.offset
+        if key not in raw:
+            raw[key] = records[key].astype(np.int64)
+        value = raw[key]
+        if field.kind == 'bits':
+            mask = (1 << (field.end_bit - field.start_bit + 1)) - 1
+            value = (value >> field.start_bit) & mask
+        if field.boolean:
+            value = value != 0
+        elif field.convert is not None:
+            value = _COLUMN_CONVERTS.get(name, field.convert)(value)
+        elif field.divisor is not None:
+            value = value / field.divisor
+        columns[name] = value
+
+    ch1_cells = columns['ch1_cells']
+    mode = columns['mode']
+    columns['b_volts'] = b_volts = (columns['b_avg_adc'] * 5.12) / 65536
+
+    vr_amps = columns['vr_amps']
+    cell_vr = columns['cell_vr']
+    has_amps = vr_amps > 0
+    safe_amps = np.where(has_amps, vr_amps, 1.0)[:, None]
+    mohm = cell_vr / safe_amps
+    mohm[:, 0] = (cell_vr[:, 0] - columns['vr_offset']) / safe_amps[:, 0]
+    last = (ch1_cells >= 1) & (ch1_cells < 8)
+    rows = np.nonzero(last)[0]
+    cells = ch1_cells[rows]
+    mohm[rows, cells] = mohm[rows, cells] - (mohm[rows, cells] / 8.0)
+    mohm[~has_amps] = 0
+    columns['mohm'] = mohm
+
+    columns['bypass_percent'] = columns['bypass_pwm'] * 3.09375
+    columns['bypass_current'] = columns['bypass_pwm'] * 31.25
+    columns['set_amps'] = np.where(mode == 8, columns['discharge_set'] / 600.0, columns['charge_set'] / 600.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        columns['avg_cell_volts'] = np.where(columns['use_nodes'] & (ch1_cells != 0),
+                                             _sum_columns(b_volts) / ch1_cells, columns['max_cell_volts'])
+        columns['avg_ir'] = np.where(columns['use_nodes'] & columns['show_vr'] & (ch1_cells != 0),
+                                     _sum_columns(mohm) / ch1_cells, 0)
+
+    secs = columns['_charge_secs']
+    columns['charge_seconds'] = np.where(secs >= 0xfd1f, (secs - 64800) + (columns['_charge_mins'] * 60), secs)
+    packs = columns['packs']
+    for name in ('mah_in', 'mah_out'):
+        value = columns['_' + name]
+        value = np.where(value > 0x7fffffff, 0, value).astype(np.float64)
+        columns[name] = np.where(packs > 1, value / np.maximum(packs, 1), value) / 2160.0
+    columns['no_data_max'] = np.where((mode >= 6) & (mode <= 11), 30, 3)
+
+    return {name: value for name, value in columns.items() if not name.startswith('_')}
@@ -40,7 +40,8 @@ def run(args, logger):
                     logger.debug('---------------------------')
                     logger.debug('%s%s', os.linesep, pp)
                 if args.write:
-                    ser.write_presets(all_presets)
+                    # The presets were just read back, so without force the write would always be skipped
+                    ser.write_presets(all_presets, force=True)
 
             if args.status:
                 ss = ser.read_status()
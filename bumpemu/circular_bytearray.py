@@ -14,12 +14,14 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import os
 
 
 class CircularByteArray:
     def __init__(self, nbytes):
         self._logger = logging.getLogger(__name__)
         self._buf = bytearray(nbytes)
+        self._view = memoryview(self._buf)
         self._write_idx = 0
         self._read_idx = -1
 
@@ -50,22 +52,49 @@ class CircularByteArray:
         return self.available() == 0
 
     def append(self, data):
-        if self.available() >= len(data):
+        nbytes = len(data)
+        if self.available() >= nbytes:
             start = self._real_index(self._write_idx)
-
-            jj = 0
-            for ii in range(start, min(start + len(data), len(self._buf))):
-                self._buf[ii] = data[jj]
-                jj += 1
-            for ii in range(0, len(data) - jj):
-                self._buf[ii] = data[jj]
-                jj += 1
-            assert jj == len(data)
-
-            self._write_idx += len(data)
+            first = min(nbytes, len(self._buf) - start)
+            if first == nbytes:
+                self._buf[start:start + nbytes] = data
+            else:
+                self._buf[start:] = data[:first]
+                self._buf[:nbytes - first] = data[first:]
+            self._write_idx += nbytes
             return True
         return False
 
+    def writable_segments(self, nbytes=None):
+        """
+        Returns up to two memoryviews over the free space, starting at the write index. Bytes written to them
+        become readable once commit() is called.
+        """
+        if nbytes is None:
+            nbytes = self.available()
+        return self._segments(self._write_idx, min(nbytes, self.available()))
+
+    def commit(self, nbytes):
+        assert nbytes <= self.available()
+        self._write_idx += nbytes
+
+    def readinto(self, source, nbytes=None):
+        """
+        Fills the free space directly from a file descriptor (int) or an object with readinto(), without an
+        intermediate buffer. A file descriptor is read with readv() across the wrap point; a file object only
+        fills up to the wrap point so a blocking read is never issued twice. Returns the number of bytes added.
+        """
+        segments = self.writable_segments(nbytes)
+        if not segments:
+            return 0
+        if isinstance(source, int):
+            nread = os.readv(source, segments)
+        else:
+            nread = source.readinto(segments[0])
+        if nread:
+            self._write_idx += nread
+        return nread
+
     def consume(self, nbytes):
         if self.size() >= nbytes:
             data = self.__getitem__(slice(self.read_index, self.read_index + nbytes))
@@ -78,9 +107,22 @@ class CircularByteArray:
 
     def peek(self):
         if self.size():
-            return self.__getitem__(self.read_index)
+            return self._buf[self._real_index(self.read_index)]
         return None
 
+    def segments(self, start=None, stop=None):
+        """
+        Returns the readable bytes in [start, stop) as one or two contiguous memoryviews, without copying. The
+        views are only valid until the bytes are advanced past and overwritten.
+        """
+        if start is None:
+            start = self.read_index
+        if stop is None:
+            stop = self.write_index
+        if start < self.read_index or stop > self.write_index:
+            raise IndexError
+        return self._segments(start, stop - start)
+
     def __getitem__(self, val):
         if isinstance(val, slice):
             start = val.start
@@ -98,21 +140,10 @@ class CircularByteArray:
 
             nbytes = stop - start
             real_start = self._real_index(start)
-            real_stop = self._real_index(stop)
-            if real_start <= real_stop:
-                return bytearray(self._buf[real_start:real_stop])
-            else:
-                buf = bytearray(nbytes)
-                jj = 0
-                for ii in range(real_start, len(self._buf)):
-                    buf[jj] = self._buf[ii]
-                    jj += 1
-                for ii in range(0, real_stop):
-                    buf[jj] = self._buf[ii]
-                    jj += 1
-                assert jj == len(buf)
-                assert jj == nbytes
-                return buf
+            first = min(nbytes, len(self._buf) - real_start)
+            if first == nbytes:
+                return self._buf[real_start:real_start + nbytes]
+            return self._buf[real_start:] + self._buf[:nbytes - first]
         elif isinstance(val, int):
             if val < self.read_index or val >= self.write_index:
                 raise IndexError
@@ -120,5 +151,14 @@ class CircularByteArray:
         else:
             raise TypeError
 
+    def _segments(self, start, nbytes):
+        if nbytes <= 0:
+            return ()
+        real_start = self._real_index(start)
+        first = min(nbytes, len(self._buf) - real_start)
+        if first == nbytes:
+            return self._view[real_start:real_start + nbytes],
+        return self._view[real_start:], self._view[:nbytes - first]
+
     def _real_index(self, val):
         return val % len(self._buf)
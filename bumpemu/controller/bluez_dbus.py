@@ -15,6 +15,7 @@
 
 import os
 import logging
+import socket
 from pprint import pformat
 
 import dbus
@@ -258,28 +259,37 @@ class Characteristic(dbus.service.Object):
     org.bluez.GattCharacteristic1 interface implementation
     """
 
-    def __init__(self, bus, index, uuid, flags, service):
+    def __init__(self, bus, index, uuid, flags, service, acquire=False):
         self._logger = logging.getLogger(__name__)
         self._path = service.path + '/char' + str(index)
         self.bus = bus
         self.uuid = uuid
         self.service = service
         self.flags = flags
+        self.acquire = acquire
+        self.write_acquired = False
+        self.notify_acquired = False
         self._descriptors = []
         super(Characteristic, self).__init__(bus, self._path)
 
     @property
     def properties(self):
-        return {
-            GATT_CHRC_IFACE: {
-                'Service': self.service.path,
-                'UUID': self.uuid,
-                'Flags': self.flags,
-                'Descriptors': dbus.Array(
-                    self.descriptor_paths,
-                    signature='o')
-            }
+        properties = {
+            'Service': self.service.path,
+            'UUID': self.uuid,
+            'Flags': self.flags,
+            'Descriptors': dbus.Array(
+                self.descriptor_paths,
+                signature='o')
         }
+        # BlueZ only calls AcquireWrite/AcquireNotify for characteristics that have these properties, and goes back
+        # to WriteValue/StartNotify if they fail
+        if self.acquire:
+            if 'write' in self.flags or 'write-without-response' in self.flags:
+                properties['WriteAcquired'] = dbus.Boolean(self.write_acquired)
+            if 'notify' in self.flags:
+                properties['NotifyAcquired'] = dbus.Boolean(self.notify_acquired)
+        return {GATT_CHRC_IFACE: properties}
 
     @property
     def path(self):
@@ -297,6 +307,22 @@ class Characteristic(dbus.service.Object):
         self._descriptors.append(descriptor)
         self._logger.debug('Added %s', descriptor)
 
+    @staticmethod
+    def new_acquired_socket(options):
+        """
+        Makes the socket pair for AcquireWrite/AcquireNotify. Returns our end, the ATT MTU BlueZ passed in options
+        and the (fd, mtu) reply that hands BlueZ the other end. Each send or recv on our end is one whole write or
+        notification.
+        """
+        mtu = int(options.get('mtu', 23))
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            # UnixFd dups the fd, so BlueZ's end can be closed here once it is wrapped
+            reply = (dbus.types.UnixFd(theirs.fileno()), dbus.UInt16(mtu))
+        finally:
+            theirs.close()
+        return ours, mtu, reply
+
     # noinspection PyPep8Naming
     @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature='s', out_signature='a{sv}')
     def GetAll(self, interface):
@@ -314,6 +340,16 @@ class Characteristic(dbus.service.Object):
     def WriteValue(self, value, options):
         raise NotSupportedException()
 
+    # noinspection PyPep8Naming
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='a{sv}', out_signature='hq')
+    def AcquireWrite(self, options):
+        raise NotSupportedException()
+
+    # noinspection PyPep8Naming
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='a{sv}', out_signature='hq')
+    def AcquireNotify(self, options):
+        raise NotSupportedException()
+
     # noinspection PyPep8Naming
     @dbus.service.method(GATT_CHRC_IFACE)
     def StartNotify(self):
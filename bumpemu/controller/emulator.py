@@ -15,21 +15,26 @@
 
 import logging
 import struct
-from threading import RLock, Condition
+from copy import copy
+from threading import RLock
+from time import monotonic
 
-import dbus
 from gi.repository import GLib
 
-from bumpemu.util import crc16
 from bumpemu.controller import bluez_dbus
 from bumpemu.controller.messages import bump_settings, charger_idle, charger_status, charger_settings, battery
 from bumpemu.controller import constants
 from bumpemu.controller.message_handler import MessageHandler
 from bumpemu.controller.state_machine import state
 from bumpemu.controller.state_machine.event import Event
+from bumpemu.controller.status_cache import StatusNotifyCache
+from bumpemu.controller.latest import LatestSample
+from bumpemu.controller.notify_packer import NotificationPacker
+from bumpemu.controller.poll_rate import AdaptivePollRate
+from bumpemu.controller.worker import ChargerWorker
 from bumpemu.charger.powerlab import PowerlabException
+from bumpemu.charger.scheduler import DeadlineExceededException
 from bumpemu import debug
-from bumpemu.debug import print_bytes
 
 
 class UartAdvertisement(bluez_dbus.Advertisement):
@@ -40,35 +45,91 @@ class UartAdvertisement(bluez_dbus.Advertisement):
 
 
 class BumpEmulator(bluez_dbus.Application):
-    def __init__(self, bus, path, charger, batt, presets, status_interval):
+    def __init__(self, bus, path, charger, batt, presets, status_interval, status_keepalive=0, poll_interval=None,
+                 poll_min=None, poll_max=None, acquire=False, standby_interval=None):
         super(BumpEmulator, self).__init__(bus)
         self._logger = logging.getLogger(__name__)
-        self.add_service(UartService(bus, path, 0, charger, batt, presets, status_interval))
+        self.add_service(UartService(bus, path, 0, charger, batt, presets, status_interval, status_keepalive,
+                                     poll_interval, poll_min, poll_max, acquire, standby_interval))
 
 
 class UartService(bluez_dbus.Service):
     UUID = '6E400001-B5A3-F393-E0A9-E50E24DCCA9E'
 
-    def __init__(self, bus, path, index, charger, batt, presets, status_interval):
+    def __init__(self, bus, path, index, charger, batt, presets, status_interval, status_keepalive=0,
+                 poll_interval=None, poll_min=None, poll_max=None, acquire=False, standby_interval=None):
         super(UartService, self).__init__(bus, path, index, self.UUID, True)
         self._logger = logging.getLogger(__name__)
         self._bus = bus
-        self._rx_chrc = RxChrc(bus, 1, self, charger, batt, presets, status_interval)
-        self.add_characteristic(TxChrc(bus, 0, self, self._rx_chrc))
+        self._rx_chrc = RxChrc(bus, 1, self, charger, batt, presets, status_interval, status_keepalive,
+                               poll_interval, poll_min, poll_max, acquire, standby_interval)
+        self.add_characteristic(TxChrc(bus, 0, self, self._rx_chrc, acquire))
         self.add_characteristic(self._rx_chrc)
 
 
 class TxChrc(bluez_dbus.Characteristic):
     UUID = '6E400002-B5A3-F393-E0A9-E50E24DCCA9E'
+    WRITE_BACKOFF_MS = 20
 
-    def __init__(self, bus, index, service, rx_chrc):
-        super(TxChrc, self).__init__(bus, index, self.UUID, ['write-without-response'], service)
+    def __init__(self, bus, index, service, rx_chrc, acquire=False):
+        super(TxChrc, self).__init__(bus, index, self.UUID, ['write-without-response'], service, acquire)
         self._logger = logging.getLogger(__name__)
+        self._rx_chrc = rx_chrc
         self._message_handler = MessageHandler(rx_chrc)
+        rx_chrc.inbound = self._message_handler
+        self._write_sock = None
+        self._write_mtu = None
 
     def WriteValue(self, value, options):
         self._logger.debug('WriteValue')
-        self._message_handler.append(bytes([bb for bb in value]))
+        if 'mtu' in options:
+            self._rx_chrc.set_mtu(int(options['mtu']))
+        self._message_handler.append(bytes(value))
+
+    def AcquireWrite(self, options):
+        self._logger.debug('AcquireWrite')
+        self._release_write()
+        sock, mtu, reply = self.new_acquired_socket(options)
+        self._write_sock = sock
+        self._write_mtu = mtu
+        self.write_acquired = True
+        self._rx_chrc.set_mtu(mtu)
+        self._watch_write(sock)
+        self._logger.info('writes acquired (mtu %d)', mtu)
+        return reply
+
+    def _on_write_io(self, fd, condition, sock):
+        if sock is not self._write_sock:
+            return False
+        if condition & GLib.IO_IN:
+            if self._message_handler.full():
+                # leave the writes in the socket until the handler catches up rather than dropping them here
+                GLib.timeout_add(self.WRITE_BACKOFF_MS, self._watch_write, sock)
+                return False
+            try:
+                data = sock.recv(self._write_mtu)
+            except OSError as ex:
+                self._logger.warning('write socket: %s', ex)
+                data = None
+            if data:
+                self._message_handler.append(data)
+                return True
+        # BlueZ closes its end when the app disconnects
+        self._release_write()
+        return False
+
+    def _watch_write(self, sock):
+        if sock is self._write_sock:
+            GLib.io_add_watch(sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                              self._on_write_io, sock)
+        return False
+
+    def _release_write(self):
+        if self._write_sock is not None:
+            self._write_sock.close()
+            self._write_sock = None
+            self.write_acquired = False
+            self._logger.info('writes released')
 
 
 def _modify_preset(preset, **kwargs):
@@ -90,38 +151,71 @@ class RxChrc(bluez_dbus.Characteristic):
     FIRMWARE_VERSION = 408
     DEVICE_ID = [0, 1, 2, 3, 4, 5]
     DEVICE_NAME = 'BumpEmulator'
-
-    def __init__(self, bus, index, service, charger, batt, presets, status_interval):
-        super(RxChrc, self).__init__(bus, index, self.UUID, ['notify'], service)
+    NOTIFY_SEND_TIMEOUT = 0.2
+    STATUS_HISTORY = 120
+    STATS_LOG_INTERVAL = 600
+
+    def __init__(self, bus, index, service, charger, batt, presets, status_interval, status_keepalive=0,
+                 poll_interval=None, poll_min=None, poll_max=None, acquire=False, standby_interval=None):
+        super(RxChrc, self).__init__(bus, index, self.UUID, ['notify'], service, acquire)
+        if poll_interval is None:
+            poll_interval = status_interval
         self._logger = logging.getLogger(__name__)
         self._notifying = False
         self._charger = charger
         self._battery = batt
         self._battery_group = battery.BatteryGroup(batt) if batt else None
-        self._status_interval = status_interval * 1000
+        self._status_interval = int(round(status_interval * 1000))
+        self._poll_interval = poll_interval
+        self._poll_rate = AdaptivePollRate(poll_interval, poll_min or poll_interval, poll_max or poll_interval)
+        self._status_cache = StatusNotifyCache(status_keepalive)
+        self._latest_status = LatestSample(self.STATUS_HISTORY)
+        self._standby_interval = standby_interval
+        self._flash_change_handled = False
+        self._session = 0
+        self._poll_chain = 0
+        self._stats_logged = 0.0
+        self._packer = NotificationPacker(self.MODEL_ID, self._notify_value)
+        self._notify_sock = None
+        self.inbound = None
+        self._worker = ChargerWorker('status')
+        self._poll_worker = ChargerWorker('poll')
         self._lock = RLock()
         self._operation_to_preset_idx = presets
         self._selected_operation = batt.pref_operation if batt else None
         if self._selected_operation == constants.ChargerOperation.ANALYZE:
             raise Exception('analyze is not currently supported')
-        self._running = False
-        self._running_cond = Condition()
         self._bad_chemistry_error_code = 122  # unknown chemistry
         self._not_allowed_error_code = 49  # charge not allowed
         self._not_idle_error_code = 108  # preset loaded while charging
         self._op_not_set_error_code = 13  # preset is empty
         self._not_clearable_error_codes = {self._bad_chemistry_error_code}
+        self._close_charger()
         self._init()
+        if standby_interval:
+            self._schedule_poll(standby_interval)
 
     def _init(self):
+        """
+        Resets what belongs to one app connection. The charger session (serial port, options, presets, state) is
+        kept across app connections; see _close_charger.
+        """
+        self._active_preset = None
+        self._forced_error_code = None
+        self._disallow_operations = True
+        self._setup_sent = False
+        self._status_cache.reset()
+        self._poll_rate.reset()
+
+    def _close_charger(self):
         self._charger.close()
         self._state = state.DisconnectedState()
         self._charger_options = None
         self._presets = None
-        self._active_preset = None
-        self._forced_error_code = None
-        self._disallow_operations = True
         self._no_status_count = 0
+        self._flash_change_handled = False
+        self._firmware_version = None
+        self._latest_status.clear()
 
     def StartNotify(self):
         self._logger.debug('StartNotify')
@@ -131,35 +225,62 @@ class RxChrc(bluez_dbus.Characteristic):
         self._logger.debug('StopNotify')
         self._notifying = False
         self._logger.info('ble disconnected')
-
-    def add_header(self, buf, message_id, payload):
-        struct.pack_into(constants.Message.HEADER_FORMAT,
-                         buf,
-                         0,
-                         constants.Message.PREAMBLE_BYTE,
-                         self.MODEL_ID,
-                         message_id,
-                         len(payload))
-        return constants.Message.HEADER_BYTES
+        self._logger.info('status notifications: %s', self._status_cache)
+        self._logger.info('status worker: %s', self._worker)
+        self._logger.info('poll worker: %s', self._poll_worker)
+        self._logger.info('poll rate: %s', self._poll_rate)
+        self._logger.info('notifications: %s', self._packer)
+        self._logger.info('inbound messages: %s', self.inbound)
+        self._packer.discard()
+        self._packer.reset_mtu()
+        self._release_notify()
+
+    def AcquireNotify(self, options):
+        self._logger.debug('AcquireNotify')
+        self._release_notify()
+        sock, mtu, reply = self.new_acquired_socket(options)
+        # Don't hold up the main loop for long if BlueZ stops reading
+        sock.settimeout(self.NOTIFY_SEND_TIMEOUT)
+        self._notify_sock = sock
+        self.notify_acquired = True
+        GLib.io_add_watch(sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_HUP | GLib.IO_ERR, self._on_notify_hup, sock)
+        self._logger.info('notifications acquired (mtu %d)', mtu)
+        self.StartNotify()
+        self._packer.set_mtu(mtu)
+        return reply
+
+    def _on_notify_hup(self, fd, condition, sock):
+        # BlueZ closes its end when the app turns notifications off or disconnects, which it then doesn't also
+        # report with StopNotify
+        if sock is self._notify_sock:
+            self.StopNotify()
+        return False
+
+    def _release_notify(self):
+        if self._notify_sock is not None:
+            self._notify_sock.close()
+            self._notify_sock = None
+            self.notify_acquired = False
+            self._logger.info('notifications released')
+
+    def set_mtu(self, mtu):
+        self._packer.set_mtu(mtu)
 
     def _write(self, message_id, payload):
         if debug.LOG_BLUETOOTH:
             self._logger.debug('_write - notifying: %s', self._notifying)
         if self._notifying:
-            buf = bytearray(len(payload) + 7)
-            ii = self.add_header(buf, message_id, payload)
-            for bb in payload:
-                buf[ii] = bb
-                ii += 1
-            crc = crc16(buf[:-constants.Message.CRC_BYTES], init=constants.Message.CRC_SEED)
-            struct.pack_into(constants.Message.CRC_FORMAT, buf, len(buf) - constants.Message.CRC_BYTES, crc)
+            self._packer.write(message_id, payload)
 
-            dbus_bytes = [dbus.Byte(bb) for bb in buf]
-            if debug.LOG_BLUETOOTH:
-                print_bytes(self._logger, logging.DEBUG, dbus_bytes, 'w')
-
-            for ii in range(0, len(dbus_bytes), 40):
-                self.PropertiesChanged(bluez_dbus.GATT_CHRC_IFACE, {'Value': dbus_bytes[ii:ii + 40]}, [])
+    def _notify_value(self, value):
+        sock = self._notify_sock
+        if sock is None:
+            self.PropertiesChanged(bluez_dbus.GATT_CHRC_IFACE, {'Value': value}, [])
+            return
+        try:
+            sock.send(value)
+        except OSError as ex:
+            self._logger.warning('notify socket: %s', ex)
 
     def connect_ack(self):
         self._logger.debug('connect_ack')
@@ -172,36 +293,62 @@ class RxChrc(bluez_dbus.Characteristic):
 
     def connect_request(self):
         self._logger.debug('connect_request')
-
-        # Wait for a status loop from a previous connection to exit (CCS app does not always send
-        # StopNotify properly)
         assert self._notifying
-        self._notifying = False
-        try:
-            with self._running_cond:
-                while self._running:
-                    if not self._running_cond.wait(self._status_interval * 2):
-                        self._logger.error('timed out waiting for status loop to exit')
-                        return
-        finally:
-            self._notifying = True
 
-        self._init()
+        # A new session stops the timers left by the previous connection (CCS app does not always send
+        # StopNotify properly) or by warm standby
+        self._session += 1
+        session = self._session
+        self._stats_logged = monotonic()
 
-        # Don't allow any operations until we've done error checking and set everything up properly
-        self._disallow_operations = True
+        with self._lock:
+            self._init()
 
-        # Inform the app it is connected
+            # Don't allow any operations until we've done error checking and set everything up properly
+            self._disallow_operations = True
+
+        # Inform the app it is connected, with a placeholder status until the charger has been looked at
         self.connect_ack()
+        with self._lock:
+            self._notify_status(*self._placeholder_status())
 
-        # Do one iteration of the status loop to set up initial state
+        # Connecting to the charger and reading presets can take seconds, so do it on the poll worker, which also
+        # keeps it from overlapping a poll; the app gets each message as soon as what it needs is ready
+        self._poll_worker.post(lambda: self._handshake(session, monotonic()))
+
+        self._logger.info('ble connected')
+
+    def _handshake(self, session, started):
+        if session != self._session:
+            return
+        if not self._notifying:
+            self._resume_standby()
+            return
+
+        # Read and send one status to set up initial state
+        if self._in_state(state.DisconnectedState):
+            self.poll_status()
+            with self._lock:
+                if not self._setup_sent and not self._in_state(state.DisconnectedState):
+                    # A warm standby poll connected the charger before the app got here
+                    self._send_charger_setup()
+        else:
+            self._resume_charger_session()
         self.status_loop()
 
-        # Start the status loop
-        assert self._running
-        GLib.timeout_add(self._status_interval, self.status_loop)
+        # Start polling the charger and sending status, each at its own rate
+        if session == self._session:
+            if self._notifying:
+                self._schedule_poll(self._poll_rate.update(self._state, self._latest_status.get()))
+                GLib.timeout_add(self._status_interval, self._status_tick, session)
+            else:
+                self._resume_standby()
+        self._logger.info('charger handshake took %.3fs', monotonic() - started)
 
-        self._logger.info('ble connected')
+    def _resume_standby(self):
+        # connect_request stopped the standby poll chain; the app left before the handshake could replace it
+        if self._standby_interval:
+            self._schedule_poll(self._standby_interval)
 
     def device_info(self):
         self._logger.debug('device_info')
@@ -314,6 +461,7 @@ class RxChrc(bluez_dbus.Characteristic):
 
     def _set_event(self, event):
         self._state = self._state.on_event(event, self)
+        self._poll_soon()
         self.status_loop()
 
     def _set_forced_error(self, code):
@@ -393,63 +541,288 @@ class RxChrc(bluez_dbus.Characteristic):
             else:
                 self._disallow_operations = True
 
+    def _read_presets(self):
+        # The bank is only used once all of it has arrived: the CRC over the whole bank is the last thing sent,
+        # and a bank that fails it must not have been written back or used to pick a preset. progress is just
+        # for the log.
+        self._logger.info('reading presets')
+        return self._charger.read_presets(
+            retries=2, progress=lambda received, expected: self._logger.debug('presets %d/%d bytes',
+                                                                              received, expected))
+
+    def _send_settings(self):
+        # Inform the app of our parameters
+        self._setup_sent = True
+        self.select_charger()
+        self.bump_settings()
+        self.charger_settings()
+        self.battery_group()
+
+    def _send_charger_setup(self):
+        # Check that the preset chemistries match the specified battery chemistry
+        self._check_preset_chemistries()
+        self._send_settings()
+
     def _charger_connected(self):
+        """
+        Finishes connecting the charger. The settings only need the options, so the app gets them before the
+        presets are read. No lock is held while reading, so the app's other requests are answered meanwhile.
+        """
         assert self._charger_options
 
-        self._logger.info('reading presets')
+        with self._lock:
+            # In warm standby there is no app yet; it gets the settings when it connects
+            if self._notifying:
+                self._send_settings()
         try:
-            self._presets = self._charger.read_presets(retries=2)
+            presets = self._read_presets()
         except Exception as ex:
             self._logger.exception(ex)
         else:
-            # Check that the preset chemistries match the specified battery chemistry
-            self._check_preset_chemistries()
+            with self._lock:
+                self._presets = presets
+                self._check_preset_chemistries()
+                self._state = self._state.on_event(Event.CONNECTED, self)
+            self._logger.info('charger connected')
 
-            # Inform the app of our parameters
-            self.select_charger()
-            self.bump_settings()
-            self.charger_settings()
-            self.battery_group()
+    def _resume_charger_session(self):
+        """
+        Picks up the charger session left open by the previous app connection. One status read checks the
+        charger is still there and whether its options or presets were changed on the charger itself since they
+        were read; only then are they read again.
+        """
+        self._logger.info('resuming charger session')
+        self._log_status_history()
+        before = self._latest_status.get()
+        self.poll_status()
+        sample = self._latest_status.get()
+        if sample is not None and sample is not before:
+            self._revalidate_charger(sample.value)
+        with self._lock:
+            if not self._in_state(state.DisconnectedState):
+                self._send_charger_setup()
+
+    def _revalidate_charger(self, chg_status):
+        # Re-read once each time the charger reports a change; the flags may stay set for a while. New firmware
+        # can change what the options and presets mean without setting either flag, so it is checked too
+        changed = chg_status.options_flash_changed or chg_status.preset_flash_changed
+        firmware = chg_status.firmware_version
+        firmware_changed = self._firmware_version is not None and firmware != self._firmware_version
+        if (firmware_changed or (changed and not self._flash_change_handled)) and \
+                not self._in_state(state.DisconnectedState):
+            if firmware_changed:
+                self._logger.info('charger firmware changed from %d to %d, re-reading options and presets',
+                                  self._firmware_version, firmware)
+                # The cached presets were read under the old firmware
+                self._charger.invalidate_preset_cache()
+            else:
+                self._logger.info('charger flash changed, re-reading options and presets')
+            try:
+                options = self._charger.read_options(retries=2)
+                presets = self._read_presets()
+            except Exception as ex:
+                self._logger.exception(ex)
+                with self._lock:
+                    self._close_charger()
+                return
+            with self._lock:
+                self._charger_options = options
+                self._presets = presets
+                self._firmware_version = firmware
+        self._flash_change_handled = changed
+
+    @property
+    def status_history(self):
+        """
+        The most recent status Samples, oldest first, including those read in warm standby.
+        """
+        return self._latest_status.history()
+
+    def _log_status_history(self):
+        history = self._latest_status.history()
+        if len(history) > 1:
+            first, last = history[0].value, history[-1].value
+            self._logger.info('last %.0fs of status: %d reads, %.2fA -> %.2fA, %.3fV -> %.3fV, %.0fs old',
+                              history[-1].timestamp - history[0].timestamp, len(history), first.avg_amps,
+                              last.avg_amps, sum(first.b_volts), sum(last.b_volts), history[-1].age)
+
+    def _stale_status_age(self):
+        # Don't send the app a reading that missed several polls in a row
+        return max(self._poll_rate.interval, self._poll_interval) * 5
+
+    def _placeholder_status(self):
+        # On a reconnect the charger session is still open; show the latest reading, as idle until the handshake
+        # has checked the charger, rather than telling the app the charger is gone
+        if not self._in_state(state.DisconnectedState):
+            sample = self._latest_status.get()
+            if sample is not None and sample.age <= self._stale_status_age():
+                return self._status_message(sample.value, True, constants.ChargerOperationFlag.NONE)
+        return self._disconnected_status()
 
-            assert self._notifying
+    @staticmethod
+    def _disconnected_status():
+        status = charger_idle.ChargerIdle()
+        status.model_id = constants.ChargerModel.PL_8
+        status.comm_state = constants.CommState.COMM_DISCONNECTED
+        return constants.MessageId.STATUS_IDLE_UPDATE_NOT2.value, status.serialize()
+
+    def _status_message(self, chg_status, is_idle_status, operation_flags):
+        mode = self._mode_conversion(chg_status.mode)
+        self._logger.debug('state: %s is_idle_status: %s op_flags: %s mode: %s',
+                           self._state, is_idle_status, operation_flags, mode)
+
+        if is_idle_status:
+            message_id = constants.MessageId.STATUS_IDLE_UPDATE_NOT2
+            status = charger_idle.ChargerIdle()
+            status.firmware_version = chg_status.firmware_version
+        else:
+            message_id = constants.MessageId.STATUS_UPDATE_NOT2
+            status = charger_status.ChargerStatus()
+            status.mode_running = mode
+            status.error_code = chg_status.error_code
+            status.chemistry = constants.Chemistry(chg_status.chem8)
+            status.cell_count = chg_status.ch1_cells
+            status.estimated_fuel_level = int(round(chg_status.fuel_level / 10.0))
+            status.estimated_minutes = 0
+            status.amps = int(chg_status.avg_amps * 1000)
+            status.pack_volts = int(sum(chg_status.b_volts) * 1000)
+            status.capacity_added = int(round(chg_status.mah_in))
+            status.capacity_removed = int(round(chg_status.mah_out))
+            status.cycle_timer = chg_status.charge_seconds
+            status.status_flags = chg_status.status_flags
+            status.rx_status_flags = chg_status.rx_status_flags
+            if (isinstance(self._state, state.ChargingState) or
+                    isinstance(self._state, state.DischargingState)):
+                if chg_status.lower_pwm_reason == 0 and chg_status.cv_started:
+                    status.power_reduced_reason = constants.ChargerPowerReducedReason.OUTPUT_CV
+                else:
+                    status.power_reduced_reason = constants.ChargerPowerReducedReason(
+                        chg_status.lower_pwm_reason)
+            else:
+                status.power_reduced_reason = constants.ChargerPowerReducedReason.NONE
+
+            if status.cell_count:
+                b_volts = chg_status.b_volts
+                mohm = chg_status.mohm
+                bp_pct = chg_status.bypass_percent
+                for ii in range(status.cell_count):
+                    status.cell_volts[ii] = int(b_volts[ii] * 1000)
+                    status.cell_ir[ii] = int(mohm[ii] * 100)
+                    status.cell_bypass[ii] = int(round(bp_pct[ii]))
+
+        status.model_id = constants.ChargerModel.PL_8
+        status.comm_state = constants.CommState.COMM_CONNECTED
+        status.supply_volts = int(chg_status.supply_volts * 1000)
+        status.supply_amps = int(chg_status.supply_amps * 1000)
+        status.cpu_temp = int(round(chg_status.cpu_temp))
+        status.operation_flags = operation_flags.value
+
+        return message_id.value, status.serialize()
+
+    def _notify_status(self, message_id, payload):
+        if self._status_cache.should_send((message_id, payload)):
+            self._write(message_id, payload)
+
+    def _status_tick(self, session):
+        # Called by the main loop, so only hand the update to the worker; a tick still queued is not repeated
+        if not self._notifying or session != self._session:
+            return False
+        self._worker.post(self.status_loop, key='status')
+        now = monotonic()
+        if now - self._stats_logged >= self.STATS_LOG_INTERVAL:
+            # Apps don't always send StopNotify, so don't count on seeing these at disconnect
+            self._stats_logged = now
+            self._logger.info('status notifications: %s', self._status_cache)
+        return True
 
-            self._state = self._state.on_event(Event.CONNECTED, self)
-            self._logger.info('charger connected')
+    @property
+    def poll_rate(self):
+        return self._poll_rate
+
+    def _schedule_poll(self, interval):
+        # Only the most recently scheduled tick polls, so rescheduling early never leaves two chains running
+        self._poll_chain += 1
+        GLib.timeout_add(int(round(interval * 1000)), self._poll_tick, self._session, self._poll_chain)
+
+    def _poll_tick(self, session, chain):
+        if (self._notifying or self._standby_interval) and session == self._session and chain == self._poll_chain:
+            self._poll_worker.post(self._poll, key='poll')
+        return False
+
+    def _poll(self):
+        self.poll_status()
+        if self._notifying:
+            self._schedule_poll(self._poll_rate.update(self._state, self._latest_status.get()))
+        elif self._standby_interval:
+            # Warm standby: keep the link and presets current for the next app connection
+            sample = self._latest_status.get()
+            if sample is not None:
+                self._revalidate_charger(sample.value)
+            self._schedule_poll(self._standby_interval)
+
+    def _poll_soon(self):
+        # The charger was just told to do something; look now rather than when the current (maybe backed off)
+        # wait runs out
+        self._poll_rate.reset()
+        self._poll_worker.post(self._poll, key='poll')
+
+    def poll_status(self):
+        """
+        Reads the charger into the latest status slot, connecting to it first if needed. The read itself is done
+        without holding the lock so a slow link never holds up status_loop, which publishes from the slot.
+        """
+        self._logger.debug('poll_status')
+        if self._in_state(state.DisconnectedState):
+            try:
+                options = self._charger.connect()
+            except PowerlabException:
+                return
+            with self._lock:
+                self._charger_options = options
+            self._charger_connected()
+
+        try:
+            chg_status = self._charger.read_status()
+        except DeadlineExceededException as ex:
+            # The link was busy with higher priority work; skip this read rather than publish stale data
+            self._logger.debug(str(ex))
+        except Exception as ex:
+            self._logger.exception(ex)
+            self._no_status_count += 1
+            if self._no_status_count >= 5:
+                with self._lock:
+                    self._no_status_count = 0
+                    self._charger_options = None
+                    self._firmware_version = None
+                    self._latest_status.clear()
+                    self._charger.close()
+                    self._state = self._state.on_event(Event.DISCONNECTED, self)
+        else:
+            self._no_status_count = 0
+            if self._firmware_version is None:
+                # What the options and presets of this charger session were read under
+                self._firmware_version = chg_status.firmware_version
+            self._latest_status.publish(chg_status)
 
     def status_loop(self, force_idle=False):
         self._logger.debug('charger_status')
-        chg_status = None
         with self._lock:
-            if self._in_state(state.DisconnectedState):
-                try:
-                    self._charger_options = self._charger.connect()
-                except PowerlabException:
-                    pass
-                else:
-                    self._charger_connected()
-
-            if not self._in_state(state.DisconnectedState):
-                try:
-                    chg_status = self._charger.read_status()
-                except Exception as ex:
-                    self._logger.exception(ex)
-                    chg_status = None
-                    self._no_status_count += 1
-                    if self._no_status_count >= 5:
-                        self._no_status_count = 0
-                        self._charger_options = None
-                        self._charger.close()
-                        self._state = self._state.on_event(Event.DISCONNECTED, self)
+            chg_status = None
+            sample = self._latest_status.get()
+            if sample is not None:
+                age = sample.age
+                if age > self._stale_status_age():
+                    self._logger.debug('not sending status %d, it is %.3fs old', sample.seq, age)
                 else:
-                    self._no_status_count = 0
+                    self._logger.debug('sending status %d, %.3fs old', sample.seq, age)
+                    chg_status = sample.value
+                    if self._forced_error_code is not None:
+                        # The sample is shared with later ticks, which may no longer be forcing the error
+                        chg_status = copy(chg_status)
 
             if self._in_state(state.DisconnectedState):
-                message_id = constants.MessageId.STATUS_IDLE_UPDATE_NOT2
-                status = charger_idle.ChargerIdle()
-                status.model_id = constants.ChargerModel.PL_8
-                status.comm_state = constants.CommState.COMM_DISCONNECTED
                 try:
-                    self._write(message_id.value, status.serialize())
+                    self._notify_status(*self._disconnected_status())
                 except Exception as ex:
                     self._logger.exception(ex)
 
@@ -483,64 +856,17 @@ class RxChrc(bluez_dbus.Characteristic):
 
                     is_idle_status = (is_idle_status or force_idle) and self._forced_error_code is None
 
-                    mode = self._mode_conversion(chg_status.mode)
-                    self._logger.debug('state: %s is_idle_status: %s op_flags: %s mode: %s',
-                                       self._state, is_idle_status, operation_flags, mode)
-
-                    if is_idle_status:
-                        message_id = constants.MessageId.STATUS_IDLE_UPDATE_NOT2
-                        status = charger_idle.ChargerIdle()
-                        status.firmware_version = chg_status.firmware_version
-                    else:
-                        message_id = constants.MessageId.STATUS_UPDATE_NOT2
-                        status = charger_status.ChargerStatus()
-                        status.mode_running = mode
-                        status.error_code = chg_status.error_code
-                        status.chemistry = constants.Chemistry(chg_status.chem8)
-                        status.cell_count = chg_status.ch1_cells
-                        status.estimated_fuel_level = int(round(chg_status.fuel_level / 10.0))
-                        status.estimated_minutes = 0
-                        status.amps = int(chg_status.avg_amps * 1000)
-                        status.pack_volts = int(sum(chg_status.b_volts) * 1000)
-                        status.capacity_added = int(round(chg_status.mah_in))
-                        status.capacity_removed = int(round(chg_status.mah_out))
-                        status.cycle_timer = chg_status.charge_seconds
-                        status.status_flags = chg_status.status_flags
-                        status.rx_status_flags = chg_status.rx_status_flags
-                        if (isinstance(self._state, state.ChargingState) or
-                                isinstance(self._state, state.DischargingState)):
-                            if chg_status.lower_pwm_reason == 0 and chg_status.cv_started:
-                                status.power_reduced_reason = constants.ChargerPowerReducedReason.OUTPUT_CV
-                            else:
-                                status.power_reduced_reason = constants.ChargerPowerReducedReason(
-                                    chg_status.lower_pwm_reason)
-                        else:
-                            status.power_reduced_reason = constants.ChargerPowerReducedReason.NONE
-
-                        if status.cell_count:
-                            b_volts = chg_status.b_volts
-                            mohm = chg_status.mohm
-                            bp_pct = chg_status.bypass_percent
-                            for ii in range(status.cell_count):
-                                status.cell_volts[ii] = int(b_volts[ii] * 1000)
-                                status.cell_ir[ii] = int(mohm[ii] * 100)
-                                status.cell_bypass[ii] = int(round(bp_pct[ii]))
-
-                    status.model_id = constants.ChargerModel.PL_8
-                    status.comm_state = constants.CommState.COMM_CONNECTED
-                    status.supply_volts = int(chg_status.supply_volts * 1000)
-                    status.supply_amps = int(chg_status.supply_amps * 1000)
-                    status.cpu_temp = int(round(chg_status.cpu_temp))
-                    status.operation_flags = operation_flags.value
-
-                    self._write(message_id.value, status.serialize())
+                    # The frame plus everything else the message is built from
+                    key = (chg_status.frame, type(self._state), is_idle_status, operation_flags,
+                           self._forced_error_code)
+                    message = self._status_cache.message_for(key)
+                    if message is None:
+                        message = self._status_message(chg_status, is_idle_status, operation_flags)
+                        self._status_cache.remember(key, message)
+                    self._notify_status(*message)
                 except Exception as ex:
                     self._logger.exception(ex)
 
-            with self._running_cond:
-                self._running = self._notifying
-                if not self._running:
-                    self._running_cond.notify()
             return self._notifying
 
     def cycle_graph_complete(self):
@@ -582,15 +908,18 @@ class RxChrc(bluez_dbus.Characteristic):
                         self._charger.command_charge(self._battery_group.battery_count, retries=2)
                 except Exception as ex:
                     self._logger.exception(ex)
+                else:
+                    self._poll_soon()
 
     def operation_stop(self, port):
         self._logger.debug('operation_stop(port=%d)', port)
-        with self._lock:
-            try:
-                self._charger.command_enter(retries=2)
-            except Exception as ex:
-                self._logger.exception(ex)
-            else:
+        # Send the stop before taking the lock so it never waits behind a status update or a preset transfer
+        try:
+            self._charger.command_enter(retries=2)
+        except Exception as ex:
+            self._logger.exception(ex)
+        else:
+            with self._lock:
                 self._set_event(Event.STOP)
 
     def dismiss(self, port, keep_setup):
@@ -665,6 +994,8 @@ class RxChrc(bluez_dbus.Characteristic):
                     self._charger.command_monitor(self._battery_group.battery_count, use_bananas=True, retries=2)
                 except Exception as ex:
                     self._logger.exception(ex)
+                else:
+                    self._poll_soon()
 
     def selected_operation(self, port, operation):
         self._logger.debug('selected_operation(port=%d, operation=%d)', port, operation)
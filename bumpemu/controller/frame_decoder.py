@@ -0,0 +1,175 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import struct
+from time import monotonic
+
+from bumpemu.util import crc16
+from bumpemu.controller import constants
+
+_PAYLOAD_LEN = struct.Struct(constants.Message.PAYLOAD_LEN_FORMAT)
+_CRC = struct.Struct(constants.Message.CRC_FORMAT)
+
+
+class FrameDecoder(object):
+    """
+    Splits the app's byte stream into messages. Bytes are kept in one contiguous buffer; feed() finds each
+    preamble with bytearray.find(), checks the length and CRC in place and yields (message_id, payload) with the
+    payload as a memoryview into the buffer, so nothing is copied between the bytes received and the message
+    handler. Bytes that don't start a valid message (noise, a bad CRC, an impossible length) are skipped up to
+    the next preamble. With partial_timeout set, expire() also gives up on a message that has been waiting that
+    long for the rest of its bytes, e.g. one truncated by a lost write or with a corrupted length, so it can't
+    hold up the messages behind it.
+    """
+
+    def __init__(self, size=4096, partial_timeout=None):
+        self._logger = logging.getLogger(__name__)
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        self._partial_timeout = partial_timeout
+        # The partial message being waited on: where it starts, since when, and where the buffer ended then
+        self._wait_pos = None
+        self._wait_since = None
+        self._wait_end = None
+        self.frames = 0
+        self.crc_errors = 0
+        self.length_errors = 0
+        self.expired = 0
+        self.skipped_bytes = 0
+
+    def pending(self):
+        """
+        Returns how many bytes are waiting for the rest of their message.
+        """
+        return self._end - self._start
+
+    def clear(self):
+        self._start = self._end = 0
+        self._wait_pos = None
+
+    def time_to_expiry(self, now=None):
+        """
+        Returns the seconds until expire() would drop the partial message, or None if nothing is waiting.
+        """
+        if self._wait_pos is None or self._partial_timeout is None:
+            return None
+        now = monotonic() if now is None else now
+        return max(self._wait_since + self._partial_timeout - now, 0.0)
+
+    def expire(self, now=None):
+        """
+        Drops the partial message if it has waited longer than partial_timeout, resyncs on the next preamble and
+        yields each (message_id, payload) that was stuck behind it. A partial message found after it in bytes that
+        were already there when the wait started is just as old, so it is dropped too.
+        """
+        if self.time_to_expiry(now) != 0.0:
+            return
+        stale_end = self._wait_end
+        while self._wait_pos is not None and self._wait_pos < stale_end:
+            self._logger.debug('dropping partial message after %.3fs', monotonic() - self._wait_since)
+            self.expired += 1
+            self.skipped_bytes += 1
+            self._start = self._wait_pos + 1
+            self._wait_pos = None
+            for frame in self._frames():
+                yield frame
+
+    def feed(self, data):
+        """
+        Adds a bytes like object and yields each (message_id, payload) it completes. A payload view is only valid
+        until the generator is resumed.
+        """
+        data = memoryview(data)
+        offset = 0
+        while True:
+            # More than the buffer holds is taken in pieces; a message never needs more than the whole buffer
+            offset += self._append(data[offset:])
+            for frame in self._frames():
+                yield frame
+            if offset >= len(data):
+                break
+
+    def _append(self, data):
+        room = len(self._buf) - self._end
+        if room < len(data) and self._start:
+            # Move the partial message (usually a few bytes) to the front to make room
+            pending = self._end - self._start
+            self._view[:pending] = self._view[self._start:self._end]
+            if self._wait_pos is not None:
+                self._wait_pos -= self._start
+                self._wait_end -= self._start
+            self._start = 0
+            self._end = pending
+            room = len(self._buf) - pending
+        nbytes = min(room, len(data))
+        self._view[self._end:self._end + nbytes] = data[:nbytes]
+        self._end += nbytes
+        return nbytes
+
+    def _frames(self):
+        buf = self._buf
+        view = self._view
+        end = self._end
+        pos = self._start
+        preamble = constants.Message.PREAMBLE_BYTE
+        overhead = constants.Message.OVERHEAD
+        max_payload = len(buf) - overhead
+        try:
+            while True:
+                found = buf.find(preamble, pos, end)
+                if found < 0:
+                    self.skipped_bytes += end - pos
+                    pos = end
+                    break
+                self.skipped_bytes += found - pos
+                pos = found
+                if end - pos < overhead:
+                    break
+                payload_len = _PAYLOAD_LEN.unpack_from(buf, pos + constants.Message.PAYLOAD_LEN_OFFSET)[0]
+                if payload_len > max_payload:
+                    self.length_errors += 1
+                    self.skipped_bytes += 1
+                    pos += 1
+                    continue
+                crc_pos = pos + constants.Message.PAYLOAD_OFFSET + payload_len
+                if crc_pos + constants.Message.CRC_BYTES > end:
+                    break
+                if crc16(view[pos:crc_pos], init=constants.Message.CRC_SEED) != _CRC.unpack_from(buf, crc_pos)[0]:
+                    self.crc_errors += 1
+                    self.skipped_bytes += 1
+                    pos += 1
+                    continue
+                message_id = buf[pos + constants.Message.MESSAGE_ID_OFFSET]
+                payload = view[pos + constants.Message.PAYLOAD_OFFSET:crc_pos]
+                pos = crc_pos + constants.Message.CRC_BYTES
+                self.frames += 1
+                yield message_id, payload
+        finally:
+            if pos == end:
+                self._start = self._end = 0
+                self._wait_pos = None
+            else:
+                self._start = pos
+                if pos != self._wait_pos:
+                    self._wait_pos = pos
+                    self._wait_since = monotonic()
+                    self._wait_end = end
+
+    def __str__(self):
+        return 'frames=%d crc_errors=%d length_errors=%d expired=%d skipped_bytes=%d pending=%d' % (
+            self.frames, self.crc_errors, self.length_errors, self.expired, self.skipped_bytes, self.pending())
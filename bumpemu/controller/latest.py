@@ -0,0 +1,69 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import deque
+from time import monotonic
+
+
+class Sample(object):
+    """
+    One published value with when it was taken and its sequence number, which goes up by one per publish.
+    """
+    __slots__ = ('value', 'timestamp', 'seq')
+
+    def __init__(self, value, timestamp, seq):
+        self.value = value
+        self.timestamp = timestamp
+        self.seq = seq
+
+    @property
+    def age(self):
+        return monotonic() - self.timestamp
+
+
+class LatestSample(object):
+    """
+    Holds the most recent value from a single writer for any number of readers. The writer fills in a new
+    Sample and then swaps it in with one reference assignment, so readers never wait on the writer and never
+    see a sample that is half written; they just get the latest complete one, with its age. The last history
+    samples are also kept in a ring.
+    """
+
+    def __init__(self, history=0):
+        self._sample = None
+        self._seq = 0
+        self._history = deque(maxlen=history)
+
+    def publish(self, value, timestamp=None):
+        self._seq += 1
+        sample = Sample(value, monotonic() if timestamp is None else timestamp, self._seq)
+        self._history.append(sample)
+        self._sample = sample
+
+    def clear(self):
+        self._sample = None
+        self._history.clear()
+
+    def history(self):
+        """
+        Returns the samples kept in the ring, oldest first.
+        """
+        return list(self._history)
+
+    def get(self):
+        """
+        Returns the latest Sample, or None if nothing has been published since the last clear().
+        """
+        return self._sample
@@ -0,0 +1,66 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+from time import monotonic
+
+from gi.repository import GLib
+
+
+class LoopMonitor(object):
+    """
+    Measures how late the GLib main loop runs a timer due every interval seconds. D-Bus calls from BlueZ
+    (StartNotify, WriteValue, GetManagedObjects, ...) are dispatched by the same loop, so this lag is how long
+    they wait behind other work. A lag over warn_lag is logged as a stall.
+    """
+
+    def __init__(self, interval=0.1, warn_lag=0.05):
+        self._logger = logging.getLogger(__name__)
+        self._interval = interval
+        self._warn_lag = warn_lag
+        self._running = False
+        self._expected = None
+        self.probes = 0
+        self.stalls = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self):
+        self._running = True
+        self._expected = monotonic() + self._interval
+        GLib.timeout_add(int(self._interval * 1000), self._probe)
+
+    def stop(self):
+        self._running = False
+
+    @property
+    def avg_lag(self):
+        return self.total_lag / self.probes if self.probes else 0.0
+
+    def _probe(self):
+        now = monotonic()
+        lag = max(now - self._expected, 0.0)
+        self._expected = now + self._interval
+        self.probes += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+        if lag > self._warn_lag:
+            self.stalls += 1
+            self._logger.warning('main loop stalled for %.3fs', lag)
+        return self._running
+
+    def __str__(self):
+        return 'probes=%d avg_lag=%.1fms max_lag=%.1fms stalls=%d' % (
+            self.probes, self.avg_lag * 1000, self.max_lag * 1000, self.stalls)
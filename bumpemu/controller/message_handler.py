@@ -13,25 +13,35 @@
 #      You should have received a copy of the GNU General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import struct
 import logging
+from itertools import chain
 # noinspection PyCompatibility
-from queue import Queue
+from queue import Queue, Empty, Full
 from threading import Thread
 
-from bumpemu.circular_bytearray import CircularByteArray
-from bumpemu.util import crc16
 from bumpemu.controller import constants
+from bumpemu.controller.frame_decoder import FrameDecoder
 from bumpemu.controller.messages.manual_start import ManualStart
 from bumpemu import debug
 from bumpemu.debug import print_bytes
 
 
 class MessageHandler(object):
+    """
+    Decodes writes from the app on its own thread and calls the matching RxChrc handler for each message. A
+    message still missing bytes after PARTIAL_TIMEOUT seconds is dropped so the ones behind it (a stop command,
+    say) get through. At most MAX_QUEUED writes wait to be decoded; append() returns False once it is that far
+    behind.
+    """
+    PARTIAL_TIMEOUT = 0.2
+    MAX_QUEUED = 64
+
     def __init__(self, rx_chrc):
         self._logger = logging.getLogger(__name__)
         self._rx_chrc = rx_chrc
-        self._buf = CircularByteArray(4096)
+        self._decoder = FrameDecoder(4096, self.PARTIAL_TIMEOUT)
+        self.dropped_writes = 0
+        self.failed = 0
         self._message_handlers = {
             constants.MessageId.SELECTED_OPERATION_NOT.value: lambda xx: self._rx_chrc.selected_operation(
                 port=xx[0], operation=xx[1]),
@@ -47,66 +57,42 @@ class MessageHandler(object):
             constants.MessageId.SET_BATTERY_GROUP_COUNT_CMD.value: lambda xx: self._rx_chrc.set_battery_group_count(
                 port=xx[0], group_index=xx[1], count=xx[2]),
         }
-        self._queue = Queue()
+        self._queue = Queue(self.MAX_QUEUED)
         self._thread = Thread(target=self._queue_processor, daemon=True)
         self._thread.start()
 
     def append(self, buf):
-        self._queue.put(buf)
+        """
+        Queues buf for decoding. Returns False, dropping it, if MAX_QUEUED writes are already waiting.
+        """
+        try:
+            self._queue.put_nowait(buf)
+        except Full:
+            self.dropped_writes += 1
+            self._logger.warning('message handler behind, dropped %d bytes', len(buf))
+            return False
+        return True
 
-    def _queue_processor(self):
-        while True:
-            buf = self._queue.get()
-            if debug.LOG_BLUETOOTH:
-                print_bytes(self._logger, logging.DEBUG, buf, 'r')
-            if self._buf.available() < len(buf):
-                raise Exception('circular buffer is full')
-            self._buf.append(buf)
-            self._handle_messages()
+    def full(self):
+        return self._queue.full()
 
-    def _advance_to_next_preamble(self):
+    def _queue_processor(self):
         while True:
-            bb = self._buf.peek()
-            if bb is None or bb == constants.Message.PREAMBLE_BYTE:
-                break
-            self._buf.advance(1)
-
-    def _handle_messages(self):
-        self._advance_to_next_preamble()
-
-        buf_len = self._buf.size()
-        while constants.Message.OVERHEAD <= buf_len:
-            assert (self._buf.peek() == constants.Message.PREAMBLE_BYTE)
-            payload_len_start_idx = self._buf.read_index + constants.Message.PAYLOAD_LEN_OFFSET
-            payload_len = struct.unpack(constants.Message.PAYLOAD_LEN_FORMAT,
-                                        self._buf[payload_len_start_idx:
-                                                  payload_len_start_idx + constants.Message.PAYLOAD_LEN_BYTES])[0]
-            message_size = payload_len + constants.Message.OVERHEAD
-            if debug.LOG_BLUETOOTH:
-                self._logger.debug('message_size: %d', message_size)
-            if message_size > self._buf.capacity():
-                self._logger.warning('message larger than circ buf size')
-                self._advance_to_next_preamble()
-                buf_len = self._buf.size()
-                continue
-            elif message_size <= buf_len:
-                payload_start_idx = self._buf.read_index + constants.Message.PAYLOAD_OFFSET
-                crc_start_idx = payload_start_idx + payload_len
-                crc = struct.unpack(constants.Message.CRC_FORMAT,
-                                    self._buf[crc_start_idx:crc_start_idx + constants.Message.CRC_BYTES])[0]
-                calc_crc = crc16(self._buf[self._buf.read_index:crc_start_idx], init=constants.Message.CRC_SEED)
+            try:
+                buf = self._queue.get(timeout=self._decoder.time_to_expiry())
+            except Empty:
+                frames = self._decoder.expire()
+            else:
                 if debug.LOG_BLUETOOTH:
-                    self._logger.debug('crc: %s calc_crc: %s', hex(crc), hex(calc_crc))
-                if crc == calc_crc:
-                    message_id = self._buf[self._buf.read_index + constants.Message.MESSAGE_ID_OFFSET]
-                    payload = self._buf[payload_start_idx:crc_start_idx]
-                    self._buf.advance(constants.Message.OVERHEAD + payload_len)
+                    print_bytes(self._logger, logging.DEBUG, buf, 'r')
+                # a slow trickle of bytes must not keep a stale partial message alive either
+                frames = chain(self._decoder.feed(buf), self._decoder.expire())
+            for message_id, payload in frames:
+                try:
                     self._handle_message(message_id, payload)
-            else:
-                # TODO: add timeout
-                break
-            self._advance_to_next_preamble()
-            buf_len = self._buf.size()
+                except Exception as ex:
+                    self.failed += 1
+                    self._logger.exception(ex)
 
     def _handle_message(self, message_id, payload):
         self._logger.debug('_handle_message - message_id: %s payload_len: %d', message_id, len(payload))
@@ -115,3 +101,6 @@ class MessageHandler(object):
             handler(payload)
         else:
             self._logger.debug('unhandled message id: %s', hex(message_id))
+
+    def __str__(self):
+        return '%s dropped_writes=%d failed=%d' % (self._decoder, self.dropped_writes, self.failed)
@@ -0,0 +1,118 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import struct
+from threading import Lock
+
+import dbus
+from gi.repository import GLib
+
+from bumpemu.util import crc16
+from bumpemu.controller import constants
+from bumpemu import debug
+from bumpemu.debug import print_bytes
+
+
+class NotificationPacker(object):
+    """
+    Frames outgoing messages (header, payload, CRC) back to back in one reusable buffer and hands them to emit on
+    the main loop as byte arrays of at most chunk_size bytes. Messages written before the main loop gets to the
+    ones already waiting go out in the same notifications, so a burst of small messages, e.g. the settings sent
+    at connect, takes as few notifications as the MTU allows.
+    """
+    DEFAULT_CHUNK_SIZE = 40
+    MIN_MTU = 23
+    ATT_HEADER_BYTES = 3
+
+    def __init__(self, model_id, emit, size=512):
+        self._logger = logging.getLogger(__name__)
+        self._model_id = model_id
+        self._emit = emit
+        self._buf = bytearray(size)
+        self._len = 0
+        self._lock = Lock()
+        self._flush_pending = False
+        self.chunk_size = self.DEFAULT_CHUNK_SIZE
+        self.messages = 0
+        self.notifications = 0
+        self.bytes = 0
+
+    def set_mtu(self, mtu):
+        """
+        Sizes notifications to the ATT MTU BlueZ reports for the connection.
+        """
+        chunk_size = max(mtu, self.MIN_MTU) - self.ATT_HEADER_BYTES
+        if chunk_size != self.chunk_size:
+            self._logger.info('mtu %d: notifying up to %d bytes at a time', mtu, chunk_size)
+            self.chunk_size = chunk_size
+
+    def reset_mtu(self):
+        self.chunk_size = self.DEFAULT_CHUNK_SIZE
+
+    def write(self, message_id, payload):
+        nbytes = len(payload) + constants.Message.OVERHEAD
+        with self._lock:
+            start = self._len
+            end = start + nbytes
+            if end > len(self._buf):
+                self._buf.extend(bytes(max(end, 2 * len(self._buf)) - len(self._buf)))
+            buf = self._buf
+            struct.pack_into(constants.Message.HEADER_FORMAT,
+                             buf,
+                             start,
+                             constants.Message.PREAMBLE_BYTE,
+                             self._model_id,
+                             message_id,
+                             len(payload))
+            crc_start = end - constants.Message.CRC_BYTES
+            buf[start + constants.Message.HEADER_BYTES:crc_start] = payload
+            with memoryview(buf) as view:
+                crc = crc16(view[start:crc_start], init=constants.Message.CRC_SEED)
+                struct.pack_into(constants.Message.CRC_FORMAT, buf, crc_start, crc)
+                if debug.LOG_BLUETOOTH:
+                    print_bytes(self._logger, logging.DEBUG, view[start:end], 'w')
+            self._len = end
+            self.messages += 1
+            if self._flush_pending:
+                return
+            self._flush_pending = True
+        # Only the main loop talks to D-Bus; this is usually called from the charger worker or message thread
+        GLib.idle_add(self._flush)
+
+    def discard(self):
+        """
+        Drops messages that have not been handed to the main loop yet.
+        """
+        with self._lock:
+            self._len = 0
+
+    def _flush(self):
+        with self._lock:
+            chunk_size = self.chunk_size
+            with memoryview(self._buf) as view:
+                chunks = [dbus.ByteArray(view[ii:min(ii + chunk_size, self._len)].tobytes())
+                          for ii in range(0, self._len, chunk_size)]
+            self.bytes += self._len
+            self._len = 0
+            self._flush_pending = False
+        for chunk in chunks:
+            self._emit(chunk)
+        self.notifications += len(chunks)
+        return False
+
+    def __str__(self):
+        return 'messages=%d notifications=%d bytes=%d chunk_size=%d' % (
+            self.messages, self.notifications, self.bytes, self.chunk_size)
@@ -0,0 +1,109 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+from time import monotonic
+
+from bumpemu.controller.state_machine import state
+
+
+class AdaptivePollRate(object):
+    """
+    Picks how long to wait before the next charger poll. Pack detection and halt for safety are polled every
+    min_interval, as is any poll where the charge current or pack voltage is moving faster than amps_per_sec or
+    volts_per_sec or the charger has just entered or left constant voltage. Other charging, discharging and
+    monitoring is polled every interval. Anything else (idle, disconnected, complete, stopped, error) starts at
+    interval and doubles after each poll up to max_interval.
+    """
+    FAST = 'fast'
+    ACTIVE = 'active'
+    BACKOFF = 'backoff'
+
+    _FAST_STATES = (state.StartingState, state.HaltForSafety)
+    _ACTIVE_STATES = (state.ChargingState, state.DischargingState, state.MonitoringState)
+
+    def __init__(self, interval, min_interval, max_interval, amps_per_sec=0.5, volts_per_sec=0.05):
+        self._logger = logging.getLogger(__name__)
+        self._base = min(max(interval, min_interval), max_interval)
+        self._min = min_interval
+        self._max = max_interval
+        self._amps_per_sec = amps_per_sec
+        self._volts_per_sec = volts_per_sec
+        self._last = None
+        self._started = monotonic()
+        self.interval = self._base
+        self.reason = self.ACTIVE
+        self.polls = {self.FAST: 0, self.ACTIVE: 0, self.BACKOFF: 0}
+
+    def reset(self):
+        """
+        Goes back to interval and forgets the last reading, e.g. after commanding the charger.
+        """
+        self._last = None
+        self.interval = self._base
+        self.reason = self.ACTIVE
+
+    def update(self, current_state, sample):
+        """
+        Returns the seconds to wait before the next poll given the emulator state and the latest status Sample
+        (or None).
+        """
+        changing = False
+        if sample is not None and (self._last is None or sample.seq != self._last[0]):
+            chg_status = sample.value
+            amps = chg_status.avg_amps
+            volts = sum(chg_status.b_volts)
+            if self._last is not None:
+                _, timestamp, last_amps, last_volts, last_cv = self._last
+                elapsed = sample.timestamp - timestamp
+                changing = chg_status.cv_started != last_cv or (elapsed > 0 and (
+                    abs(amps - last_amps) / elapsed > self._amps_per_sec or
+                    abs(volts - last_volts) / elapsed > self._volts_per_sec))
+            self._last = (sample.seq, sample.timestamp, amps, volts, chg_status.cv_started)
+
+        if isinstance(current_state, self._FAST_STATES) or \
+                (changing and isinstance(current_state, self._ACTIVE_STATES)):
+            reason, interval = self.FAST, self._min
+        elif isinstance(current_state, self._ACTIVE_STATES):
+            reason, interval = self.ACTIVE, self._base
+        elif self.reason == self.BACKOFF:
+            reason, interval = self.BACKOFF, min(self.interval * 2, self._max)
+        else:
+            reason, interval = self.BACKOFF, self._base
+
+        if reason != self.reason:
+            self._logger.debug('polling every %.2fs (%s)', interval, reason)
+        self.reason = reason
+        self.interval = interval
+        self.polls[reason] += 1
+        return interval
+
+    @property
+    def rate(self):
+        """
+        Polls per second currently in effect.
+        """
+        return 1.0 / self.interval
+
+    @property
+    def average_rate(self):
+        total = sum(self.polls.values())
+        elapsed = monotonic() - self._started
+        return total / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return 'interval=%.2fs (%s, %.2f Hz) average=%.2f Hz fast=%d active=%d backoff=%d' % (
+            self.interval, self.reason, self.rate, self.average_rate, self.polls[self.FAST],
+            self.polls[self.ACTIVE], self.polls[self.BACKOFF])
@@ -0,0 +1,91 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from time import monotonic
+
+
+class StatusNotifyCache(object):
+    """
+    Remembers the last status message built and the last one sent so the status loop can skip repeating work.
+
+    A frame hit means the charger's Ram frame and the emulator state that goes into the message are the same as
+    last tick, so the message built then is reused. A suppressed notify means the message is byte for byte the
+    one the app already has. A message is still sent once keepalive seconds have passed since the last send;
+    a keepalive of 0 sends every message.
+    """
+
+    def __init__(self, keepalive):
+        self._keepalive = keepalive
+        self.frames = 0
+        self.frame_hits = 0
+        self.notifies = 0
+        self.suppressed = 0
+        self.keepalives = 0
+        self.reset()
+
+    @property
+    def keepalive(self):
+        return self._keepalive
+
+    def reset(self):
+        """
+        Forgets the last frame and message, e.g. when the app reconnects and has seen neither.
+        """
+        self._key = None
+        self._message = None
+        self._sent = None
+        self._sent_at = None
+
+    def message_for(self, key):
+        """
+        Returns the (message_id, payload) built for key last tick, or None if key has changed.
+        """
+        self.frames += 1
+        if self._message is not None and key == self._key:
+            self.frame_hits += 1
+            return self._message
+        return None
+
+    def remember(self, key, message):
+        self._key = key
+        self._message = message
+
+    def should_send(self, message, now=None):
+        """
+        Returns whether message needs to go to the app, and if so counts it as sent.
+        """
+        now = monotonic() if now is None else now
+        self.notifies += 1
+        if self._keepalive and message == self._sent:
+            if now - self._sent_at < self._keepalive:
+                self.suppressed += 1
+                return False
+            self.keepalives += 1
+        self._sent = message
+        self._sent_at = now
+        return True
+
+    @property
+    def frame_hit_rate(self):
+        return self.frame_hits / self.frames if self.frames else 0.0
+
+    @property
+    def suppressed_rate(self):
+        return self.suppressed / self.notifies if self.notifies else 0.0
+
+    def __str__(self):
+        return ('frames=%d frame_hits=%d (%.0f%%) notifies=%d suppressed=%d (%.0f%%) keepalives=%d' %
+                (self.frames, self.frame_hits, self.frame_hit_rate * 100, self.notifies, self.suppressed,
+                 self.suppressed_rate * 100, self.keepalives))
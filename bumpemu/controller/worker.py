@@ -0,0 +1,90 @@
+#      Copyright (C) 2019  Frank Riley
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU General Public License as published by
+#      the Free Software Foundation, either version 3 of the License, or
+#      (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU General Public License for more details.
+#
+#      You should have received a copy of the GNU General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+from collections import deque
+from threading import Thread, Condition
+from time import monotonic
+
+
+class ChargerWorker(object):
+    """
+    Runs work that talks to the charger on its own thread so the GLib main loop, which also serves every D-Bus
+    call from BlueZ, never waits on the serial link. Work is run one item at a time in the order posted. Work
+    posted with a key that is already queued is dropped, so a slow link skips status updates rather than
+    building a backlog of them.
+    """
+
+    def __init__(self, name='charger'):
+        self._logger = logging.getLogger(__name__)
+        self._queue = deque()
+        self._queued_keys = set()
+        self._cv = Condition()
+        self._stopped = False
+        self.posted = 0
+        self.dropped = 0
+        self.failed = 0
+        self.max_wait = 0.0
+        self.max_run = 0.0
+        self._thread = Thread(target=self._run, name='%s-worker' % name, daemon=True)
+        self._thread.start()
+
+    def post(self, func, key=None):
+        """
+        Queues func to run on the worker thread. Returns False if it was dropped because work with the same key
+        is still waiting to run.
+        """
+        with self._cv:
+            if self._stopped:
+                return False
+            if key is not None:
+                if key in self._queued_keys:
+                    self.dropped += 1
+                    return False
+                self._queued_keys.add(key)
+            self.posted += 1
+            self._queue.append((func, key, monotonic()))
+            self._cv.notify()
+        return True
+
+    def stop(self):
+        with self._cv:
+            self._stopped = True
+            self._queue.clear()
+            self._queued_keys.clear()
+            self._cv.notify()
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._stopped and not self._queue:
+                    self._cv.wait()
+                if self._stopped:
+                    return
+                func, key, posted = self._queue.popleft()
+                self._queued_keys.discard(key)
+            start = monotonic()
+            try:
+                func()
+            except Exception as ex:
+                self.failed += 1
+                self._logger.exception(ex)
+            end = monotonic()
+            self.max_wait = max(self.max_wait, start - posted)
+            self.max_run = max(self.max_run, end - start)
+
+    def __str__(self):
+        return 'posted=%d dropped=%d failed=%d max_wait=%.3fs max_run=%.3fs' % (
+            self.posted, self.dropped, self.failed, self.max_wait, self.max_run)
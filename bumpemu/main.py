@@ -24,14 +24,27 @@ import serial.tools.list_ports as list_ports
 from gi.repository import GLib
 from bumpemu.controller import bluez_dbus, constants
 from bumpemu.controller.emulator import BumpEmulator, UartAdvertisement
+from bumpemu.controller.loop_monitor import LoopMonitor
 from bumpemu.controller.messages.battery import Battery
 from bumpemu.charger.powerlab import Powerlab
+from bumpemu.charger.cache import PresetCache
+from bumpemu.charger.scheduler import ScheduledPowerlab
 from bumpemu.util import ignore_exc
 from bumpemu import debug
 
 
-def _check_charger(port):
-    with Powerlab(port) as pl:
+def _preset_cache(args, logger):
+    if args.no_cache:
+        return None
+    try:
+        return PresetCache(args.cache_dir)
+    except OSError as ex:
+        logger.warning('preset cache disabled: %s', ex)
+        return None
+
+
+def _check_charger(port, cache):
+    with Powerlab(port, cache=cache) as pl:
         print('Reading options...')
         options = pl.read_options()
         print('Reading status...')
@@ -66,8 +79,8 @@ def _print_presets(args, presets):
         _print_preset(presets[args.presets_config[key]], key)
 
 
-def _show_presets(args):
-    with Powerlab(args.port) as pl:
+def _show_presets(args, cache):
+    with Powerlab(args.port, cache=cache) as pl:
         print('Reading presets (slow)...')
         presets = pl.read_presets()
         _print_presets(args, presets)
@@ -100,12 +113,14 @@ def run(args, logger):
                 print(port)
             raise SystemExit(0)
 
+        cache = _preset_cache(args, logger)
+
         if args.check:
-            _check_charger(args.port)
+            _check_charger(args.port, cache)
             raise SystemExit(0)
 
         if args.show_presets:
-            _show_presets(args)
+            _show_presets(args, cache)
             raise SystemExit(0)
 
         presets = {constants.ChargerOperation[key.upper()]: val for key, val in args.presets_config.items()}
@@ -125,12 +140,16 @@ def run(args, logger):
         app = None
         adv = None
         pl = None
+        loop_monitor = LoopMonitor() if args.loop_monitor else None
 
         try:
             if not args.no_app_register:
-                pl = Powerlab(args.port)
+                pl = ScheduledPowerlab(Powerlab(args.port, event_driven_reader=args.event_driven_serial, cache=cache),
+                                       status_deadline=args.poll_interval)
                 service_manager = dbus.Interface(bluez_obj, bluez_dbus.GATT_MANAGER_IFACE)
-                app = BumpEmulator(bus, 'bump_emulator', pl, args.battery, presets, args.status_interval)
+                app = BumpEmulator(bus, 'bump_emulator', pl, args.battery, presets, args.status_interval,
+                                   args.status_keepalive, args.poll_interval, args.poll_min, args.poll_max,
+                                   not args.no_acquire, args.standby_interval)
                 service_manager.RegisterApplication(
                     app.path,
                     {},
@@ -145,8 +164,13 @@ def run(args, logger):
                     reply_handler=lambda: _register_ad_cb(logger, adv_flag),
                     error_handler=lambda ee: _register_ad_error_cb(logger, ee, mainloop))
 
+            if loop_monitor:
+                loop_monitor.start()
             mainloop.run()
         finally:
+            if loop_monitor:
+                loop_monitor.stop()
+                logger.info('main loop lag: %s', loop_monitor)
             if adv_flag.registered:
                 ignore_exc(func=lambda: adv_manager.UnregisterAdvertisement(adv.path))
                 logger.info('Advertisement unregistered')
@@ -155,6 +179,7 @@ def run(args, logger):
                 logger.info('App unregistered')
             if pl:
                 ignore_exc(func=pl.close)
+                ignore_exc(func=pl.shutdown)
     except KeyboardInterrupt:
         raise SystemExit(0)
     except SystemExit:
@@ -174,6 +199,26 @@ def _positive_int(value):
     return ivalue
 
 
+def _positive_float(value):
+    try:
+        fvalue = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is an invalid positive number' % value)
+    if fvalue <= 0:
+        raise argparse.ArgumentTypeError('%s is an invalid positive number' % value)
+    return fvalue
+
+
+def _non_negative_int(value):
+    try:
+        ivalue = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is an invalid non-negative int value' % value)
+    if ivalue < 0:
+        raise argparse.ArgumentTypeError('%s is an invalid non-negative int value' % value)
+    return ivalue
+
+
 def _battery_file(value):
     if os.path.isfile(value):
         try:
@@ -212,6 +257,7 @@ def _presets_file(value):
 def main():
     presets_yml = os.path.realpath('/etc/bumpemu/presets.yml')
     battery_yml = os.path.realpath('/etc/bumpemu/battery.yml')
+    cache_dir = '/var/cache/bumpemu'
     if not os.path.isfile(battery_yml):
         battery_yml = None
 
@@ -230,15 +276,47 @@ def main():
                         help="Don't advertise on BLE.")
     parser.add_argument('-R', '--no-app-register', action='store_true',
                         help="Don't register the app with BLE.")
-    parser.add_argument('--status-interval', type=_positive_int, default=1, metavar='SECONDS',
-                        help=('Set the interval in seconds when status is retrieved from the charger. '
-                              'Dev use only. (default: 1).'))
+    parser.add_argument('--no-acquire', action='store_true',
+                        help=("Don't let BlueZ hand the app's writes and notifications over sockets "
+                              '(AcquireWrite/AcquireNotify); send everything as D-Bus calls and signals instead.'))
+    parser.add_argument('--status-interval', type=_positive_float, default=1, metavar='SECONDS',
+                        help=('Set the interval in seconds at which status is sent to the app. May be less than a '
+                              'second. Dev use only. (default: 1).'))
+    parser.add_argument('--poll-interval', type=_positive_float, default=1, metavar='SECONDS',
+                        help=('Set the interval in seconds at which status is read from the charger. May be less '
+                              'than a second. Dev use only. (default: 1).'))
+    parser.add_argument('--poll-min', type=_positive_float, default=0.25, metavar='SECONDS',
+                        help=('Set the shortest interval in seconds between charger reads, used while a pack is being '
+                              'detected or the current or voltage is changing quickly. (default: 0.25).'))
+    parser.add_argument('--poll-max', type=_positive_float, default=8, metavar='SECONDS',
+                        help=('Set the longest interval in seconds between charger reads, which the interval backs '
+                              'off to while the charger is idle. (default: 8).'))
+    parser.add_argument('--standby-interval', type=_positive_float, metavar='SECONDS',
+                        help=('Keep reading the charger every this many seconds while no app is connected, so the '
+                              'serial link, presets and recent status are current when one connects and charger '
+                              'disconnects and preset changes are noticed right away. (default: off).'))
+    parser.add_argument('--status-keepalive', type=_non_negative_int, default=0, metavar='SECONDS',
+                        help=('Only send the app a status update that is the same as the last one sent once this '
+                              'many seconds have passed. 0 sends every update. (default: 0).'))
+    parser.add_argument('--event-driven-serial', action='store_true',
+                        help=('Only wake the serial reader when the charger sends data instead of polling the port '
+                              'every 100 ms.'))
+    parser.add_argument('--cache-dir', metavar='DIR', default=cache_dir,
+                        help='Set the directory where presets read from the charger are cached. (default: %s)' %
+                             cache_dir)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always read the presets from the charger instead of using the cache.')
     parser.add_argument('-l', '--log-level', metavar='LEVEL', default='INFO',
                         help='Set the log level (default: INFO).')
     parser.add_argument('--log-serial', action='store_true', help='Turn on logging of the raw serial bytes.')
     parser.add_argument('--log-bluetooth', action='store_true', help='Turn on logging of the raw bluetooth bytes.')
     parser.add_argument('--log-status', action='store_true', help='Turn on logging of the charger status object.')
+    parser.add_argument('--loop-monitor', action='store_true',
+                        help=('Measure how late the main loop runs, which is how long D-Bus calls wait, and log '
+                              'stalls. Wakes the process 10 times a second.'))
     pargs = parser.parse_args()
+    if pargs.poll_min > pargs.poll_max:
+        parser.error('--poll-min must not be greater than --poll-max')
 
     loggr = logging.getLogger()
     handler = logging.StreamHandler(sys.stdout)
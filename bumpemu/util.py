@@ -14,6 +14,8 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import sys
+from array import array
 
 
 def ignore_exc(func):
@@ -24,33 +26,74 @@ def ignore_exc(func):
         pass
 
 
-def crc16(data, init):
-    crc = init
-    for bb in data:
+def _make_crc16_table(poly=0x8408):
+    table = []
+    for byte in range(256):
+        crc = byte
         for _ in range(8):
-            if (bb ^ crc) & 1:
-                crc = (crc >> 1) ^ 0x8408
+            if crc & 1:
+                crc = (crc >> 1) ^ poly
             else:
                 crc >>= 1
-            bb >>= 1
+        table.append(crc)
+    return tuple(table)
+
+
+_CRC16_TABLE = _make_crc16_table()
+
+
+def _crc16_update(crc, data):
+    table = _CRC16_TABLE
+    for bb in data:
+        crc = (crc >> 8) ^ table[(crc ^ bb) & 0xff]
     return crc
 
 
+def crc16(data, init):
+    return _crc16_update(init, data)
+
+
+class Crc16(object):
+    """
+    Streaming CRC16 (reflected 0x8408) that can be fed data as it arrives.
+    """
+
+    def __init__(self, init):
+        self._init = init
+        self._crc = init
+
+    @property
+    def value(self):
+        return self._crc
+
+    def update(self, data):
+        self._crc = _crc16_update(self._crc, data)
+        return self
+
+    def reset(self):
+        self._crc = self._init
+
+
 def rotate_bit16_left(val, nrolls):
-    while nrolls:
-        bit = (val & (1 << 15)) >> 15
-        val <<= 1
-        val |= bit
-        nrolls -= 1
-    return val & 0xffff
+    val &= 0xffff
+    nrolls %= 16
+    return ((val << nrolls) | (val >> (16 - nrolls))) & 0xffff
+
+
+def _be_words(data):
+    words = array('H')
+    words.frombytes(data)
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return words
 
 
 def checksum(data, init):
     assert ((len(data) % 2) == 0)
     cksum = init
-    for ii in range(0, len(data), 2):
-        cksum += ((data[ii] << 8) | data[ii + 1])
-        cksum = rotate_bit16_left(cksum & 0xffff, 2)
+    for word in _be_words(data):
+        cksum = (cksum + word) & 0xffff
+        cksum = ((cksum << 2) | (cksum >> 14)) & 0xffff
     return cksum
 
 
@@ -61,12 +104,8 @@ def byte_to_char(val):
 
 
 def bits_from_int16(data, index, start_bit, end_bit):
-    val = 0
     int16 = (data[index] << 8) | data[index + 1]
-    for nbit in range(start_bit, end_bit + 1):
-        if int16 & (1 << nbit):
-            val += (1 << (nbit - start_bit))
-    return val
+    return (int16 >> start_bit) & ((1 << (end_bit - start_bit + 1)) - 1)
 
 
 def int16_to_bits(data, index, start_bit, end_bit, value):
@@ -75,13 +114,8 @@ def int16_to_bits(data, index, start_bit, end_bit, value):
         raise Exception('value must be >= 0')
     if value >= (2 ** nbits):
         raise Exception('value (%d) too large for bits (%d)' % (value, nbits))
-    value <<= start_bit
-    int16 = (data[index] << 8) | data[index + 1]
-    for nbit in range(start_bit, end_bit + 1):
-        if value & (1 << nbit):
-            int16 |= (1 << nbit)
-        else:
-            int16 &= ~(1 << nbit)
+    mask = ((1 << nbits) - 1) << start_bit
+    int16 = (((data[index] << 8) | data[index + 1]) & ~mask) | (value << start_bit)
     data[index] = (int16 >> 8)
     data[index + 1] = (int16 & 0xff)
 
@@ -102,10 +136,7 @@ def str_from_data(data, start, end):
 
 
 def swap_bytes(data, start=0):
-    for ii in range(start, len(data), 2):
-        tmp = data[ii]
-        data[ii] = data[ii + 1]
-        data[ii + 1] = tmp
+    data[start::2], data[start + 1::2] = data[start + 1::2], data[start::2]
     return data
 
 
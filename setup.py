@@ -32,6 +32,7 @@ with open("README.md", "r") as fh:
     long_description = fh.read()
 
 REQUIRES = ['dbus-python>=1.2.8', 'PyGObject>=3.22.0', 'pyserial>=3.4', 'PyYAML>=3.13']
+EXTRAS = {'analysis': ['numpy>=1.13']}
 
 setuptools.setup(
     name="bumpemu",
@@ -48,6 +49,7 @@ setuptools.setup(
     package_data={'bumpemu': ['config/presets.yml']},
     python_requires='>=3.5',
     install_requires=REQUIRES,
+    extras_require=EXTRAS,
     classifiers=[
         "Development Status :: 4 - Beta",
         "Environment :: Console",